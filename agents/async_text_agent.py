@@ -0,0 +1,76 @@
+# async_text_agent.py
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+import openai
+
+from agents.entity_extraction import extract_entities_local, has_entities
+from agents.text_agent import (
+    TEXT_MODEL, SUB_ISSUES, DEFAULT_SUB_ISSUE, ENTITY_EXTRACTION_MODE, redis_conn,
+    local_issue, local_sub_issue, record_classification, categorize_messages, parse_categorization, issue_messages, sub_issue_messages,
+    sentiment_messages, entities_messages, key_phrases_messages, build_structured_output
+)
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Maximum number of LLM requests in flight for a single complaint
+TEXT_AGENT_CONCURRENCY = int(os.environ.get('TEXT_AGENT_CONCURRENCY', 5))
+
+async def _achat(semaphore: asyncio.Semaphore, messages: List[Dict[str, str]], **kwargs) -> str:
+    async with semaphore:
+        response = await openai.ChatCompletion.acreate(
+            model=TEXT_MODEL,
+            messages=messages,
+            **kwargs
+        )
+    return response.choices[0].message['content']
+
+async def _classify(semaphore: asyncio.Semaphore, text: str) -> Tuple[str, str]:
+    # classify_sub_issue depends on the issue, so the two calls form the only chain
+    issue = local_issue(text)
+    if issue is None:
+        start = time.perf_counter()
+        issue = (await _achat(semaphore, issue_messages(text))).strip()
+        record_classification(redis_conn, 'llm', time.perf_counter() - start)
+    if issue not in SUB_ISSUES:
+        return issue, DEFAULT_SUB_ISSUE
+    sub_issue = local_sub_issue(text, issue)
+    if sub_issue is None:
+        start = time.perf_counter()
+        sub_issue = (await _achat(semaphore, sub_issue_messages(text, issue))).strip()
+        record_classification(redis_conn, 'llm', time.perf_counter() - start)
+    return issue, sub_issue
+
+async def _json_call(semaphore: asyncio.Semaphore, messages: List[Dict[str, str]]) -> Any:
+    return json.loads(await _achat(semaphore, messages))
+
+async def _entities(semaphore: asyncio.Semaphore, text: str) -> Dict[str, list]:
+    if ENTITY_EXTRACTION_MODE != 'llm':
+        entities = extract_entities_local(text)
+        if ENTITY_EXTRACTION_MODE != 'rules_then_llm' or has_entities(entities):
+            return entities
+    return await _json_call(semaphore, entities_messages(text))
+
+async def analyze_text_async(text: str, concurrency: Optional[int] = None) -> Tuple[Dict[str, Any], str]:
+    semaphore = asyncio.Semaphore(concurrency or TEXT_AGENT_CONCURRENCY)
+
+    categorization, (issue, sub_issue), sentiment, entities, key_phrases = await asyncio.gather(
+        _achat(semaphore, categorize_messages(text)),
+        _classify(semaphore, text),
+        _json_call(semaphore, sentiment_messages(text)),
+        _entities(semaphore, text),
+        _json_call(semaphore, key_phrases_messages(text)),
+    )
+    category, summary = parse_categorization(categorization)
+
+    structured_output = build_structured_output(text, issue, sub_issue, summary, entities, sentiment, key_phrases)
+    return structured_output, category
+
+def analyze_text_concurrent(text: str, concurrency: Optional[int] = None) -> Tuple[Dict[str, Any], str]:
+    # Synchronous entry point so RQ jobs can keep calling a plain function
+    return asyncio.run(analyze_text_async(text, concurrency))
@@ -0,0 +1,147 @@
+# blob_store.py
+#
+# Content-addressed store for uploaded media on a disk shared by the aggregator
+# and the workers. Uploads are streamed to disk in chunks while being hashed, and
+# jobs only carry a {'blob': <sha256>, 'size': <bytes>} reference. Agents read
+# blobs through a memory map instead of holding a copy of the media.
+#
+#   python -m agents.blob_store prune --older-than-hours 72
+import os
+import mmap
+import time
+import uuid
+import hashlib
+import logging
+import argparse
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR', 'data/blobs')
+BLOB_STORE_MAX_BYTES = int(os.environ.get('BLOB_STORE_MAX_BYTES', 2 * 1024 ** 3))
+BLOB_CHUNK_BYTES = 1024 * 1024
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+def is_blob_ref(content: Any) -> bool:
+    return isinstance(content, dict) and 'blob' in content
+
+
+class Media:
+    # A complaint's media: `view` is a buffer over its bytes, `path` is set when it is a file on disk
+    def __init__(self, view: memoryview, path: Optional[str] = None, digest: Optional[str] = None):
+        self.view = view
+        self.path = path
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.view)
+
+
+class BlobStore:
+    def __init__(self, root: str = BLOB_STORE_DIR, max_bytes: int = BLOB_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+            raise ValueError(f"Invalid blob digest: {digest}")
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def write_stream(self, stream: BinaryIO, chunk_size: int = BLOB_CHUNK_BYTES) -> Dict[str, Any]:
+        # Hashes while writing to a private temporary file, then moves it into place.
+        # Identical uploads end up as a single file.
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise BlobTooLarge(f"Upload is larger than {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+            path = self.path(digest.hexdigest())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return {'blob': digest.hexdigest(), 'size': size}
+
+    @contextmanager
+    def open(self, digest: str) -> Iterator[Media]:
+        path = self.path(digest)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield Media(memoryview(b''), path, digest)
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            media = Media(memoryview(mapped), path, digest)
+            try:
+                yield media
+            finally:
+                try:
+                    media.view.release()
+                    mapped.close()
+                except BufferError:
+                    # A caller still holds a view, the map is released with it
+                    pass
+
+    def iter_chunks(self, digest: str, chunk_size: int = BLOB_CHUNK_BYTES) -> Iterator[bytes]:
+        with open(self.path(digest), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def prune(self, older_than_seconds: float) -> int:
+        # Blobs are only needed until their job has run
+        cutoff = time.time() - older_than_seconds
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+
+blob_store = BlobStore()
+
+@contextmanager
+def open_media(content: Any) -> Iterator[Media]:
+    # Agents accept either inline bytes or a blob reference
+    if is_blob_ref(content):
+        with blob_store.open(content['blob']) as media:
+            yield media
+    else:
+        yield Media(memoryview(content))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the media blob store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    prune_parser = subparsers.add_parser('prune', help='Remove blobs older than the given age')
+    prune_parser.add_argument('--older-than-hours', type=float, default=72)
+    args = parser.parse_args()
+
+    removed = blob_store.prune(args.older_than_hours * 3600)
+    print(f"Removed {removed} blobs from {blob_store.root}")
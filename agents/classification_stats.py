@@ -0,0 +1,67 @@
+# classification_stats.py
+#
+# Redis counters of issue/sub-issue classifications by source (local or LLM).
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from typing import Dict
+from redis import Redis, RedisError
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'local-classifier:stats'
+# Counters are buffered in the process and written at most this often, plus once per job
+CLASSIFICATION_STATS_FLUSH_SECONDS = float(os.environ.get('CLASSIFICATION_STATS_FLUSH_SECONDS', 5))
+
+_pending = Counter()
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+def record_classification(redis_conn: Redis, source: str, seconds: float):
+    # source is 'local' or 'llm'; the report compares the average time of both. No round trip
+    # per prediction, a local answer stays in the microseconds.
+    with _pending_lock:
+        _pending[f"{source}_count"] += 1
+        _pending[f"{source}_seconds"] += seconds
+        due = time.monotonic() - _last_flush >= CLASSIFICATION_STATS_FLUSH_SECONDS
+    if due:
+        flush_classification_stats(redis_conn)
+
+def flush_classification_stats(redis_conn: Redis):
+    # Called by the text agent at the end of each job, since a forked work horse exits without atexit
+    global _last_flush
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for field, value in pending.items():
+            if field.endswith('_count'):
+                pipe.hincrby(STATS_KEY, field, value)
+            else:
+                pipe.hincrbyfloat(STATS_KEY, field, value)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not record classification stats: {str(e)}")
+
+def classification_report(redis_conn: Redis) -> Dict[str, float]:
+    stats = {field.decode(): float(value) for field, value in redis_conn.hgetall(STATS_KEY).items()}
+    local_count = stats.get('local_count', 0.0)
+    llm_count = stats.get('llm_count', 0.0)
+    local_seconds = stats.get('local_seconds', 0.0)
+    llm_seconds = stats.get('llm_seconds', 0.0)
+    total = local_count + llm_count
+    mean_llm = llm_seconds / llm_count if llm_count else 0.0
+    return {
+        'local_count': local_count,
+        'llm_count': llm_count,
+        'local_fraction': local_count / total if total else 0.0,
+        'mean_local_seconds': local_seconds / local_count if local_count else 0.0,
+        'mean_llm_seconds': mean_llm,
+        'seconds_saved': max(0.0, local_count * mean_llm - local_seconds),
+    }
@@ -0,0 +1,45 @@
+# complaint_options.py
+#
+# Per-request options of the agents that take them, checked by the aggregator
+# before a job is enqueued. Kept apart from the agents so the API can validate
+# options without importing OpenCV or the Google Cloud clients.
+import os
+from typing import Any, Dict, Optional, Tuple
+
+STAGES = ('downscale', 'denoise', 'contrast')
+# Stages enabled unless a request turns them off, comma-separated
+IMAGE_PREPROCESS_STAGES = tuple(stage.strip() for stage in
+                                os.environ.get('IMAGE_PREPROCESS_STAGES', ','.join(STAGES)).split(',')
+                                if stage.strip())
+
+VIDEO_ANALYSIS_MODES = ('keyframes', 'full')
+
+# Option names each modality accepts, agents not listed take none
+OPTIONS = {
+    'image': ('preprocess',),
+    'video': ('video_analysis',),
+}
+
+def resolve_stages(overrides: Optional[Dict[str, bool]] = None) -> Tuple[str, ...]:
+    # {'denoise': False} turns a stage off for one request, unknown stages are an error
+    if not isinstance(overrides or {}, dict):
+        raise ValueError("preprocess must be an object")
+    enabled = {stage: stage in IMAGE_PREPROCESS_STAGES for stage in STAGES}
+    for stage, on in (overrides or {}).items():
+        if stage not in enabled:
+            raise ValueError(f"Unknown preprocessing stage: {stage}")
+        enabled[stage] = bool(on)
+    return tuple(stage for stage in STAGES if enabled[stage])
+
+def validate_options(complaint_type: str, options: Any) -> None:
+    # Raises ValueError with a message for the client
+    if not isinstance(options, dict):
+        raise ValueError("options must be an object")
+    allowed = OPTIONS.get(complaint_type, ())
+    for name in options:
+        if name not in allowed:
+            raise ValueError(f"{complaint_type} complaints take no option '{name}'")
+    if 'preprocess' in options:
+        resolve_stages(options['preprocess'])
+    if 'video_analysis' in options and options['video_analysis'] not in VIDEO_ANALYSIS_MODES:
+        raise ValueError(f"video_analysis must be one of {', '.join(VIDEO_ANALYSIS_MODES)}")
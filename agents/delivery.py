@@ -0,0 +1,66 @@
+# delivery.py
+#
+# How agents hand their analysis back. In the default 'direct' mode the
+# structured output is returned to process_complaint in the same job, which
+# persists it once. 'http' posts it to the aggregator's /aggregate endpoint,
+# for agents running outside the worker pools; the aggregator then only stores
+# it. Per-modality counters of complaints, HTTP hops, enqueued jobs and
+# processing time are kept in Redis to compare the two.
+import os
+import logging
+from typing import Any, Dict
+from redis import Redis, RedisError
+from agents.resources import resources
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AGENT_DELIVERY = os.environ.get('AGENT_DELIVERY', 'direct')
+AGGREGATOR_URL = os.environ.get('AGGREGATOR_URL', 'http://localhost:5000/aggregate')
+
+PIPELINE_STATS_KEY = 'pipeline:stats'
+
+def record_pipeline(redis_conn: Redis, modality: str, **counters: float):
+    # e.g. record_pipeline(conn, 'text', complaints=1, seconds=0.8)
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for name, value in counters.items():
+            if isinstance(value, int):
+                pipe.hincrby(PIPELINE_STATS_KEY, f"{modality}:{name}", value)
+            else:
+                pipe.hincrbyfloat(PIPELINE_STATS_KEY, f"{modality}:{name}", value)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not record pipeline stats: {str(e)}")
+
+def pipeline_report(redis_conn: Redis) -> Dict[str, Dict[str, float]]:
+    # Per modality totals and per complaint averages of hops, jobs and seconds
+    report = {}
+    for field, value in redis_conn.hgetall(PIPELINE_STATS_KEY).items():
+        modality, name = field.decode().split(':', 1)
+        report.setdefault(modality, {})[name] = float(value)
+    for stats in report.values():
+        complaints = stats.get('complaints', 0.0)
+        for name in ('http_hops', 'jobs', 'seconds'):
+            stats[f"{name}_per_complaint"] = stats.get(name, 0.0) / complaints if complaints else 0.0
+    return report
+
+def deliver(modality: str, content: Dict[str, Any], category: str) -> Dict[str, Any]:
+    # What process_<modality>_complaint returns to process_complaint
+    if AGENT_DELIVERY != 'http':
+        return {'type': modality, 'content': content, 'category': category}
+
+    # Send to aggregator, which stores the analysis in a job of its own
+    response = resources.http.post(AGGREGATOR_URL, json={
+        'type': modality,
+        'content': content,
+        'category': category
+    })
+    record_pipeline(resources.redis, modality, http_hops=1)
+
+    if response.status_code == 202:
+        logger.info(f"{modality.capitalize()} complaint sent to aggregator. Job ID: {response.json()['job_id']}")
+    else:
+        logger.error(f"Failed to send {modality} complaint to aggregator. Status code: {response.status_code}")
+    return dict(response.json(), delivered='http', category=category)
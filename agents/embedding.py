@@ -0,0 +1,196 @@
+# embedding.py
+#
+# Sentence embeddings of complaints for similarity search. The default embedder
+# runs a small sentence-transformers model (MiniLM, 384 dimensions) on the CPU
+# with torch; 'hashing' is a model-free lexical fallback, and any other embedder
+# can be plugged in as 'package.module:factory'. Vectors are L2-normalized, so
+# the dot product of two of them is their cosine similarity.
+#
+#   python -m agents.embedding "I was charged twice for the same purchase"
+import os
+import sys
+import time
+import zlib
+import base64
+import logging
+import importlib
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+from agents.resources import resources
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 'minilm', 'hashing', 'none' or 'package.module:factory'
+EMBEDDER = os.environ.get('EMBEDDER', 'minilm')
+# Hugging Face model name or a local directory holding it
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_MAX_TOKENS = int(os.environ.get('EMBEDDING_MAX_TOKENS', 256))
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+# torch intra-op threads, 0 keeps torch's default
+EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS', 0))
+EMBEDDING_HASHING_DIM = int(os.environ.get('EMBEDDING_HASHING_DIM', 512))
+EMBEDDING_MAX_CHARS = int(os.environ.get('EMBEDDING_MAX_CHARS', 4000))
+# Only load EMBEDDING_MODEL from a local directory, never from the Hub (the image bakes the model in)
+EMBEDDING_LOCAL_ONLY = os.environ.get('EMBEDDING_LOCAL_ONLY', 'false').lower() in ('1', 'true', 'yes')
+# A failed load is not retried before this, so an offline worker does not try again on every job
+EMBEDDING_RETRY_SECONDS = float(os.environ.get('EMBEDDING_RETRY_SECONDS', 300))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class TransformerEmbedder:
+    # Mean of the last hidden states over the real tokens, as sentence-transformers pools MiniLM
+    def __init__(self, model_name: str = EMBEDDING_MODEL, max_tokens: int = EMBEDDING_MAX_TOKENS):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        if EMBEDDING_LOCAL_ONLY and not os.path.isdir(model_name):
+            raise ValueError(f"EMBEDDING_MODEL must be a local directory with EMBEDDING_LOCAL_ONLY, got '{model_name}'")
+        if EMBEDDING_THREADS:
+            torch.set_num_threads(EMBEDDING_THREADS)
+        start = time.perf_counter()
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=EMBEDDING_LOCAL_ONLY)
+        self.model = AutoModel.from_pretrained(model_name, local_files_only=EMBEDDING_LOCAL_ONLY).eval()
+        self.max_tokens = max_tokens
+        self.name = model_name
+        self.dim = self.model.config.hidden_size
+        logger.info(f"Loaded embedding model {model_name} in {time.perf_counter() - start:.1f}s")
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        batches = []
+        with self.torch.no_grad():
+            for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+                encoded = self.tokenizer(list(texts[start:start + EMBEDDING_BATCH_SIZE]), padding=True,
+                                         truncation=True, max_length=self.max_tokens, return_tensors='pt')
+                hidden = self.model(**encoded)[0]
+                mask = encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                batches.append(pooled.numpy())
+        return _normalize(np.concatenate(batches)) if batches else np.empty((0, self.dim), dtype=np.float32)
+
+
+class HashingEmbedder:
+    # Signed feature hashing of words, word bigrams and character trigrams. No model to download,
+    # but it only finds complaints that share wording, not paraphrases.
+    def __init__(self, dim: int = EMBEDDING_HASHING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text: str) -> List[str]:
+        words = ''.join(c if c.isalnum() else ' ' for c in text.lower()).split()
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                hashed = zlib.crc32(feature.encode())
+                vectors[row, hashed % self.dim] += 1.0 if hashed & 0x80000000 else -1.0
+        # Sublinear term frequency, so one repeated word does not dominate
+        return _normalize(np.sign(vectors) * np.log1p(np.abs(vectors)))
+
+
+EMBEDDERS = {
+    'minilm': TransformerEmbedder,
+    'hashing': HashingEmbedder,
+}
+
+def load_embedder(name: str = EMBEDDER):
+    # Plugins are factories returning an object with `name`, `dim` and `embed(texts) -> (n, dim) float32`
+    if name in EMBEDDERS:
+        return EMBEDDERS[name]()
+    module, _, factory = name.partition(':')
+    if not factory:
+        raise ValueError(f"Unknown embedder '{name}', expected one of {', '.join(EMBEDDERS)} or module:factory")
+    return getattr(importlib.import_module(module), factory)()
+
+_load_failure = None
+
+def get_embedder():
+    # One model per process, loaded on first use. resources.client does not keep failures, they are
+    # remembered here for EMBEDDING_RETRY_SECONDS.
+    global _load_failure
+    if _load_failure is not None and time.monotonic() - _load_failure[0] < EMBEDDING_RETRY_SECONDS:
+        raise RuntimeError(f"Embedder unavailable, retrying in at most {EMBEDDING_RETRY_SECONDS:.0f}s: "
+                           f"{_load_failure[1]}")
+    try:
+        embedder = resources.client('embedder', load_embedder)
+    except Exception as e:
+        _load_failure = (time.monotonic(), str(e))
+        raise
+    _load_failure = None
+    return embedder
+
+def embedding_enabled() -> bool:
+    return EMBEDDER != 'none'
+
+def embed_texts(texts: Sequence[str]) -> np.ndarray:
+    return get_embedder().embed([text[:EMBEDDING_MAX_CHARS] for text in texts])
+
+
+def embedding_text(content: Any) -> Optional[str]:
+    # What a complaint says, by the keys each agent produces: the complaint text or transcript
+    # first, then the summary, OCR text and image labels
+    if isinstance(content, str):
+        return content.strip() or None
+    if not isinstance(content, dict):
+        return None
+    parts = [content.get(field) for field in ('original_text', 'transcript', 'summary', 'text')]
+    parts += [item.get('text') for item in content.get('texts') or [] if isinstance(item, dict)]
+    labels = [item.get('description') or item.get('name')
+              for item in (content.get('labels') or []) + (content.get('objects') or []) if isinstance(item, dict)]
+    parts.append(', '.join(label for label in labels if isinstance(label, str)))
+    text = '\n'.join(part.strip() for part in parts if isinstance(part, str) and part.strip())
+    return text or None
+
+def encode_vector(vector: np.ndarray) -> str:
+    # Records are staged as JSON, the float32 bytes travel as base64
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+
+def decode_vector(encoded: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32)
+
+def embed_records(records: List[Dict[str, Any]]) -> int:
+    # Adds an 'embedding' to every record with text. A failure is logged and leaves the records
+    # without one: the complaint is still stored and can be embedded again when the index is rebuilt.
+    if not embedding_enabled():
+        return 0
+    texts = [(record, embedding_text(record.get('content'))) for record in records]
+    texts = [(record, text) for record, text in texts if text]
+    if not texts:
+        return 0
+    try:
+        embedder_name = get_embedder().name
+        vectors = embed_texts([text for _, text in texts])
+    except Exception as e:
+        logger.warning(f"Could not embed {len(texts)} complaints: {str(e)}")
+        return 0
+    for (record, _), vector in zip(texts, vectors):
+        # The index only mixes vectors of one embedder
+        record['embedding'] = encode_vector(vector)
+        record['embedding_model'] = embedder_name
+    return len(texts)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python -m agents.embedding <text> [<text> ...]")
+        sys.exit(1)
+    embedder = get_embedder()
+    start = time.perf_counter()
+    vectors = embed_texts(sys.argv[1:])
+    print(f"{embedder.name}: {len(vectors)} x {embedder.dim} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    if len(vectors) > 1:
+        similarities = vectors @ vectors.T
+        for i, text in enumerate(sys.argv[1:]):
+            print(f"{text[:40]:<40} " + ' '.join(f"{similarity:.2f}" for similarity in similarities[i]))
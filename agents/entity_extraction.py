@@ -0,0 +1,56 @@
+# entity_extraction.py
+#
+# In-process extraction of monetary amounts, dates, card last-4 digits and
+# account references. All patterns are compiled into one alternation so each
+# text is scanned once.
+import re
+from typing import Dict, Iterable, List
+
+_MONTHS = (r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|"
+           r"sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?")
+_DAY = r"(?:0?[1-9]|[12]\d|3[01])(?:st|nd|rd|th)?"
+_NUMBER = r"\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?"
+
+_PATTERNS = [
+    ('card_last4', r"\b(?:card|account|acct)\s+(?:number\s+)?ending\s+(?:in\s+|with\s+)?(?P<card_digits>\d{4})\b"
+                   r"|\blast\s+(?:4|four)(?:\s+digits)?(?:\s+(?:of|on)\s+(?:my\s+)?(?:card|account))?\s*(?:is|are|:)?\s*(?P<card_digits2>\d{4})\b"
+                   r"|(?<![\w*])(?:[x*]{4}[\s-]?){3}(?P<card_digits3>\d{4})\b|(?<![\w*])[x*]{4,12}(?P<card_digits4>\d{4})\b"),
+    ('account_references', r"\b(?:account|acct)\.?\s*(?:number|no\.?|num\.?|#)\s*[:#]?\s*(?P<account>[a-z]{0,3}\d[\d-]{3,19}\d)\b"),
+    ('monetary_amounts', rf"(?:\$|\busd\s?)\s?(?:{_NUMBER})(?:\s?(?:k|m|million|thousand)\b)?"
+                         rf"|\b(?:{_NUMBER})\s?(?:dollars|usd)\b"),
+    ('dates', rf"\b(?:\d{{4}}-(?:0?[1-9]|1[0-2])-(?:0?[1-9]|[12]\d|3[01])"
+              rf"|(?:0?[1-9]|1[0-2])[/-](?:0?[1-9]|[12]\d|3[01])[/-](?:\d{{4}}|\d{{2}})"
+              rf"|{_DAY}\s+(?:of\s+)?{_MONTHS},?\s+\d{{4}}"
+              rf"|{_MONTHS}\s+(?:{_DAY},?\s+\d{{4}}|{_DAY}\b|\d{{4}}))\b"),
+]
+
+# Output order matches the LLM extraction: amounts and dates first
+ENTITY_TYPES = ['monetary_amounts', 'dates', 'card_last4', 'account_references']
+
+_ENTITY_PATTERN = re.compile('|'.join(f"(?P<{name}>{pattern})" for name, pattern in _PATTERNS), re.IGNORECASE)
+_CARD_GROUPS = ('card_digits', 'card_digits2', 'card_digits3', 'card_digits4')
+
+def empty_entities() -> Dict[str, List[str]]:
+    return {name: [] for name in ENTITY_TYPES}
+
+def extract_entities_local(text: str) -> Dict[str, List[str]]:
+    entities = empty_entities()
+    seen = set()
+    for match in _ENTITY_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'card_last4':
+            value = next(match.group(group) for group in _CARD_GROUPS if match.group(group))
+        elif kind == 'account_references':
+            value = match.group('account')
+        else:
+            value = match.group(kind).strip()
+        if (kind, value) not in seen:
+            seen.add((kind, value))
+            entities[kind].append(value)
+    return entities
+
+def extract_entities_batch(texts: Iterable[str]) -> List[Dict[str, List[str]]]:
+    return [extract_entities_local(text) for text in texts]
+
+def has_entities(entities: Dict[str, List[str]]) -> bool:
+    return any(entities.values())
@@ -1,78 +1,93 @@
 # image_agent.py
 import os
-import requests
-import io
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import vision
 from google.cloud import language_v1
-import cv2
-import numpy as np
-from PIL import Image
+from google.api_core.exceptions import GoogleAPICallError
 import logging
+from agents.resources import resources
+from agents.blob_store import open_media
+from agents.complaint_options import IMAGE_PREPROCESS_STAGES, resolve_stages
+from agents.image_preprocessing import preprocess_image
+from agents.result_cache import result_cache
+from agents.delivery import deliver
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Google Cloud clients
-vision_client = vision.ImageAnnotatorClient()
-language_client = language_v1.LanguageServiceClient()
-
-AGGREGATOR_URL = os.environ.get('AGGREGATOR_URL', 'http://localhost:5000/aggregate')
-
-def enhance_image(image_content):
-    # Convert bytes to numpy array
-    nparr = np.frombuffer(image_content, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # Denoise
-    denoised = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
-
-    # Enhance contrast
-    lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
-    l, a, b = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-    cl = clahe.apply(l)
-    enhanced_lab = cv2.merge((cl,a,b))
-    enhanced = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
-
-    # Convert back to bytes
-    is_success, buffer = cv2.imencode(".jpg", enhanced)
-    return buffer.tobytes()
-
-def process_image_complaint(image_content):
-    logger.info("Processing image complaint...")
-
-    # Enhance image
-    enhanced_image = enhance_image(image_content)
-
-    # Perform image analysis
-    image = vision.Image(content=enhanced_image)
-    
-    # Detect text
-    text_detection_response = vision_client.text_detection(image=image)
-    texts = text_detection_response.text_annotations
-    
-    # Detect labels
-    label_detection_response = vision_client.label_detection(image=image)
-    labels = label_detection_response.label_annotations
-    
-    # Detect objects
-    object_detection_response = vision_client.object_localization(image=image)
-    objects = object_detection_response.localized_object_annotations
-    
-    # Perform sentiment analysis on detected text
-    if texts:
-        document = language_v1.Document(content=texts[0].description, type_=language_v1.Document.Type.PLAIN_TEXT)
-        sentiment = language_client.analyze_sentiment(request={'document': document}).document_sentiment
-    else:
-        sentiment = None
+# host:port of a plaintext gRPC fake (benchmarks/stub_vision_server.py) instead of the Google APIs
+VISION_API_ENDPOINT = os.environ.get('VISION_API_ENDPOINT')
+LANGUAGE_API_ENDPOINT = os.environ.get('LANGUAGE_API_ENDPOINT')
+# Images per batch annotate request in batch mode, the API accepts up to 16
+VISION_BATCH_SIZE = int(os.environ.get('VISION_BATCH_SIZE', 16))
+IMAGE_SENTIMENT_CONCURRENCY = int(os.environ.get('IMAGE_SENTIMENT_CONCURRENCY', 8))
+
+def _google_client(client_class, endpoint):
+    if not endpoint:
+        return client_class()
+    import grpc
+    transport_class = client_class.get_transport_class('grpc')
+    return client_class(transport=transport_class(channel=grpc.insecure_channel(endpoint)))
+
+# Google Cloud clients are created on first use and shared through resources
+def vision_client():
+    return resources.client('vision', lambda: _google_client(vision.ImageAnnotatorClient, VISION_API_ENDPOINT))
+
+def language_client():
+    return resources.client('language', lambda: _google_client(language_v1.LanguageServiceClient, LANGUAGE_API_ENDPOINT))
+
+def sentiment_executor():
+    # Threads do not survive a fork, so the pool is rebuilt per process like the clients
+    return resources.client('image_sentiment_executor',
+                            lambda: ThreadPoolExecutor(max_workers=IMAGE_SENTIMENT_CONCURRENCY))
+
+
+# Part of the result cache key, bump when preprocessing or the output shape change
+ANALYSIS_VERSION = 'vision:v2'
+
+# Everything the analysis uses, requested together so the image is uploaded once
+FEATURES = [
+    vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION),
+    vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION),
+    vision.Feature(type_=vision.Feature.Type.OBJECT_LOCALIZATION),
+]
+
+def enhance_image(image_content, stages=IMAGE_PREPROCESS_STAGES):
+    # Downscale, denoise only when needed and enhance contrast, see image_preprocessing
+    return preprocess_image(image_content, stages)
+
+def prepare_image(image_content, stages=IMAGE_PREPROCESS_STAGES):
+    # Enhance image, decoding straight from the memory-mapped upload
+    with open_media(image_content) as media:
+        enhanced_image, preprocessing = enhance_image(media.view, stages)
+    return vision.AnnotateImageRequest(image=vision.Image(content=enhanced_image), features=FEATURES), preprocessing
+
+def text_sentiment(text):
+    document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
+    return language_client().analyze_sentiment(request={'document': document}).document_sentiment
+
+def start_sentiment(response):
+    # Perform sentiment analysis on detected text, started as soon as the annotations arrive
+    if response.error.message:
+        raise RuntimeError(f"Vision annotation failed: {response.error.message}")
+    texts = response.text_annotations
+    return sentiment_executor().submit(text_sentiment, texts[0].description) if texts else None
+
+def build_result(response, sentiment_future, preprocessing):
+    texts = response.text_annotations
+    labels = response.label_annotations
+    objects = response.localized_object_annotations
+    sentiment = sentiment_future.result() if sentiment_future is not None else None
 
     # Prepare content for aggregator
     content = {
         'text': texts[0].description if texts else '',
         'labels': [{'description': label.description, 'score': label.score} for label in labels],
         'objects': [{'name': obj.name, 'score': obj.score} for obj in objects],
-        'sentiment': {'score': sentiment.score, 'magnitude': sentiment.magnitude} if sentiment else None
+        'sentiment': {'score': sentiment.score, 'magnitude': sentiment.magnitude} if sentiment else None,
+        # Timings differ from run to run and would be served stale from the cache
+        'preprocessing': {key: value for key, value in preprocessing.items() if key != 'timings_ms'}
     }
 
     # Determine category based on detected objects and labels
@@ -85,19 +100,80 @@ def process_image_complaint(image_content):
     elif 'error' in categories or 'warning' in categories:
         category = 'Error or Warning Complaint'
 
-    # Send to aggregator
-    response = requests.post(AGGREGATOR_URL, json={
-        'type': 'image',
-        'content': content,
-        'category': category
-    })
+    return content, category
+
+def analyze_image_complaint(image_content, stages=IMAGE_PREPROCESS_STAGES):
+    request, preprocessing = prepare_image(image_content, stages)
+
+    # One request for text, labels and objects
+    response = vision_client().batch_annotate_images(requests=[request]).responses[0]
+    return build_result(response, start_sentiment(response), preprocessing)
+
+def analyze_image_complaints(image_contents, stages=IMAGE_PREPROCESS_STAGES):
+    # Batch mode for backfills: up to VISION_BATCH_SIZE images per annotate request, with the
+    # sentiment calls of one batch running while the next batch is prepared and annotated.
+    # Same result cache as process_image_complaint; images that fail are None.
+    version = f"{ANALYSIS_VERSION}:{'+'.join(stages)}"
+    analyses = [None] * len(image_contents)
+    misses = []
+    for index, image_content in enumerate(image_contents):
+        cached = result_cache.get('image', image_content, version)
+        if cached is not None:
+            analyses[index] = (cached['content'], cached['category'])
+        else:
+            misses.append(index)
+
+    pending = []
+    with ThreadPoolExecutor(max_workers=min(VISION_BATCH_SIZE, os.cpu_count() or 1)) as preprocess:
+        for offset in range(0, len(misses), VISION_BATCH_SIZE):
+            batch = misses[offset:offset + VISION_BATCH_SIZE]
+            prepared = {}
+            # OpenCV releases the GIL, the images of a batch are preprocessed in parallel
+            for index, future in [(index, preprocess.submit(prepare_image, image_contents[index], stages))
+                                  for index in batch]:
+                try:
+                    prepared[index] = future.result()
+                except Exception as e:
+                    logger.error(f"Could not preprocess image {index}: {str(e)}")
+            if not prepared:
+                continue
+            indexes = list(prepared)
+            try:
+                responses = vision_client().batch_annotate_images(
+                    requests=[prepared[index][0] for index in indexes]).responses
+            except GoogleAPICallError as e:
+                # Only this batch is lost, its images stay None
+                logger.error(f"Vision request for images {indexes} failed: {str(e)}")
+                continue
+            for index, response in zip(indexes, responses):
+                try:
+                    pending.append((index, response, start_sentiment(response), prepared[index][1]))
+                except RuntimeError as e:
+                    logger.error(f"Image {index}: {str(e)}")
+
+    for index, response, sentiment_future, preprocessing in pending:
+        try:
+            analyses[index] = build_result(response, sentiment_future, preprocessing)
+        except Exception as e:
+            logger.error(f"Sentiment analysis of image {index} failed: {str(e)}")
+            continue
+        content, category = analyses[index]
+        result_cache.set('image', image_contents[index], version, {'content': content, 'category': category})
+    logger.info(f"Analyzed {len(misses)} images in {-(-len(misses) // VISION_BATCH_SIZE)} batch requests, "
+                f"{len(image_contents) - len(misses)} from the cache")
+    return analyses
+
+def process_image_complaint(image_content, options=None):
+    logger.info("Processing image complaint...")
 
-    if response.status_code == 202:
-        logger.info(f"Image complaint processed and sent to aggregator. Task ID: {response.json()['task_id']}")
-    else:
-        logger.error(f"Failed to send image complaint to aggregator. Status code: {response.status_code}")
+    # options={'preprocess': {'denoise': False}} turns preprocessing stages off for this complaint
+    stages = resolve_stages((options or {}).get('preprocess'))
+    content, category = result_cache.cached_analysis(
+        'image', image_content, f"{ANALYSIS_VERSION}:{'+'.join(stages)}",
+        lambda: analyze_image_complaint(image_content, stages))
 
-    return response.json()
+    # Back to process_complaint in the same job, or to the aggregator for remote agents
+    return deliver('image', content, category)
 
 if __name__ == '__main__':
     # For testing, you would need to provide an image file
@@ -0,0 +1,122 @@
+# image_preprocessing.py
+#
+# Tiered preprocessing for image complaints. Photos are decoded at a reduced
+# scale when the codec supports it and downscaled to what OCR and labeling need,
+# noise is measured on the small image and only noisy images are denoised, with
+# a cheap edge-preserving filter unless the noise is heavy. Each stage can be
+# turned off per request, and the time spent in every stage is reported.
+import os
+import io
+import time
+import logging
+from typing import Any, Dict, Tuple
+import cv2
+import numpy as np
+from PIL import Image
+# Default stages, shared with the aggregator's option checks
+from agents.complaint_options import IMAGE_PREPROCESS_STAGES
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Longest side after downscaling. Vision reads receipt text reliably well below 12 MP.
+IMAGE_TARGET_MAX_SIDE = int(os.environ.get('IMAGE_TARGET_MAX_SIDE', 2048))
+# Estimated noise standard deviation (0-255 scale) under which denoising is skipped,
+# and above which the slower non-local means filter is used
+IMAGE_NOISE_SKIP = float(os.environ.get('IMAGE_NOISE_SKIP', 3.0))
+IMAGE_NOISE_HEAVY = float(os.environ.get('IMAGE_NOISE_HEAVY', 12.0))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 90))
+
+
+# Kernel of Immerkaer's fast noise variance estimation, it cancels out image structure
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+def estimate_noise(gray: np.ndarray) -> float:
+    # Standard deviation of Gaussian noise, one 3x3 convolution over the image
+    height, width = gray.shape
+    if height < 3 or width < 3:
+        return 0.0
+    response = cv2.filter2D(gray.astype(np.float32), -1, _NOISE_KERNEL)[1:-1, 1:-1]
+    return float(np.sqrt(np.pi / 2) * np.abs(response).sum() / (6.0 * (width - 2) * (height - 2)))
+
+def _reduced_decode_flag(data, max_side: int) -> Tuple[int, int]:
+    # JPEG decodes straight to 1/2, 1/4 or 1/8 scale, which skips most of the decoding work.
+    # Only the header is read to find the size.
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            size, fmt = max(header.size), header.format
+    except Exception:
+        return cv2.IMREAD_COLOR, 1
+    if fmt != 'JPEG':
+        return cv2.IMREAD_COLOR, 1
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if size // factor >= max_side:
+            return flag, factor
+    return cv2.IMREAD_COLOR, 1
+
+def preprocess_image(image_content, stages: Tuple[str, ...] = IMAGE_PREPROCESS_STAGES,
+                     max_side: int = IMAGE_TARGET_MAX_SIDE) -> Tuple[bytes, Dict[str, Any]]:
+    # JPEG bytes for the Vision API and a summary of what was done, with per-stage timings in ms
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = round((now - started) * 1000, 2)
+        started = now
+
+    nparr = np.frombuffer(image_content, np.uint8)
+    flag, factor = _reduced_decode_flag(nparr, max_side) if 'downscale' in stages else (cv2.IMREAD_COLOR, 1)
+    img = cv2.imdecode(nparr, flag)
+    if img is None:
+        raise ValueError("Could not decode image")
+    original = (img.shape[1] * factor, img.shape[0] * factor)
+    lap('decode')
+
+    if 'downscale' in stages and max(img.shape[:2]) > max_side:
+        scale = max_side / max(img.shape[:2])
+        img = cv2.resize(img, (round(img.shape[1] * scale), round(img.shape[0] * scale)),
+                         interpolation=cv2.INTER_AREA)
+        lap('downscale')
+
+    noise, denoiser = None, None
+    if 'denoise' in stages:
+        noise = estimate_noise(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+        lap('noise_estimate')
+        if noise >= IMAGE_NOISE_HEAVY:
+            denoiser = 'nl_means'
+            h = min(15.0, noise * 0.8)
+            img = cv2.fastNlMeansDenoisingColored(img, None, h, h, 5, 11)
+        elif noise >= IMAGE_NOISE_SKIP:
+            denoiser = 'bilateral'
+            img = cv2.bilateralFilter(img, 5, noise * 3, 5)
+        lap('denoise')
+
+    if 'contrast' in stages:
+        # CLAHE on lightness only, colors are left alone
+        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+        l, a, b = cv2.split(lab)
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+        img = cv2.cvtColor(cv2.merge((clahe.apply(l), a, b)), cv2.COLOR_LAB2BGR)
+        lap('contrast')
+
+    is_success, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, IMAGE_JPEG_QUALITY])
+    if not is_success:
+        raise ValueError("Could not encode preprocessed image")
+    lap('encode')
+
+    info = {
+        'stages': list(stages),
+        'original_size': list(original),
+        'size': [img.shape[1], img.shape[0]],
+        'noise': round(noise, 2) if noise is not None else None,
+        'denoiser': denoiser,
+        'timings_ms': timings,
+    }
+    logger.info(f"Preprocessed {original[0]}x{original[1]} image to {img.shape[1]}x{img.shape[0]} "
+                f"(noise {info['noise']}, denoiser {denoiser}) in {sum(timings.values()):.0f}ms")
+    return buffer.tobytes(), info
@@ -0,0 +1,251 @@
+# local_classifier.py
+#
+# CPU-only TF-IDF + softmax regression classifier for issue and sub-issue.
+# It is trained offline from the historical rows of the `complaints` table and
+# answers high-confidence complaints locally; everything else still goes to the LLM.
+#
+#   python -m agents.local_classifier train --output models/issue_classifier.npz
+#   python -m agents.local_classifier report
+import os
+import re
+import time
+import logging
+import argparse
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from scipy import sparse
+from agents.resources import resources
+# The counters live apart so the aggregator can read them without numpy/scipy
+from agents.classification_stats import classification_report
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LOCAL_CLASSIFIER_PATH = os.environ.get('LOCAL_CLASSIFIER_PATH', 'models/issue_classifier.npz')
+# Minimum predicted probability for a local answer, below it the LLM is asked
+LOCAL_CLASSIFIER_THRESHOLD = float(os.environ.get('LOCAL_CLASSIFIER_THRESHOLD', 0.85))
+
+_TOKEN = re.compile(r"[a-z0-9$%']+")
+
+def tokenize(text: str) -> List[str]:
+    words = _TOKEN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class LinearTextClassifier:
+    def __init__(self, vocabulary: Sequence[str], idf: np.ndarray, weights: np.ndarray, bias: np.ndarray,
+                 labels: Sequence[str]):
+        self.vocabulary = {term: index for index, term in enumerate(vocabulary)}
+        self.idf = idf.astype(np.float32)
+        self.weights = weights.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.labels = list(labels)
+        self.label_index = {label: index for index, label in enumerate(self.labels)}
+
+    def vectorize(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts = Counter(index for index in map(self.vocabulary.get, tokenize(text)) if index is not None)
+        if not counts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        values = (1.0 + np.log(values)) * self.idf[indices]
+        return indices, values / np.linalg.norm(values)
+
+    def transform(self, texts: Iterable[str]) -> sparse.csr_matrix:
+        rows, cols, data = [], [], []
+        n_rows = 0
+        for row, text in enumerate(texts):
+            indices, values = self.vectorize(text)
+            rows.append(np.full(len(indices), row, dtype=np.int64))
+            cols.append(indices)
+            data.append(values)
+            n_rows = row + 1
+        if not rows:
+            return sparse.csr_matrix((0, len(self.vocabulary)), dtype=np.float32)
+        return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(n_rows, len(self.vocabulary)), dtype=np.float32)
+
+    def predict_proba(self, text: str, allowed: Optional[Sequence[str]] = None) -> np.ndarray:
+        indices, values = self.vectorize(text)
+        # Only the rows of the weight matrix for tokens present in the text are touched
+        logits = values @ self.weights[indices] + self.bias
+        return _softmax(logits, self._mask(allowed))
+
+    def predict_proba_batch(self, texts: Sequence[str], allowed: Optional[Sequence[str]] = None) -> np.ndarray:
+        logits = self.transform(texts) @ self.weights + self.bias
+        return _softmax(logits, self._mask(allowed))
+
+    def predict(self, text: str, allowed: Optional[Sequence[str]] = None) -> Tuple[Optional[str], float]:
+        indices, values = self.vectorize(text)
+        if len(indices) == 0:
+            # No known term: the bias alone would still give a confident label
+            return None, 0.0
+        probabilities = _softmax(values @ self.weights[indices] + self.bias, self._mask(allowed))
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    def _mask(self, allowed: Optional[Sequence[str]]) -> Optional[np.ndarray]:
+        if allowed is None:
+            return None
+        mask = np.zeros(len(self.labels), dtype=bool)
+        mask[[self.label_index[label] for label in allowed if label in self.label_index]] = True
+        return mask
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], labels: Sequence[str], min_df: int = 2, epochs: int = 300,
+            learning_rate: float = 2.0, l2: float = 1e-4) -> 'LinearTextClassifier':
+        document_frequency = Counter(term for text in texts for term in set(tokenize(text)))
+        vocabulary = sorted(term for term, df in document_frequency.items() if df >= min_df)
+        df = np.array([document_frequency[term] for term in vocabulary], dtype=np.float32)
+        idf = np.log((1.0 + len(texts)) / (1.0 + df)) + 1.0
+
+        label_names = sorted(set(labels))
+        y = np.array([label_names.index(label) for label in labels])
+        model = cls(vocabulary, idf, np.zeros((len(vocabulary), len(label_names))), np.zeros(len(label_names)),
+                    label_names)
+        x = model.transform(texts)
+        targets = np.zeros((len(y), len(label_names)), dtype=np.float32)
+        targets[np.arange(len(y)), y] = 1.0
+
+        # Full-batch gradient descent with momentum on the softmax cross-entropy
+        velocity_w = np.zeros_like(model.weights)
+        velocity_b = np.zeros_like(model.bias)
+        for _ in range(epochs):
+            probabilities = _softmax(x @ model.weights + model.bias)
+            error = (probabilities - targets) / len(y)
+            grad_w = x.T @ error + l2 * model.weights
+            grad_b = error.sum(axis=0)
+            velocity_w = 0.9 * velocity_w - learning_rate * grad_w
+            velocity_b = 0.9 * velocity_b - learning_rate * grad_b
+            model.weights += velocity_w
+            model.bias += velocity_b
+        return model
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        return {
+            f"{prefix}_vocabulary": np.array(vocabulary, dtype=str),
+            f"{prefix}_idf": self.idf,
+            f"{prefix}_weights": self.weights,
+            f"{prefix}_bias": self.bias,
+            f"{prefix}_labels": np.array(self.labels, dtype=str),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str) -> 'LinearTextClassifier':
+        return cls(arrays[f"{prefix}_vocabulary"].tolist(), arrays[f"{prefix}_idf"], arrays[f"{prefix}_weights"],
+                   arrays[f"{prefix}_bias"], arrays[f"{prefix}_labels"].tolist())
+
+
+def _softmax(logits: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    if mask is not None:
+        logits = np.where(mask, logits, -np.inf)
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class IssueClassifier:
+    def __init__(self, issue_model: LinearTextClassifier, sub_issue_model: LinearTextClassifier,
+                 threshold: float = LOCAL_CLASSIFIER_THRESHOLD):
+        self.issue_model = issue_model
+        self.sub_issue_model = sub_issue_model
+        self.threshold = threshold
+
+    def predict_issue(self, text: str) -> Optional[str]:
+        issue, confidence = self.issue_model.predict(text)
+        return issue if issue is not None and confidence >= self.threshold else None
+
+    def predict_sub_issue(self, text: str, allowed: Sequence[str]) -> Optional[str]:
+        # Sub-issues are scored only among the ones that belong to the chosen issue
+        if not any(label in self.sub_issue_model.label_index for label in allowed):
+            return None
+        sub_issue, confidence = self.sub_issue_model.predict(text, allowed)
+        return sub_issue if sub_issue is not None and confidence >= self.threshold else None
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez_compressed(path, **self.issue_model.to_arrays('issue'), **self.sub_issue_model.to_arrays('sub_issue'))
+
+    @classmethod
+    def load(cls, path: str, threshold: float = LOCAL_CLASSIFIER_THRESHOLD) -> 'IssueClassifier':
+        with np.load(path) as arrays:
+            return cls(LinearTextClassifier.from_arrays(arrays, 'issue'),
+                       LinearTextClassifier.from_arrays(arrays, 'sub_issue'), threshold)
+
+
+def load_issue_classifier(path: str = LOCAL_CLASSIFIER_PATH) -> Optional[IssueClassifier]:
+    if not os.path.exists(path):
+        logger.info(f"No local issue classifier at {path}, every complaint goes to the LLM")
+        return None
+    start = time.perf_counter()
+    classifier = IssueClassifier.load(path)
+    logger.info(f"Loaded local issue classifier from {path} in {time.perf_counter() - start:.3f}s")
+    return classifier
+
+
+def fetch_training_rows() -> List[Tuple[str, str, str]]:
+    import psycopg2
+
+    conn = psycopg2.connect(
+        dbname=os.getenv('POSTGRES_DB', 'complaints'),
+        user=os.getenv('POSTGRES_USER', 'postgres'),
+        password=os.getenv('POSTGRES_PASSWORD', 'postgres'),
+        host=os.getenv('POSTGRES_HOST', 'localhost'),
+        port=os.getenv('POSTGRES_PORT', '5433')
+    )
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT content->>'original_text', content->>'issue', content->>'sub_issue'
+            FROM complaints
+            WHERE type = 'text' AND content->>'original_text' IS NOT NULL AND content->>'issue' IS NOT NULL
+        """)
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    return rows
+
+def train(rows: Sequence[Tuple[str, str, str]], min_df: int = 2) -> IssueClassifier:
+    from agents.text_agent import ISSUES, SUB_ISSUES
+
+    # Free-text LLM answers that are not one of the known labels are dropped
+    issue_rows = [(text, issue) for text, issue, _ in rows if issue in ISSUES]
+    sub_issue_rows = [(text, sub_issue) for text, issue, sub_issue in rows
+                      if sub_issue in SUB_ISSUES.get(issue, [])]
+    if not issue_rows or not sub_issue_rows:
+        raise ValueError("Not enough labelled complaints to train the local classifier")
+
+    logger.info(f"Training issue model on {len(issue_rows)} complaints")
+    issue_model = LinearTextClassifier.fit([t for t, _ in issue_rows], [l for _, l in issue_rows], min_df=min_df)
+    logger.info(f"Training sub-issue model on {len(sub_issue_rows)} complaints")
+    sub_issue_model = LinearTextClassifier.fit([t for t, _ in sub_issue_rows], [l for _, l in sub_issue_rows],
+                                               min_df=min_df)
+    return IssueClassifier(issue_model, sub_issue_model)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local issue/sub-issue classifier')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train_parser = subparsers.add_parser('train', help='Train from the complaints table')
+    train_parser.add_argument('--output', default=LOCAL_CLASSIFIER_PATH)
+    train_parser.add_argument('--min-df', type=int, default=2)
+    subparsers.add_parser('report', help='Show how many complaints were classified locally')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        classifier = train(fetch_training_rows(), min_df=args.min_df)
+        classifier.save(args.output)
+        print(f"Saved local issue classifier to {args.output}")
+    else:
+        report = classification_report(resources.redis)
+        print(f"Served locally: {report['local_fraction']:.1%} "
+              f"({int(report['local_count'])} local, {int(report['llm_count'])} LLM)")
+        print(f"Mean latency: local {report['mean_local_seconds'] * 1e6:.0f}us, "
+              f"LLM {report['mean_llm_seconds'] * 1e3:.0f}ms")
+        print(f"Latency saved: {report['seconds_saved']:.1f}s")
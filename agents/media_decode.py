@@ -0,0 +1,81 @@
+# media_decode.py
+#
+# ffmpeg/ffprobe helpers that decode media straight to the raw PCM the speech
+# recognizer takes. Bytes go to and from ffmpeg over pipes; containers that need
+# seeking (MP4/MOV) get a uniquely named file on tmpfs, so concurrent jobs never
+# share a filename and nothing touches the working directory.
+import os
+import json
+import logging
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from fractions import Fraction
+from typing import Any, Dict, Iterator, Union
+from agents.blob_store import Media
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+FFPROBE_BIN = os.environ.get('FFPROBE_BIN', 'ffprobe')
+# Memory-backed when available, temporary copies of inline media never hit the disk
+MEDIA_TMP_DIR = os.environ.get('MEDIA_TMP_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+# What the speech recognizer is configured for: 16 kHz mono LINEAR16
+RECOGNIZER_SAMPLE_RATE = 16000
+RECOGNIZER_CHANNELS = 1
+
+
+class MediaDecodeError(Exception):
+    pass
+
+
+@contextmanager
+def media_path(media: Media, suffix: str = '') -> Iterator[str]:
+    # Blobs are already files; inline bytes are written once to a unique tmpfs file
+    if media.path is not None:
+        yield media.path
+        return
+    with tempfile.NamedTemporaryFile(dir=MEDIA_TMP_DIR, suffix=suffix, prefix='complaint-') as f:
+        f.write(media.view)
+        f.flush()
+        yield f.name
+
+def _run(cmd, stdin_data=None) -> bytes:
+    proc = subprocess.run(cmd, input=stdin_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise MediaDecodeError(f"{os.path.basename(cmd[0])} failed: {proc.stderr.decode(errors='replace')[-500:]}")
+    return proc.stdout
+
+def probe(path: str) -> Dict[str, Any]:
+    return json.loads(_run([FFPROBE_BIN, '-v', 'error', '-print_format', 'json',
+                            '-show_streams', '-show_format', path]))
+
+def frame_rate(info: Dict[str, Any]) -> float:
+    # From the container metadata, e.g. "30000/1001"; 0.0 when there is no video stream
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            for field in ('avg_frame_rate', 'r_frame_rate'):
+                rate = stream.get(field, '0/0')
+                if not rate.endswith('/0'):
+                    return float(Fraction(rate))
+    return 0.0
+
+def has_audio(info: Dict[str, Any]) -> bool:
+    return any(stream.get('codec_type') == 'audio' for stream in info.get('streams', []))
+
+def decode_pcm(source: Union[str, Media], sample_rate: int = RECOGNIZER_SAMPLE_RATE,
+               channels: int = RECOGNIZER_CHANNELS) -> bytes:
+    # Signed 16-bit little-endian PCM, resampled and downmixed by ffmpeg in the same pass
+    if isinstance(source, str):
+        input_arg, stdin_data = source, None
+    elif source.path is not None:
+        input_arg, stdin_data = source.path, None
+    else:
+        # Streamed from the buffer, without copying it
+        input_arg, stdin_data = 'pipe:0', source.view
+    cmd = [FFMPEG_BIN, '-v', 'error'] + (['-nostdin'] if stdin_data is None else [])
+    return _run(cmd + ['-i', input_arg, '-vn', '-ac', str(channels), '-ar', str(sample_rate),
+                       '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1'], stdin_data)
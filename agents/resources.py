@@ -0,0 +1,141 @@
+# resources.py
+#
+# Shared, pooled clients for the agents and the aggregator. Every client is
+# built on first use and reused afterwards; a forked process (RQ work horse)
+# builds its own instead of sharing sockets with its parent.
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from redis import ConnectionPool, Redis
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+ES_MAXSIZE = int(os.environ.get('ES_MAXSIZE', 25))
+
+def database_url():
+    db_user = os.environ.get('POSTGRES_USER', 'postgres')
+    db_pass = os.environ.get('POSTGRES_PASSWORD', 'postgres')
+    db_host = os.environ.get('POSTGRES_HOST', 'localhost')
+    db_port = os.environ.get('POSTGRES_PORT', '5433')
+    db_name = 'complaints'
+    return f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
+
+
+class Resources:
+    def __init__(self):
+        # Re-entrant: building the session factory builds the engine
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._clients = {}
+
+    def _get(self, name, factory):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Inherited clients hold the parent's sockets, drop them without closing
+                self._pid = os.getpid()
+                self._clients = {}
+            if name not in self._clients:
+                self._clients[name] = factory()
+            return self._clients[name]
+
+    def built(self, name):
+        # Clients that exist in this process, without building new ones
+        with self._lock:
+            return self._clients.get(name) if self._pid == os.getpid() else None
+
+    def client(self, name, factory):
+        # Any other client (Google Cloud, ...) is built on first use and shared the same way
+        return self._get(name, factory)
+
+    @property
+    def http(self) -> requests.Session:
+        def factory():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                                  max_retries=HTTP_MAX_RETRIES)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            return session
+        return self._get('http', factory)
+
+    @property
+    def redis(self) -> Redis:
+        def factory():
+            pool = ConnectionPool(host=os.environ.get('REDIS_HOST', 'localhost'),
+                                  port=int(os.environ.get('REDIS_PORT', 6379)),
+                                  max_connections=REDIS_MAX_CONNECTIONS)
+            return Redis(connection_pool=pool)
+        return self._get('redis', factory)
+
+    @property
+    def engine(self):
+        def factory():
+            from sqlalchemy import create_engine
+            return create_engine(database_url(), pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                 pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+        return self._get('engine', factory)
+
+    @property
+    def session_factory(self):
+        def factory():
+            from sqlalchemy.orm import sessionmaker
+            return sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        return self._get('session_factory', factory)
+
+    @property
+    def elasticsearch(self):
+        def factory():
+            from elasticsearch import Elasticsearch
+            return Elasticsearch([os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')], maxsize=ES_MAXSIZE)
+        return self._get('elasticsearch', factory)
+
+    @staticmethod
+    def _urllib3_stats(pool):
+        # The queue holds idle connections plus None for every slot that was never opened
+        queued = list(pool.pool.queue)
+        return pool.pool.maxsize - len(queued), sum(1 for conn in queued if conn is not None), pool.pool.maxsize
+
+    def pool_stats(self):
+        # Utilization of every pool built in this process, for the Prometheus collector
+        stats = []
+        session = self.built('http')
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                for key, pool in list(adapter.poolmanager.pools._container.items()):
+                    stats.append(('http', f"{key.key_scheme}://{key.key_host}:{key.key_port}",
+                                  *self._urllib3_stats(pool)))
+        redis_conn = self.built('redis')
+        if redis_conn is not None:
+            pool = redis_conn.connection_pool
+            stats.append(('redis', 'default', len(pool._in_use_connections), len(pool._available_connections),
+                          pool.max_connections))
+        engine = self.built('engine')
+        if engine is not None:
+            pool = engine.pool
+            stats.append(('postgres', 'default', pool.checkedout(), pool.checkedin(),
+                          pool.size() + DB_MAX_OVERFLOW))
+        es = self.built('elasticsearch')
+        if es is not None:
+            for connection in es.transport.connection_pool.connections:
+                pool = getattr(connection, 'pool', None)
+                if pool is not None:
+                    stats.append(('elasticsearch', connection.host, *self._urllib3_stats(pool)))
+        return stats
+
+
+resources = Resources()
@@ -0,0 +1,156 @@
+# result_cache.py
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from redis import Redis, RedisError
+from agents.resources import resources
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600))
+# In-process LRU tier limits, by entry count and by serialized size
+RESULT_CACHE_LOCAL_ENTRIES = int(os.environ.get('RESULT_CACHE_LOCAL_ENTRIES', 1024))
+RESULT_CACHE_LOCAL_BYTES = int(os.environ.get('RESULT_CACHE_LOCAL_BYTES', 64 * 1024 * 1024))
+# Results larger than this are not cached at all
+RESULT_CACHE_MAX_VALUE_BYTES = int(os.environ.get('RESULT_CACHE_MAX_VALUE_BYTES', 1024 * 1024))
+
+CACHE_KEY_PREFIX = 'result-cache'
+CACHE_STATS_KEY = 'result-cache:stats'
+
+_WHITESPACE = re.compile(r'\s+')
+
+# Text, inline media bytes or a blob store reference
+Content = Union[str, bytes, memoryview, Dict[str, Any]]
+
+def normalize_text(text: str) -> str:
+    # Form resubmits and copy-pasted templates differ only in case, unicode forms and spacing
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text)).strip().casefold()
+
+def content_key(modality: str, content: Content, version: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{modality}\0{version}\0".encode())
+    if isinstance(content, dict):
+        # Blob store references are already content hashes, the media is not read again
+        content = f"sha256:{content['blob']}".encode()
+    elif isinstance(content, str):
+        # Only free text is normalized, encoded media has to match byte for byte
+        content = (normalize_text(content) if modality == 'text' else content).encode()
+    digest.update(content)
+    return f"{CACHE_KEY_PREFIX}:{modality}:{digest.hexdigest()}"
+
+
+class ResultCache:
+    def __init__(self, redis_conn: Optional[Redis] = None, ttl: int = RESULT_CACHE_TTL,
+                 local_entries: int = RESULT_CACHE_LOCAL_ENTRIES, local_bytes: int = RESULT_CACHE_LOCAL_BYTES,
+                 max_value_bytes: int = RESULT_CACHE_MAX_VALUE_BYTES, enabled: bool = RESULT_CACHE_ENABLED):
+        self.redis_conn = redis_conn or resources.redis
+        self.ttl = ttl
+        self.local_entries = local_entries
+        self.local_bytes = local_bytes
+        self.max_value_bytes = max_value_bytes
+        self.enabled = enabled
+        self._local = OrderedDict()
+        self._local_size = 0
+        self._lock = threading.Lock()
+
+    def _local_get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                self._local_size -= len(payload)
+                return None
+            self._local.move_to_end(key)
+            return payload
+
+    def _local_set(self, key: str, payload: bytes, ttl: float):
+        with self._lock:
+            previous = self._local.pop(key, None)
+            if previous is not None:
+                self._local_size -= len(previous[1])
+            self._local[key] = (time.monotonic() + ttl, payload)
+            self._local_size += len(payload)
+            while self._local and (len(self._local) > self.local_entries or self._local_size > self.local_bytes):
+                _, (_, evicted) = self._local.popitem(last=False)
+                self._local_size -= len(evicted)
+
+    def _count(self, modality: str, outcome: str):
+        try:
+            self.redis_conn.hincrby(CACHE_STATS_KEY, f"{modality}:{outcome}", 1)
+        except RedisError as e:
+            logger.warning(f"Could not record result cache {outcome}: {str(e)}")
+
+    def get(self, modality: str, content: Content, version: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        key = content_key(modality, content, version)
+
+        payload = self._local_get(key)
+        if payload is not None:
+            self._count(modality, 'hit_local')
+            return json.loads(payload)
+
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.ttl(key)
+            payload, remaining_ttl = pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Result cache lookup failed: {str(e)}")
+            payload = None
+        if payload is not None:
+            # Promote to the local tier without outliving the Redis entry
+            self._local_set(key, payload, remaining_ttl if remaining_ttl and remaining_ttl > 0 else self.ttl)
+            self._count(modality, 'hit_redis')
+            return json.loads(payload)
+
+        self._count(modality, 'miss')
+        return None
+
+    def set(self, modality: str, content: Content, version: str, value: Dict[str, Any]):
+        if not self.enabled:
+            return
+        payload = json.dumps(value).encode()
+        if len(payload) > self.max_value_bytes:
+            logger.info(f"Result for {modality} complaint is {len(payload)} bytes, not caching")
+            return
+        key = content_key(modality, content, version)
+        self._local_set(key, payload, self.ttl)
+        try:
+            self.redis_conn.set(key, payload, ex=self.ttl)
+        except RedisError as e:
+            logger.warning(f"Result cache store failed: {str(e)}")
+
+    def cached_analysis(self, modality: str, content: Content, version: str,
+                        analyze: Callable[[], Tuple[Dict[str, Any], str]],
+                        cacheable: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Tuple[Dict[str, Any], str]:
+        # cacheable(analysis) False keeps a partial analysis out of the cache, so a resubmit retries it
+        cached = self.get(modality, content, version)
+        if cached is not None:
+            logger.info(f"Result cache hit for {modality} complaint")
+            return cached['content'], cached['category']
+        analysis, category = analyze()
+        if cacheable is None or cacheable(analysis):
+            self.set(modality, content, version, {'content': analysis, 'category': category})
+        else:
+            logger.info(f"Not caching the partial analysis of a {modality} complaint")
+        return analysis, category
+
+    def stats(self) -> Dict[str, int]:
+        return {field.decode(): int(value) for field, value in self.redis_conn.hgetall(CACHE_STATS_KEY).items()}
+
+
+result_cache = ResultCache()
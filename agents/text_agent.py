@@ -1,12 +1,19 @@
 # text_agent.py
 import os
 import json
+import time
 import logging
-from typing import Dict, Any
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 import openai
 from rq import Queue
-from redis import Redis
+from agents.resources import resources
+from agents.result_cache import result_cache
+from agents.delivery import deliver
+from agents.local_classifier import load_issue_classifier
+from agents.classification_stats import record_classification, flush_classification_stats
+from agents.entity_extraction import extract_entities_local, has_entities
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -16,116 +23,128 @@ logger = logging.getLogger(__name__)
 openai.api_key = os.environ.get('OPENAI_API_KEY')
 
 # Initialize Redis and RQ
-redis_conn = Redis(host=os.environ.get('REDIS_HOST', 'localhost'), 
-                   port=int(os.environ.get('REDIS_PORT', 6379)))
+redis_conn = resources.redis
 queue = Queue(connection=redis_conn)
 
-AGGREGATOR_URL = os.environ.get('AGGREGATOR_URL', 'http://localhost:5000/aggregate')
 
-def classify_issue(text: str) -> str:
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a complaint classifier. Classify the following complaint into one of these categories: 'Problem with a purchase shown on your statement', 'Fees or interest', 'Closing your account', 'Getting a credit card', 'Problem when making payments', 'Other features, terms, or problems'."},
-            {"role": "user", "content": text}
-        ]
-    )
-    return response.choices[0].message['content'].strip()
+TEXT_MODEL = os.environ.get('TEXT_MODEL', 'gpt-3.5-turbo')
 
-def classify_sub_issue(text: str, issue: str) -> str:
-    sub_issues = {
-        "Problem with a purchase shown on your statement": [
-            "Credit card company isn't resolving a dispute about a purchase on your statement",
-            "Overcharged for something you did purchase with the card",
-            "Card was charged for something you did not purchase with the card"
-        ],
-        "Fees or interest": [
-            "Problem with fees",
-            "Charged too much interest"
-        ],
-        "Closing your account": [
-            "Company closed your account"
-        ],
-        "Getting a credit card": [
-            "Card opened without my consent or knowledge"
-        ],
-        "Problem when making payments": [
-            "Problem during payment process"
-        ]
-    }
-    
-    if issue in sub_issues:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": f"You are a complaint sub-classifier. Classify the following complaint into one of these sub-categories: {', '.join(sub_issues[issue])}."},
-                {"role": "user", "content": text}
-            ]
-        )
-        return response.choices[0].message['content'].strip()
-    return "Other sub-issue"
+# 'rules' extracts entities in-process, 'rules_then_llm' asks the LLM only when the rules find
+# nothing and 'llm' always asks the LLM
+ENTITY_EXTRACTION_MODE = os.environ.get('ENTITY_EXTRACTION_MODE', 'rules')
 
-def extract_entities(text: str) -> Dict[str, list]:
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Extract monetary amounts and dates from the following text. Return the result as a JSON object with keys 'monetary_amounts' and 'dates', each containing a list of extracted values."},
-            {"role": "user", "content": text}
-        ]
-    )
-    return json.loads(response.choices[0].message['content'])
+# Limits of TEXT_MODEL used to pack several complaints into one batch request
+TEXT_MODEL_CONTEXT_TOKENS = int(os.environ.get('TEXT_MODEL_CONTEXT_TOKENS', 16385))
+TEXT_MODEL_MAX_OUTPUT_TOKENS = int(os.environ.get('TEXT_MODEL_MAX_OUTPUT_TOKENS', 4096))
+TEXT_BATCH_MAX_COMPLAINTS = int(os.environ.get('TEXT_BATCH_MAX_COMPLAINTS', 40))
+# Packed requests of one batch that may be in flight at the same time
+TEXT_BATCH_CONCURRENCY = int(os.environ.get('TEXT_BATCH_CONCURRENCY', 4))
 
-def extract_key_phrases(text: str) -> list:
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Extract up to 10 key phrases from the following text. Return the result as a JSON array."},
-            {"role": "user", "content": text}
-        ]
-    )
-    return json.loads(response.choices[0].message['content'])
+# Part of the result cache key, bump when prompts or the output shape change
+TEXT_PROMPT_VERSION = 'v1'
 
-def process_text_complaint(text: str) -> Dict[str, Any]:
-    logger.info(f"Processing complaint: {text[:50]}...")
+# 'fused' asks for every field in one structured request, 'legacy' makes one request per field
+# and 'concurrent' keeps the per-field prompts but runs the independent ones at the same time
+TEXT_ANALYSIS_MODE = os.environ.get('TEXT_ANALYSIS_MODE', 'fused')
 
-    # Use GPT-3.5 to analyze and categorize the complaint
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are an AI assistant that categorizes customer complaints. Provide a category and a brief summary."},
-            {"role": "user", "content": f"Categorize this complaint and provide a brief summary: {text}"}
-        ]
+ISSUES = [
+    "Problem with a purchase shown on your statement",
+    "Fees or interest",
+    "Closing your account",
+    "Getting a credit card",
+    "Problem when making payments",
+    "Other features, terms, or problems"
+]
+
+SUB_ISSUES = {
+    "Problem with a purchase shown on your statement": [
+        "Credit card company isn't resolving a dispute about a purchase on your statement",
+        "Overcharged for something you did purchase with the card",
+        "Card was charged for something you did not purchase with the card"
+    ],
+    "Fees or interest": [
+        "Problem with fees",
+        "Charged too much interest"
+    ],
+    "Closing your account": [
+        "Company closed your account"
+    ],
+    "Getting a credit card": [
+        "Card opened without my consent or knowledge"
+    ],
+    "Problem when making payments": [
+        "Problem during payment process"
+    ]
+}
+
+DEFAULT_SUB_ISSUE = "Other sub-issue"
+
+# Loaded once when the worker imports the agent; None means every complaint goes to the LLM
+issue_classifier = load_issue_classifier()
+
+# Result cache key. The analysis mode, the entity extraction mode and the local classifier change
+# the prompts and the output, so results computed under other settings are not served.
+ANALYSIS_VERSION = (f"{TEXT_MODEL}:{TEXT_PROMPT_VERSION}:{TEXT_ANALYSIS_MODE}:{ENTITY_EXTRACTION_MODE}:"
+                    f"{'llm' if issue_classifier is None else f'local@{issue_classifier.threshold}'}")
+
+def _chat_response(messages: List[Dict[str, str]], **kwargs):
+    return openai.ChatCompletion.create(
+        model=TEXT_MODEL,
+        messages=messages,
+        **kwargs
     )
-    
-    analysis = response.choices[0].message['content']
-    
+
+def _chat(messages: List[Dict[str, str]], **kwargs) -> str:
+    return _chat_response(messages, **kwargs).choices[0].message['content']
+
+# Prompts are built separately from the calls so the async agent can reuse them
+def categorize_messages(text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "You are an AI assistant that categorizes customer complaints. Provide a category and a brief summary."},
+        {"role": "user", "content": f"Categorize this complaint and provide a brief summary: {text}"}
+    ]
+
+def parse_categorization(analysis: str) -> Tuple[str, str]:
     # Extract category and summary from the GPT-3.5 response
     lines = analysis.split('\n')
     category = lines[0].split(':')[-1].strip()
     summary = '\n'.join(lines[1:])
+    return category, summary
 
-    # Classify issue and sub-issue
-    issue = classify_issue(text)
-    sub_issue = classify_sub_issue(text, issue)
+def issue_messages(text: str) -> List[Dict[str, str]]:
+    categories = ', '.join(f"'{issue}'" for issue in ISSUES)
+    return [
+        {"role": "system", "content": f"You are a complaint classifier. Classify the following complaint into one of these categories: {categories}."},
+        {"role": "user", "content": text}
+    ]
 
-    # Perform sentiment analysis
-    sentiment_response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Perform sentiment analysis on the following text. Return the result as a JSON object with keys 'label' (either 'POSITIVE' or 'NEGATIVE') and 'score' (a float between 0 and 1)."},
-            {"role": "user", "content": text}
-        ]
-    )
-    sentiment = json.loads(sentiment_response.choices[0].message['content'])
+def sub_issue_messages(text: str, issue: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": f"You are a complaint sub-classifier. Classify the following complaint into one of these sub-categories: {', '.join(SUB_ISSUES[issue])}."},
+        {"role": "user", "content": text}
+    ]
 
-    # Extract entities
-    entities = extract_entities(text)
+def sentiment_messages(text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "Perform sentiment analysis on the following text. Return the result as a JSON object with keys 'label' (either 'POSITIVE' or 'NEGATIVE') and 'score' (a float between 0 and 1)."},
+        {"role": "user", "content": text}
+    ]
 
-    # Extract key phrases
-    key_phrases = extract_key_phrases(text)
+def entities_messages(text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "Extract monetary amounts and dates from the following text. Return the result as a JSON object with keys 'monetary_amounts' and 'dates', each containing a list of extracted values."},
+        {"role": "user", "content": text}
+    ]
 
-    # Prepare structured output
-    structured_output = {
+def key_phrases_messages(text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "Extract up to 10 key phrases from the following text. Return the result as a JSON array."},
+        {"role": "user", "content": text}
+    ]
+
+def build_structured_output(text: str, issue: str, sub_issue: str, summary: str, entities: Dict[str, list],
+                            sentiment: Dict[str, Any], key_phrases: list) -> Dict[str, Any]:
+    return {
         "product": "Credit card",
         "issue": issue,
         "sub_issue": sub_issue,
@@ -136,22 +155,380 @@ def process_text_complaint(text: str) -> Dict[str, Any]:
         "original_text": text
     }
 
-    # Send to aggregator
-    response = requests.post(AGGREGATOR_URL, json={
-        'type': 'text',
-        'content': structured_output,
-        'category': category
-    })
+def categorize_complaint(text: str) -> Tuple[str, str]:
+    # Use GPT-3.5 to analyze and categorize the complaint
+    return parse_categorization(_chat(categorize_messages(text)))
+
+def local_issue(text: str) -> Optional[str]:
+    if issue_classifier is None:
+        return None
+    start = time.perf_counter()
+    issue = issue_classifier.predict_issue(text)
+    if issue is not None:
+        record_classification(redis_conn, 'local', time.perf_counter() - start)
+    return issue
+
+def local_sub_issue(text: str, issue: str) -> Optional[str]:
+    if issue_classifier is None:
+        return None
+    start = time.perf_counter()
+    sub_issue = issue_classifier.predict_sub_issue(text, SUB_ISSUES[issue])
+    if sub_issue is not None:
+        record_classification(redis_conn, 'local', time.perf_counter() - start)
+    return sub_issue
+
+def classify_issue(text: str) -> str:
+    # High-confidence complaints are answered by the local classifier
+    issue = local_issue(text)
+    if issue is not None:
+        return issue
+    start = time.perf_counter()
+    issue = _chat(issue_messages(text)).strip()
+    record_classification(redis_conn, 'llm', time.perf_counter() - start)
+    return issue
+
+def classify_sub_issue(text: str, issue: str) -> str:
+    if issue in SUB_ISSUES:
+        sub_issue = local_sub_issue(text, issue)
+        if sub_issue is not None:
+            return sub_issue
+        start = time.perf_counter()
+        sub_issue = _chat(sub_issue_messages(text, issue)).strip()
+        record_classification(redis_conn, 'llm', time.perf_counter() - start)
+        return sub_issue
+    return DEFAULT_SUB_ISSUE
+
+def analyze_sentiment(text: str) -> Dict[str, Any]:
+    return json.loads(_chat(sentiment_messages(text)))
+
+def extract_entities_llm(text: str) -> Dict[str, list]:
+    return json.loads(_chat(entities_messages(text)))
+
+def extract_entities(text: str) -> Dict[str, list]:
+    if ENTITY_EXTRACTION_MODE == 'llm':
+        return extract_entities_llm(text)
+    entities = extract_entities_local(text)
+    if ENTITY_EXTRACTION_MODE == 'rules_then_llm' and not has_entities(entities):
+        return extract_entities_llm(text)
+    return entities
+
+def extract_key_phrases(text: str) -> list:
+    return json.loads(_chat(key_phrases_messages(text)))
+
+# Schema of the fused response. It is sent with the prompt and every field is
+# validated on the way back so that only broken fields need a second request.
+FUSED_OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string"},
+        "summary": {"type": "string"},
+        "issue": {"type": "string", "enum": ISSUES},
+        "sub_issue": {"type": "string", "description": f"One of the sub-issues listed for the chosen issue, or '{DEFAULT_SUB_ISSUE}' if the issue has none"},
+        "sentiment": {
+            "type": "object",
+            "properties": {
+                "label": {"type": "string", "enum": ["POSITIVE", "NEGATIVE"]},
+                "score": {"type": "number", "minimum": 0, "maximum": 1}
+            },
+            "required": ["label", "score"]
+        },
+        "entities": {
+            "type": "object",
+            "properties": {
+                "monetary_amounts": {"type": "array", "items": {"type": "string"}},
+                "dates": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["monetary_amounts", "dates"]
+        },
+        "key_phrases": {"type": "array", "items": {"type": "string"}, "maxItems": 10}
+    },
+    "required": ["category", "summary", "issue", "sub_issue", "sentiment", "entities", "key_phrases"]
+}
+
+def fused_system_prompt(with_entities: bool = True, with_issue: bool = True) -> str:
+    schema = json.loads(json.dumps(FUSED_OUTPUT_SCHEMA))
+    if not with_entities:
+        # Entities come from the local rule engine, so the model does not spend tokens on them
+        del schema['properties']['entities']
+        schema['required'].remove('entities')
+    if not with_issue:
+        # Issue and sub-issue come from the local classifier
+        for field in ('issue', 'sub_issue'):
+            del schema['properties'][field]
+            schema['required'].remove(field)
+    sub_issues = f"Sub-issues allowed for each issue:\n{json.dumps(SUB_ISSUES, separators=(',', ':'))}\n" \
+        if with_issue else ""
+    return (
+        "You are an AI assistant that analyzes customer complaints about credit cards. "
+        "Return a single JSON object that matches this JSON schema:\n"
+        f"{json.dumps(schema, separators=(',', ':'))}\n"
+        + sub_issues
+        + "'category' is a short free-text category, 'summary' is a brief summary, "
+        + ("'entities' holds the monetary amounts and dates found in the complaint, " if with_entities else "")
+        + "and 'key_phrases' holds up to 10 key phrases."
+    )
+
+FUSED_SYSTEM_PROMPT = fused_system_prompt(with_entities=ENTITY_EXTRACTION_MODE != 'rules')
+FUSED_LOCAL_ISSUE_SYSTEM_PROMPT = fused_system_prompt(with_entities=ENTITY_EXTRACTION_MODE != 'rules',
+                                                      with_issue=False)
+
+BATCH_SYSTEM_PROMPT = (
+    "You will receive a JSON array of complaints, each with an integer 'id' and a 'text'. "
+    "Analyze every complaint independently and return a JSON object {\"results\": [...]} holding one result "
+    "per complaint. Each result has the 'id' of its complaint plus the fields described below.\n"
+    + fused_system_prompt(with_entities=ENTITY_EXTRACTION_MODE != 'rules').replace(
+        "Return a single JSON object that matches this JSON schema", "Each result matches this JSON schema")
+)
+
+def _validate_text(value: Any) -> Optional[str]:
+    if isinstance(value, str) and value.strip():
+        return value.strip()
+    return None
+
+def _validate_issue(value: Any) -> Optional[str]:
+    return value if value in ISSUES else None
+
+def _validate_sub_issue(value: Any, issue: str) -> Optional[str]:
+    return value if value in SUB_ISSUES.get(issue, [DEFAULT_SUB_ISSUE]) else None
+
+def _validate_sentiment(value: Any) -> Optional[Dict[str, Any]]:
+    if not isinstance(value, dict) or value.get('label') not in ('POSITIVE', 'NEGATIVE'):
+        return None
+    score = value.get('score')
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 1:
+        return None
+    return {'label': value['label'], 'score': float(score)}
 
-    if response.status_code == 202:
-        logger.info(f"Complaint processed and sent to aggregator. Task ID: {response.json()['task_id']}")
+def _validate_entities(value: Any) -> Optional[Dict[str, list]]:
+    if not isinstance(value, dict):
+        return None
+    entities = {}
+    for key in ('monetary_amounts', 'dates'):
+        items = value.get(key)
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            return None
+        entities[key] = items
+    return entities
+
+def _validate_key_phrases(value: Any) -> Optional[list]:
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        return None
+    return value[:10]
+
+def analyze_text_fused(text: str) -> Tuple[Dict[str, Any], str]:
+    # A confident local issue replaces the model's. When the sub-issue is local too, neither is asked for.
+    issue = local_issue(text)
+    if issue is None:
+        sub_issue = None
+    elif issue in SUB_ISSUES:
+        sub_issue = local_sub_issue(text, issue)
     else:
-        logger.error(f"Failed to send complaint to aggregator. Status code: {response.status_code}")
+        sub_issue = DEFAULT_SUB_ISSUE
+    prompt = FUSED_LOCAL_ISSUE_SYSTEM_PROMPT if sub_issue is not None else FUSED_SYSTEM_PROMPT
+    try:
+        data = json.loads(_chat([
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": text}
+        ], response_format={"type": "json_object"}, temperature=0))
+    except json.JSONDecodeError:
+        logger.warning("Fused analysis returned invalid JSON, falling back to per-field calls")
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    if issue is not None:
+        data['issue'] = issue
+    if sub_issue is not None:
+        data['sub_issue'] = sub_issue
+    return complete_fused_result(text, data)
+
+def complete_fused_result(text: str, data: Any) -> Tuple[Dict[str, Any], str]:
+    if not isinstance(data, dict):
+        data = {}
+
+    category = _validate_text(data.get('category'))
+    summary = _validate_text(data.get('summary'))
+    issue = _validate_issue(data.get('issue'))
+    sub_issue = _validate_sub_issue(data.get('sub_issue'), issue) if issue else None
+    sentiment = _validate_sentiment(data.get('sentiment'))
+    entities = _validate_entities(data.get('entities'))
+    key_phrases = _validate_key_phrases(data.get('key_phrases'))
+
+    # The rule engine is authoritative for entities unless it is configured as a pre-pass only
+    if ENTITY_EXTRACTION_MODE != 'llm':
+        local_entities = extract_entities_local(text)
+        if ENTITY_EXTRACTION_MODE == 'rules' or has_entities(local_entities):
+            entities = local_entities
+
+    # Fall back to the dedicated prompt only for the fields that failed validation
+    failed = [name for name, value in (('category', category), ('summary', summary), ('issue', issue),
+                                       ('sub_issue', sub_issue), ('sentiment', sentiment),
+                                       ('entities', entities), ('key_phrases', key_phrases)) if value is None]
+    if failed:
+        logger.info(f"Fused analysis fields failed validation: {failed}")
+    if category is None or summary is None:
+        fallback_category, fallback_summary = categorize_complaint(text)
+        category = category or fallback_category
+        summary = summary or fallback_summary
+    if issue is None:
+        issue = classify_issue(text)
+    if sub_issue is None:
+        sub_issue = classify_sub_issue(text, issue)
+    if sentiment is None:
+        sentiment = analyze_sentiment(text)
+    if entities is None:
+        entities = extract_entities(text)
+    if key_phrases is None:
+        key_phrases = extract_key_phrases(text)
+
+    structured_output = build_structured_output(text, issue, sub_issue, summary, entities, sentiment, key_phrases)
+    return structured_output, category
+
+def analyze_text_legacy(text: str) -> Tuple[Dict[str, Any], str]:
+    category, summary = categorize_complaint(text)
+
+    # Classify issue and sub-issue
+    issue = classify_issue(text)
+    sub_issue = classify_sub_issue(text, issue)
+
+    # Perform sentiment analysis
+    sentiment = analyze_sentiment(text)
+
+    # Extract entities
+    entities = extract_entities(text)
+
+    # Extract key phrases
+    key_phrases = extract_key_phrases(text)
+
+    # Prepare structured output
+    structured_output = build_structured_output(text, issue, sub_issue, summary, entities, sentiment, key_phrases)
+    return structured_output, category
+
+def analyze_text_complaint(text: str, mode: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+    mode = mode or TEXT_ANALYSIS_MODE
+    if mode == 'fused':
+        return analyze_text_fused(text)
+    if mode == 'legacy':
+        return analyze_text_legacy(text)
+    if mode == 'concurrent':
+        from agents.async_text_agent import analyze_text_concurrent
+        return analyze_text_concurrent(text)
+    raise ValueError(f"Unknown text analysis mode: {mode}")
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+class BatchSizer:
+    # Packs complaints into requests that fit the context window and output limit. The output
+    # estimate follows the completion tokens actually used, so batch sizes adapt over time.
+    def __init__(self, output_tokens_per_complaint: float = 200.0, smoothing: float = 0.2):
+        self.output_tokens_per_complaint = output_tokens_per_complaint
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def observe(self, complaints: int, completion_tokens: int):
+        with self._lock:
+            observed = completion_tokens / complaints
+            self.output_tokens_per_complaint += self.smoothing * (observed - self.output_tokens_per_complaint)
+
+    def expected_output_tokens(self, complaints: int) -> int:
+        # Headroom so an unusually verbose batch is not truncated
+        return min(TEXT_MODEL_MAX_OUTPUT_TOKENS, int(complaints * self.output_tokens_per_complaint * 1.25) + 64)
+
+    def pack(self, texts: List[str], system_tokens: int) -> List[List[int]]:
+        groups, group, input_tokens = [], [], system_tokens
+        for index, text in enumerate(texts):
+            tokens = estimate_tokens(text) + 8
+            size = len(group) + 1
+            fits = (size <= TEXT_BATCH_MAX_COMPLAINTS
+                    and size * self.output_tokens_per_complaint * 1.25 + 64 <= TEXT_MODEL_MAX_OUTPUT_TOKENS
+                    and input_tokens + tokens + self.expected_output_tokens(size) <= TEXT_MODEL_CONTEXT_TOKENS)
+            if group and not fits:
+                groups.append(group)
+                group, input_tokens = [], system_tokens
+            group.append(index)
+            input_tokens += tokens
+        if group:
+            groups.append(group)
+        return groups
+
+
+batch_sizer = BatchSizer()
+
+def _analyze_group(texts: List[str], group: List[int]) -> Dict[int, Tuple[Dict[str, Any], str]]:
+    if len(group) == 1:
+        return {group[0]: analyze_text_fused(texts[group[0]])}
+
+    payload = json.dumps([{'id': position, 'text': texts[index]} for position, index in enumerate(group)])
+    try:
+        response = _chat_response([
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": payload}
+        ], response_format={"type": "json_object"}, temperature=0,
+            max_tokens=batch_sizer.expected_output_tokens(len(group)))
+        if response.choices[0].get('finish_reason') == 'length':
+            raise ValueError("batch response was truncated")
+        data = json.loads(response.choices[0].message['content'])
+        batch_sizer.observe(len(group), response['usage']['completion_tokens'])
+    except (ValueError, KeyError, TypeError) as e:
+        # Split and retry, down to single complaints that use the fused request
+        logger.warning(f"Batch of {len(group)} complaints failed ({str(e)}), splitting")
+        middle = len(group) // 2
+        return {**_analyze_group(texts, group[:middle]), **_analyze_group(texts, group[middle:])}
+
+    by_id = {}
+    for item in data.get('results', []) if isinstance(data, dict) else []:
+        if isinstance(item, dict) and isinstance(item.get('id'), int):
+            by_id[item['id']] = item
+
+    results = {}
+    for position, index in enumerate(group):
+        if position in by_id:
+            results[index] = complete_fused_result(texts[index], by_id[position])
+        else:
+            logger.info(f"Batch response is missing complaint {position}, analyzing it on its own")
+            results[index] = analyze_text_fused(texts[index])
+    return results
+
+def analyze_text_batch(texts: List[str]) -> List[Tuple[Dict[str, Any], str]]:
+    groups = batch_sizer.pack(texts, estimate_tokens(BATCH_SYSTEM_PROMPT))
+    logger.info(f"Analyzing {len(texts)} complaints in {len(groups)} batch requests")
+    results = {}
+    with ThreadPoolExecutor(max_workers=TEXT_BATCH_CONCURRENCY) as executor:
+        for group_results in executor.map(lambda group: _analyze_group(texts, group), groups):
+            results.update(group_results)
+    return [results[index] for index in range(len(texts))]
+
+def analyze_text_complaints(texts: List[str]) -> List[Tuple[Dict[str, Any], str]]:
+    # Batch counterpart of process_text_complaint's analysis, with the same result cache
+    analyses = [None] * len(texts)
+    misses = []
+    for index, text in enumerate(texts):
+        cached = result_cache.get('text', text, ANALYSIS_VERSION)
+        if cached is not None:
+            analyses[index] = (cached['content'], cached['category'])
+        else:
+            misses.append(index)
+    if misses:
+        for index, (structured_output, category) in zip(misses, analyze_text_batch([texts[i] for i in misses])):
+            result_cache.set('text', texts[index], ANALYSIS_VERSION, {'content': structured_output, 'category': category})
+            analyses[index] = (structured_output, category)
+    flush_classification_stats(redis_conn)
+    return analyses
+
+def process_text_complaint(text: str) -> Dict[str, Any]:
+    logger.info(f"Processing complaint: {text[:50]}...")
+
+    structured_output, category = result_cache.cached_analysis(
+        'text', text, ANALYSIS_VERSION, lambda: analyze_text_complaint(text))
+    flush_classification_stats(redis_conn)
 
-    return response.json()
+    # Back to process_complaint in the same job, or to the aggregator for remote agents
+    return deliver('text', structured_output, category)
 
 if __name__ == '__main__':
     # For testing
     sample_complaint = "I've been trying to reach customer service for days about a wrong charge of $50.00 on my card from 05/15/2024, but no one is responding!"
     result = queue.enqueue(process_text_complaint, sample_complaint)
-    print(f"Job ID: {result.id}")
\ No newline at end of file
+    print(f"Job ID: {result.id}")
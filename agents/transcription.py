@@ -0,0 +1,183 @@
+# transcription.py
+#
+# Segmenting transcription for voice and video complaints. 16 kHz mono PCM is
+# split on silence into windows no longer than TRANSCRIPTION_MAX_WINDOW_SECONDS,
+# the windows are recognized concurrently and the transcripts are stitched back
+# in order with their timestamps. Latency follows the longest window, not the
+# clip length, and clips are no longer capped by the synchronous API limit.
+import os
+import time
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from agents.resources import resources
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRANSCRIPTION_RECOGNIZER = os.environ.get('TRANSCRIPTION_RECOGNIZER', 'google')
+# Synchronous recognition accepts up to 60s of audio per request
+TRANSCRIPTION_MAX_WINDOW_SECONDS = float(os.environ.get('TRANSCRIPTION_MAX_WINDOW_SECONDS', 55))
+TRANSCRIPTION_MIN_WINDOW_SECONDS = float(os.environ.get('TRANSCRIPTION_MIN_WINDOW_SECONDS', 5))
+TRANSCRIPTION_MIN_SILENCE_MS = int(os.environ.get('TRANSCRIPTION_MIN_SILENCE_MS', 300))
+TRANSCRIPTION_CONCURRENCY = int(os.environ.get('TRANSCRIPTION_CONCURRENCY', 8))
+
+FRAME_MS = 30
+
+
+def frame_energy(samples: np.ndarray, frame_length: int) -> np.ndarray:
+    # RMS per frame, the last partial frame is padded with zeros
+    n_frames = -(-len(samples) // frame_length)
+    frames = np.zeros(n_frames * frame_length, dtype=np.float32)
+    frames[:len(samples)] = samples
+    frames = frames.reshape(n_frames, frame_length)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+def silence_threshold(energy: np.ndarray) -> float:
+    # Just above the noise floor, but well under speech level when there are few pauses.
+    # Relative, so it works for quiet and loud recordings.
+    if not len(energy):
+        return 0.0
+    floor = np.percentile(energy, 10)
+    return max(min(floor * 2.0, np.percentile(energy, 90) * 0.3), 50.0)
+
+def split_on_silence(samples: np.ndarray, sample_rate: int,
+                     max_window: float = TRANSCRIPTION_MAX_WINDOW_SECONDS,
+                     min_window: float = TRANSCRIPTION_MIN_WINDOW_SECONDS,
+                     min_silence_ms: int = TRANSCRIPTION_MIN_SILENCE_MS) -> List[Tuple[int, int]]:
+    # (start, end) sample offsets. Windows end in the middle of a pause when there is one
+    # between min_window and max_window, otherwise at the quietest frame before max_window.
+    if not len(samples):
+        return []
+    frame_length = sample_rate * FRAME_MS // 1000
+    energy = frame_energy(samples, frame_length)
+    silent = energy < silence_threshold(energy)
+
+    # Centers of pauses that are long enough to cut in
+    min_run = max(1, min_silence_ms // FRAME_MS)
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    long_runs = run_ends - run_starts >= min_run
+    cuts = (run_starts[long_runs] + run_ends[long_runs]) // 2
+
+    max_frames = max(1, int(max_window * 1000 / FRAME_MS))
+    min_frames = min(max_frames, int(min_window * 1000 / FRAME_MS))
+    windows = []
+    start, n_frames = 0, len(energy)
+    while start < n_frames:
+        limit = start + max_frames
+        if limit >= n_frames:
+            end = n_frames
+        else:
+            candidates = cuts[(cuts > start + min_frames) & (cuts <= limit)]
+            if len(candidates):
+                end = int(candidates[-1])
+            else:
+                tail = start + min_frames
+                end = tail + int(np.argmin(energy[tail:limit])) if limit > tail else limit
+                end = max(end, start + 1)
+        # Windows that are silence from end to end are not sent to the recognizer
+        if not silent[start:end].all():
+            windows.append((start * frame_length, min(end * frame_length, len(samples))))
+        start = end
+    return windows
+
+
+class Recognizer(ABC):
+    # Turns one window of 16-bit mono PCM into text
+    @abstractmethod
+    def recognize(self, pcm: bytes, sample_rate: int) -> str:
+        ...
+
+
+class GoogleSpeechRecognizer(Recognizer):
+    def __init__(self, language_code: str = 'en-US', enable_automatic_punctuation: bool = True):
+        self.language_code = language_code
+        self.enable_automatic_punctuation = enable_automatic_punctuation
+
+    def recognize(self, pcm: bytes, sample_rate: int) -> str:
+        from google.cloud import speech_v1p1beta1 as speech
+
+        client = resources.client('speech', speech.SpeechClient)
+        config = speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=sample_rate,
+            language_code=self.language_code,
+            enable_automatic_punctuation=self.enable_automatic_punctuation,
+        )
+        response = client.recognize(config=config, audio=speech.RecognitionAudio(content=pcm))
+        # Every result covers a consecutive part of the window
+        return ' '.join(result.alternatives[0].transcript.strip() for result in response.results
+                        if result.alternatives)
+
+
+class StubRecognizer(Recognizer):
+    # Local recognizer for tests and benchmarks: optional fixed latency per second of
+    # audio and a deterministic transcript
+    def __init__(self, seconds_per_audio_second: float = 0.0,
+                 transcribe: Optional[Callable[[bytes, int], str]] = None):
+        self.seconds_per_audio_second = seconds_per_audio_second
+        self.transcribe = transcribe
+
+    def recognize(self, pcm: bytes, sample_rate: int) -> str:
+        duration = len(pcm) / 2 / sample_rate
+        if self.seconds_per_audio_second:
+            time.sleep(duration * self.seconds_per_audio_second)
+        if self.transcribe is not None:
+            return self.transcribe(pcm, sample_rate)
+        return f"[{duration:.2f}s of speech]"
+
+
+RECOGNIZERS = {
+    'google': GoogleSpeechRecognizer,
+    'stub': StubRecognizer,
+}
+
+def get_recognizer(name: str = TRANSCRIPTION_RECOGNIZER) -> Recognizer:
+    return RECOGNIZERS[name]()
+
+def is_complete(transcription: Dict[str, Any]) -> bool:
+    # False when a window failed recognition and left a gap in the transcript
+    return not any(segment.get('error') for segment in transcription.get('segments') or [])
+
+def transcribe(samples: np.ndarray, sample_rate: int, recognizer: Optional[Recognizer] = None,
+               concurrency: int = TRANSCRIPTION_CONCURRENCY) -> Dict[str, Any]:
+    # {'transcript': str, 'segments': [{'start', 'end', 'text'}]}, timestamps in seconds
+    recognizer = recognizer or get_recognizer()
+    samples = np.asarray(samples, dtype=np.int16)
+    windows = split_on_silence(samples, sample_rate)
+
+    def recognize(window):
+        start, end = window
+        try:
+            return recognizer.recognize(samples[start:end].tobytes(), sample_rate)
+        except Exception as e:
+            # One failed window leaves a gap instead of losing the transcript
+            logger.error(f"Recognition of {start / sample_rate:.1f}s-{end / sample_rate:.1f}s failed: {str(e)}")
+            return None
+
+    started = time.perf_counter()
+    if len(windows) > 1:
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(windows)))) as executor:
+            texts = list(executor.map(recognize, windows))
+    else:
+        texts = [recognize(window) for window in windows]
+
+    if windows and all(text is None for text in texts):
+        raise RuntimeError(f"Recognition failed for all {len(windows)} windows")
+
+    segments = []
+    for (start, end), text in zip(windows, texts):
+        segment = {'start': round(start / sample_rate, 3), 'end': round(end / sample_rate, 3), 'text': text or ''}
+        if text is None:
+            segment['error'] = True
+        segments.append(segment)
+    logger.info(f"Transcribed {len(samples) / sample_rate:.1f}s of audio in {len(windows)} windows "
+                f"in {time.perf_counter() - started:.2f}s")
+    return {
+        'transcript': ' '.join(segment['text'] for segment in segments if segment['text']),
+        'segments': segments,
+    }
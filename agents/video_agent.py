@@ -1,60 +1,51 @@
 # video_agent.py
 import os
-import requests
-import io
 from google.cloud import videointelligence
-from google.cloud import speech_v1p1beta1 as speech
 from google.cloud import language_v1
-import cv2
 import numpy as np
 import logging
+from agents.resources import resources
+from agents.blob_store import open_media
+from agents.media_decode import RECOGNIZER_SAMPLE_RATE, media_path, probe, frame_rate, has_audio, decode_pcm
+from agents.keyframes import extract_keyframes
+from agents.image_agent import VISION_BATCH_SIZE, prepare_image, vision_client
+from agents.transcription import is_complete, transcribe
+from agents.result_cache import result_cache
+from agents.delivery import deliver
+from agents.complaint_options import VIDEO_ANALYSIS_MODES
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Google Cloud clients
-video_client = videointelligence.VideoIntelligenceServiceClient()
-speech_client = speech.SpeechClient()
-language_client = language_v1.LanguageServiceClient()
+# Google Cloud clients are created on first use and shared through resources
+def language_client():
+    return resources.client('language', language_v1.LanguageServiceClient)
 
-AGGREGATOR_URL = os.environ.get('AGGREGATOR_URL', 'http://localhost:5000/aggregate')
+def video_client():
+    return resources.client('videointelligence', videointelligence.VideoIntelligenceServiceClient)
 
-def extract_audio(video_content):
-    # Save video content to a temporary file
-    temp_video = 'temp_video.mp4'
-    with open(temp_video, 'wb') as f:
-        f.write(video_content)
 
-    # Extract audio using OpenCV
-    video = cv2.VideoCapture(temp_video)
-    fps = video.get(cv2.CAP_PROP_FPS)
-    audio_output = 'temp_audio.wav'
-    os.system(f"ffmpeg -i {temp_video} -ab 160k -ac 2 -ar 44100 -vn {audio_output}")
+# 'keyframes' annotates a few representative frames through the image analysis path,
+# 'full' uploads the whole video to Video Intelligence
+VIDEO_ANALYSIS_MODE = os.environ.get('VIDEO_ANALYSIS_MODE', 'keyframes')
 
-    # Read the audio file
-    with open(audio_output, 'rb') as audio_file:
-        audio_content = audio_file.read()
+# Part of the result cache key, bump when preprocessing or the output shape change
+ANALYSIS_VERSION = 'videointelligence:v4'
 
-    # Clean up temporary files
-    os.remove(temp_video)
-    os.remove(audio_output)
-
-    return audio_content, fps
-
-def process_video_complaint(video_content):
-    logger.info("Processing video complaint...")
-
-    # Extract audio from video
-    audio_content, fps = extract_audio(video_content)
+def extract_audio(path, info):
+    # The audio track as 16 kHz mono PCM, empty for videos without one
+    return decode_pcm(path) if has_audio(info) else b''
 
+def annotate_full_video(media):
     # Perform video analysis
     features = [videointelligence.Feature.LABEL_DETECTION,
                 videointelligence.Feature.OBJECT_TRACKING,
                 videointelligence.Feature.TEXT_DETECTION]
 
-    operation = video_client.annotate_video(
-        request={"features": features, "input_content": video_content}
+    # The API takes inline content as bytes, the only full copy of the video in this job
+    operation = video_client().annotate_video(
+        request={"features": features, "input_content": bytes(media.view)}
     )
     logger.info("Waiting for video analysis to complete...")
     result = operation.result(timeout=90)
@@ -82,37 +73,80 @@ def process_video_complaint(video_content):
             'text': text.text,
             'confidence': text.segments[0].confidence
         })
+    return {'labels': labels, 'objects': objects, 'texts': texts}
+
+def annotate_keyframes(path, fps):
+    # The K most representative frames, annotated like image complaints in batch requests
+    keyframes = extract_keyframes(path, fps)
+    prepared = [prepare_image(keyframe['jpeg']) for keyframe in keyframes]
+    responses = []
+    for offset in range(0, len(prepared), VISION_BATCH_SIZE):
+        responses += vision_client().batch_annotate_images(
+            requests=[request for request, _ in prepared[offset:offset + VISION_BATCH_SIZE]]).responses
+    logger.info(f"Annotated {len(keyframes)} keyframes, "
+                f"{sum(len(request.image.content) for request, _ in prepared)} bytes uploaded")
+
+    # Highest score of every label and object over the keyframes. Text confidence is the
+    # share of keyframes it appears in, OCR does not score it.
+    labels, objects, texts, frames = {}, {}, {}, []
+    for keyframe, response in zip(keyframes, responses):
+        if response.error.message:
+            logger.error(f"Annotation of the frame at {keyframe['time']}s failed: {response.error.message}")
+            continue
+        for label in response.label_annotations:
+            labels[label.description] = max(labels.get(label.description, 0.0), label.score)
+        for obj in response.localized_object_annotations:
+            objects[obj.name] = max(objects.get(obj.name, 0.0), obj.score)
+        if response.text_annotations:
+            text = response.text_annotations[0].description
+            texts[text] = texts.get(text, 0) + 1
+        frames.append({'time': keyframe['time'],
+                       'labels': [label.description for label in response.label_annotations[:5]]})
+    return {
+        'labels': [{'description': description, 'confidence': score}
+                   for description, score in sorted(labels.items(), key=lambda item: -item[1])],
+        'objects': [{'description': description, 'confidence': score}
+                    for description, score in sorted(objects.items(), key=lambda item: -item[1])],
+        'texts': [{'text': text, 'confidence': count / len(keyframes)} for text, count in texts.items()],
+        'keyframes': frames,
+    }
 
-    # Perform speech recognition on extracted audio
-    audio = speech.RecognitionAudio(content=audio_content)
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=44100,
-        language_code="en-US",
-        enable_automatic_punctuation=True,
-    )
-
-    response = speech_client.recognize(config=config, audio=audio)
-    transcript = ' '.join([result.alternatives[0].transcript for result in response.results])
+def analyze_video_complaint(video_content, mode=VIDEO_ANALYSIS_MODE):
+    with open_media(video_content) as media:
+        # FPS from the container metadata, without fixed temp filenames so several videos
+        # can be processed at once
+        with media_path(media, suffix='.mp4') as path:
+            info = probe(path)
+            audio_content = extract_audio(path, info)
+            if mode == 'full':
+                visual = annotate_full_video(media)
+            else:
+                visual = annotate_keyframes(path, frame_rate(info))
+
+    # Perform speech recognition on extracted audio in silence-delimited windows, concurrently;
+    # videos without an audio track have no transcript
+    transcription = transcribe(np.frombuffer(audio_content, dtype=np.int16), RECOGNIZER_SAMPLE_RATE)
+    transcript = transcription['transcript']
 
     # Perform sentiment analysis on transcript
-    document = language_v1.Document(content=transcript, type_=language_v1.Document.Type.PLAIN_TEXT)
-    sentiment = language_client.analyze_sentiment(request={'document': document}).document_sentiment
+    sentiment = None
+    if transcript:
+        document = language_v1.Document(content=transcript, type_=language_v1.Document.Type.PLAIN_TEXT)
+        sentiment = language_client().analyze_sentiment(request={'document': document}).document_sentiment
 
     # Prepare content for aggregator
-    content = {
-        'labels': labels,
-        'objects': objects,
-        'texts': texts,
+    content = dict(visual, **{
+        'analysis': mode,
         'transcript': transcript,
+        'segments': transcription['segments'],
         'sentiment': {
             'score': sentiment.score,
             'magnitude': sentiment.magnitude
-        }
-    }
+        } if sentiment else None
+    })
 
-    # Determine category based on detected objects and labels
-    categories = set([obj['description'] for obj in objects] + [label['description'] for label in labels])
+    # Determine category based on detected objects and labels, Vision capitalizes them
+    categories = set(item['description'].lower() for item in visual['objects'] + visual['labels'])
     category = 'General Video Complaint'
     if 'product' in categories or 'merchandise' in categories:
         category = 'Product-related Video Complaint'
@@ -121,19 +155,21 @@ def process_video_complaint(video_content):
     elif 'website' in categories or 'app' in categories:
         category = 'Digital Service Video Complaint'
 
-    # Send to aggregator
-    response = requests.post(AGGREGATOR_URL, json={
-        'type': 'video',
-        'content': content,
-        'category': category
-    })
+    return content, category
+
+def process_video_complaint(video_content, options=None):
+    logger.info("Processing video complaint...")
 
-    if response.status_code == 202:
-        logger.info(f"Video complaint processed and sent to aggregator. Task ID: {response.json()['task_id']}")
-    else:
-        logger.error(f"Failed to send video complaint to aggregator. Status code: {response.status_code}")
+    # options={'video_analysis': 'full'} opts into annotating the whole video
+    mode = (options or {}).get('video_analysis', VIDEO_ANALYSIS_MODE)
+    if mode not in VIDEO_ANALYSIS_MODES:
+        raise ValueError(f"Unknown video analysis mode: {mode}")
+    content, category = result_cache.cached_analysis(
+        'video', video_content, f"{ANALYSIS_VERSION}:{mode}", lambda: analyze_video_complaint(video_content, mode),
+        cacheable=is_complete)
 
-    return response.json()
+    # Back to process_complaint in the same job, or to the aggregator for remote agents
+    return deliver('video', content, category)
 
 if __name__ == '__main__':
     # For testing, you would need to provide a video file
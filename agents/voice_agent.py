@@ -1,98 +1,71 @@
 # voice_agent.py
-import os
-import requests
-from google.cloud import speech_v1p1beta1 as speech
 from google.cloud import language_v1
-from pydub import AudioSegment
-import io
-import wave
-import numpy as np
-from scipy.io import wavfile
-import noisereduce as nr
 import logging
+from agents.resources import resources
+from agents.blob_store import open_media
+from agents.media_decode import RECOGNIZER_SAMPLE_RATE
+from agents.audio_enhancement import enhance_media
+from agents.transcription import is_complete, transcribe
+from agents.result_cache import result_cache
+from agents.delivery import deliver
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Google Cloud clients
-speech_client = speech.SpeechClient()
-language_client = language_v1.LanguageServiceClient()
+# Google Cloud clients are created on first use and shared through resources
+def language_client():
+    return resources.client('language', language_v1.LanguageServiceClient)
 
 
-AGGREGATOR_URL = os.environ.get('AGGREGATOR_URL', 'http://localhost:5000/aggregate')
+# Part of the result cache key, bump when preprocessing or the output shape change
+ANALYSIS_VERSION = 'speech:v3'
 
-def enhance_audio(audio_content):
-    # Convert to wav
-    audio = AudioSegment.from_file(io.BytesIO(audio_content), format="mp3")
-    buf = io.BytesIO()
-    audio.export(buf, format="wav")
-    buf.seek(0)
+def enhance_audio(media):
+    # Decoded to the recognizer's 16 kHz mono PCM and denoised block by block as ffmpeg produces it
+    return enhance_media(media, RECOGNIZER_SAMPLE_RATE)
 
-    # Read wav file
-    with wave.open(buf, "rb") as wave_file:
-        frame_rate = wave_file.getframerate()
-        wav_data = np.frombuffer(wave_file.readframes(-1), dtype=np.int16)
-
-    # Reduce noise
-    reduced_noise = nr.reduce_noise(y=wav_data, sr=frame_rate)
-
-    # Convert back to bytes
-    enhanced_buf = io.BytesIO()
-    wavfile.write(enhanced_buf, frame_rate, reduced_noise.astype(np.int16))
-    return enhanced_buf.getvalue()
+def analyze_voice_complaint(audio_content):
+    # Enhance audio
+    with open_media(audio_content) as media:
+        enhanced_audio = enhance_audio(media)
+
+    # Transcribe audio in silence-delimited windows, concurrently
+    transcription = transcribe(enhanced_audio, RECOGNIZER_SAMPLE_RATE)
+    transcript = transcription['transcript']
+
+    # Perform sentiment and entity analysis, a recording without speech has neither
+    sentiment, entities = None, []
+    if transcript:
+        document = language_v1.Document(content=transcript, type_=language_v1.Document.Type.PLAIN_TEXT)
+        sentiment = language_client().analyze_sentiment(request={'document': document}).document_sentiment
+        entities = language_client().analyze_entities(request={'document': document}).entities
+
+    content = {
+        'transcript': transcript,
+        'segments': transcription['segments'],
+        'sentiment': {
+            'score': sentiment.score,
+            'magnitude': sentiment.magnitude
+        } if sentiment else None,
+        'entities': [{
+            'name': entity.name,
+            'type': language_v1.Entity.Type(entity.type_).name,
+            'salience': entity.salience
+        } for entity in entities]
+    }
+    category = 'Voice Complaint'  # You might want to determine this based on the content
+    return content, category
 
 def process_voice_complaint(audio_content):
     logger.info("Processing voice complaint...")
 
-    # Enhance audio
-    enhanced_audio = enhance_audio(audio_content)
-
-    # Transcribe audio
-    audio = speech.RecognitionAudio(content=enhanced_audio)
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=16000,
-        language_code="en-US",
-        enable_automatic_punctuation=True,
-        enable_speaker_diarization=True,
-        diarization_speaker_count=2,
-    )
-
-    response = speech_client.recognize(config=config, audio=audio)
-    transcript = response.results[-1].alternatives[0].transcript
-
-    # Perform sentiment analysis
-    document = language_v1.Document(content=transcript, type_=language_v1.Document.Type.PLAIN_TEXT)
-    sentiment = language_client.analyze_sentiment(request={'document': document}).document_sentiment
-
-    # Perform entity analysis
-    entities = language_client.analyze_entities(request={'document': document}).entities
-
-    # Send to aggregator
-    response = requests.post(AGGREGATOR_URL, json={
-        'type': 'voice',
-        'content': {
-            'transcript': transcript,
-            'sentiment': {
-                'score': sentiment.score,
-                'magnitude': sentiment.magnitude
-            },
-            'entities': [{
-                'name': entity.name,
-                'type': language_v1.Entity.Type(entity.type_).name,
-                'salience': entity.salience
-            } for entity in entities]
-        },
-        'category': 'Voice Complaint'  # You might want to determine this based on the content
-    })
-
-    if response.status_code == 202:
-        logger.info(f"Voice complaint processed and sent to aggregator. Task ID: {response.json()['task_id']}")
-    else:
-        logger.error(f"Failed to send voice complaint to aggregator. Status code: {response.status_code}")
+    content, category = result_cache.cached_analysis(
+        'voice', audio_content, ANALYSIS_VERSION, lambda: analyze_voice_complaint(audio_content),
+        cacheable=is_complete)
 
-    return response.json()
+    # Back to process_complaint in the same job, or to the aggregator for remote agents
+    return deliver('voice', content, category)
 
 if __name__ == '__main__':
     # For testing, you would need to provide an audio file
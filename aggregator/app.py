@@ -1,28 +1,31 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
-from elasticsearch import Elasticsearch, ElasticsearchException
+from elasticsearch import RequestError
 from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from redis import Redis
-from rq import Queue
-from rq.job import Job
-from redis import Redis
+from rq.job import Job, JobStatus
 
 import logging
 from opencensus.ext.flask.flask_middleware import FlaskMiddleware
 from opencensus.trace import samplers
 from opencensus.ext.azure.trace_exporter import AzureExporter
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import REGISTRY
 from datetime import datetime
 
 import sys
 
+# Complaints per batch job. A text job packs its complaints into as few LLM requests as
+# possible, an image job annotates up to VISION_BATCH_SIZE images per Vision request.
+TEXT_BATCH_JOB_SIZE = int(os.environ.get('TEXT_BATCH_JOB_SIZE', 200))
+IMAGE_BATCH_JOB_SIZE = int(os.environ.get('IMAGE_BATCH_JOB_SIZE', 64))
+
 # Get the absolute path of the current script
 current_dir = os.path.dirname(os.path.abspath(__file__))
 # Get the parent directory
@@ -34,20 +37,28 @@ print("Current directory:", current_dir)
 print("Parent directory:", parent_dir)
 print("Python path:", sys.path)
 
-# import the agent modules
-from agents.text_agent import process_text_complaint
-from agents.voice_agent import process_voice_complaint
-from agents.image_agent import process_image_complaint
-from agents.video_agent import process_video_complaint
-from aggregator.tasks import process_complaint
+# Agents are loaded by the workers on first use, the app only enqueues jobs
+from aggregator.tasks import (process_complaint, process_complaint_batch, collect_batch_result, release_batch_results,
+                              store_complaint)
+from agents.resources import resources
+from agents.blob_store import blob_store, is_blob_ref, BlobTooLarge
+from agents.complaint_options import validate_options
+from collectors import (ResultCacheCollector, LocalClassifierCollector, ResourcePoolCollector, QueueCollector,
+                        PipelineCollector, SearchCacheCollector, DedupCollector)
+from queues import MODALITIES, get_queue, enqueue_complaint
+from persistence import persisted_result
+from dedup import duplicate_clusters, duplicate_cluster, dedup_report
+from search import parse_search_args, search_complaints as run_search
+from notifications import (JobEventHub, SSE_MAX_JOBS, job_statuses, notify_job_failed, notify_job_finished,
+                           stream_job_events)
 
 
 def create_app():
     app = Flask(__name__)
     CORS(app)
 
-    redis_conn = Redis(host=os.environ.get('REDIS_HOST', 'localhost'), port=int(os.environ.get('REDIS_PORT', 6379)))
-    queue = Queue(connection=redis_conn)
+    # One pooled Redis client for the queues, job lookups and persistence results
+    redis_conn = resources.redis
 
 
     # Distributed tracing
@@ -59,6 +70,13 @@ def create_app():
 
     # Prometheus metrics
     metrics = PrometheusMetrics(app)
+    REGISTRY.register(ResultCacheCollector(redis_conn))
+    REGISTRY.register(LocalClassifierCollector(redis_conn))
+    REGISTRY.register(ResourcePoolCollector(resources))
+    REGISTRY.register(QueueCollector(redis_conn))
+    REGISTRY.register(PipelineCollector(redis_conn))
+    REGISTRY.register(SearchCacheCollector(redis_conn))
+    REGISTRY.register(DedupCollector(redis_conn))
 
     # Logging
     logging.basicConfig(level=logging.INFO)
@@ -116,23 +134,6 @@ def create_app():
         logger.info("Database setup completed.")
         return engine, Session, Complaint
 
-    def setup_elasticsearch():
-        if not es.indices.exists(index="complaints"):
-            es.indices.create(index="complaints", body={
-                "settings": {
-                    "number_of_shards": 1,
-                    "number_of_replicas": 0
-                },
-                "mappings": {
-                    "properties": {
-                        "type": {"type": "keyword"},
-                        "content": {"type": "text"},
-                        "category": {"type": "keyword"}
-                    }
-                }
-            })
-        logger.info("Elasticsearch index 'complaints' setup completed.")
-
     # Run database setup before first request
     with app.app_context():
         # engine, Session, Complaint = setup_database()
@@ -141,21 +142,107 @@ def create_app():
             engine, Session, Complaint = setup_database()
 
         # Initialize Elasticsearch
-        es = Elasticsearch([os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')])
-
-        # Initialize Redis and RQ
-        redis_conn = Redis(host=os.environ.get('REDIS_HOST', 'localhost'),
-                        port=int(os.environ.get('REDIS_PORT', 6379)))
-        task_queue = Queue(connection=redis_conn)
+        es = resources.elasticsearch
 
     # send complaints 
     @app.route('/api/complaints', methods=['POST'])
     @metrics.counter('api_complaints_received', 'Number of complaints received via API')
     def submit_complaint():
         data = request.json
-        job = queue.enqueue(process_complaint, data)
+        if not isinstance(data, dict) or data.get('type') not in MODALITIES:
+            return jsonify({'status': 'error', 'message': f"type must be one of {', '.join(MODALITIES)}"}), 400
+        if is_blob_ref(data.get('content')) and not blob_store.exists(data['content']['blob']):
+            return jsonify({'status': 'error', 'message': 'Unknown blob'}), 400
+        try:
+            validate_options(data['type'], data.get('options', {}))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        # Each modality has its own queue and worker pool
+        job = enqueue_complaint(redis_conn, process_complaint, data)
         return jsonify({'status': 'processing', 'job_id': job.id}), 202
 
+    @app.route('/api/complaints/upload', methods=['POST', 'PUT'])
+    @metrics.counter('api_media_uploads_received', 'Number of media complaints uploaded')
+    def upload_complaint():
+        # Streams the media to the blob store, the job only carries its reference.
+        # The body is either the raw media (chunked transfer encoding works) or multipart with a 'file' part.
+        complaint_type = request.args.get('type') or request.form.get('type')
+        if complaint_type not in ('voice', 'image', 'video'):
+            return jsonify({'status': 'error', 'message': 'type must be one of voice, image, video'}), 400
+        options = {}
+        # ?skip=denoise,contrast turns image preprocessing stages off for this upload
+        skip = [stage for stage in request.args.get('skip', '').split(',') if stage]
+        if skip:
+            options['preprocess'] = {stage: False for stage in skip}
+        # ?video_analysis=full annotates the whole video instead of its keyframes
+        if request.args.get('video_analysis'):
+            options['video_analysis'] = request.args['video_analysis']
+        # Checked before the upload is streamed, so a bad request does not leave a blob behind
+        try:
+            validate_options(complaint_type, options)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({'status': 'error', 'message': "Missing 'file' part"}), 400
+            stream = upload.stream
+        else:
+            stream = request.stream
+
+        try:
+            ref = blob_store.write_stream(stream)
+        except BlobTooLarge as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 413
+        if ref['size'] == 0:
+            return jsonify({'status': 'error', 'message': 'Empty upload'}), 400
+
+        data = {'type': complaint_type, 'content': ref}
+        if options:
+            data['options'] = options
+        job = enqueue_complaint(redis_conn, process_complaint, data)
+        return jsonify({'status': 'processing', 'job_id': job.id, 'blob': ref['blob'], 'size': ref['size']}), 202
+
+    @app.route('/api/complaints/batch', methods=['POST'])
+    @metrics.counter('api_complaint_batches_received', 'Number of complaint batches received via API')
+    def submit_complaint_batch():
+        # All text, or all images uploaded beforehand and referenced by blob (backfills)
+        body = request.get_json(silent=True)
+        complaints = (body.get('complaints') if isinstance(body, dict) else None) or []
+        if not isinstance(complaints, list) or not all(isinstance(c, dict) for c in complaints):
+            complaint_type = None
+        else:
+            complaint_type = complaints[0].get('type') if complaints else None
+        if complaint_type == 'text':
+            valid = all(c.get('type') == 'text' and isinstance(c.get('content'), str) for c in complaints)
+        elif complaint_type == 'image':
+            valid = all(c.get('type') == 'image' and is_blob_ref(c.get('content'))
+                        and blob_store.exists(c['content']['blob']) for c in complaints)
+        else:
+            valid = False
+        if not valid:
+            return jsonify({'status': 'error',
+                            'message': 'Expected a non-empty list of text complaints or of uploaded images'}), 400
+
+        queue = get_queue(complaint_type, redis_conn)
+        batch_job_ids, job_ids = [], []
+        job_size = TEXT_BATCH_JOB_SIZE if complaint_type == 'text' else IMAGE_BATCH_JOB_SIZE
+        for offset in range(0, len(complaints), job_size):
+            chunk = complaints[offset:offset + job_size]
+            # Saved but not queued yet: every dependent has to be registered before a worker can
+            # finish or fail the batch, or a dependent added after that stays deferred for good
+            batch_job = queue.create_job(process_complaint_batch, args=(chunk, complaint_type), timeout=3600,
+                                         status=JobStatus.DEFERRED, on_failure=release_batch_results)
+            batch_job.save()
+            batch_job_ids.append(batch_job.id)
+            # One lightweight job per complaint so results can be fetched by job ID as usual
+            for index in range(len(chunk)):
+                job = queue.enqueue(collect_batch_result, batch_job.id, index, depends_on=batch_job,
+                                    on_success=notify_job_finished, on_failure=notify_job_failed)
+                job_ids.append(job.id)
+            queue.enqueue_job(batch_job)
+        return jsonify({'status': 'processing', 'job_ids': job_ids, 'batch_job_ids': batch_job_ids}), 202
+
     # Modify get_complaint_result route
     @app.route('/api/complaints/<job_id>', methods=['GET'])
     def get_complaint_result(job_id):
@@ -163,10 +250,23 @@ def create_app():
             job = Job.fetch(job_id, connection=redis_conn)
             if job.is_finished:
                 result = job.result
+                # Write-behind persistence assigns the complaint ID after the job finished
+                if isinstance(result, dict) and result.get('complaint_id') is None and result.get('record_id') \
+                        and not result.get('error'):
+                    stored = persisted_result(redis_conn, result['record_id'])
+                    if stored.get('complaint_id'):
+                        result['complaint_id'] = int(stored['complaint_id'])
+                    result['persistence'] = stored.get('status', 'persisting')
                 return jsonify({
                     'status': 'completed',
                     'result': result
                 })
+            elif job.is_failed:
+                # e.g. a complaint of a batch whose batch job failed, with the last line of the traceback
+                return jsonify({
+                    'status': 'failed',
+                    'error': (job.exc_info or 'Job failed').strip().splitlines()[-1]
+                })
             else:
                 return jsonify({
                     'status': 'processing',
@@ -181,32 +281,129 @@ def create_app():
                 'error': str(e)
             }), 500
 
-        
+    def requested_job_ids():
+        # ?job_ids=a,b,c or {"job_ids": [...]}, duplicates removed in order
+        if request.method == 'POST':
+            job_ids = (request.get_json(silent=True) or {}).get('job_ids') or []
+        else:
+            job_ids = [job_id for job_id in request.args.get('job_ids', '').split(',') if job_id]
+        if not isinstance(job_ids, list) or not all(isinstance(job_id, str) for job_id in job_ids):
+            return None
+        return list(dict.fromkeys(job_ids))
+
+    @app.route('/api/complaints/status', methods=['GET', 'POST'])
+    def bulk_complaint_status():
+        # Any number of jobs in one pipelined Redis round trip, instead of one poll per job
+        job_ids = requested_job_ids()
+        if not job_ids:
+            return jsonify({'status': 'error', 'message': 'Expected a non-empty list of job_ids'}), 400
+        return jsonify({'jobs': job_statuses(redis_conn, job_ids)})
+
+    def job_event_stream(job_ids):
+        # One pub/sub subscription per app process, shared by every open stream
+        hub = resources.client('job_event_hub', lambda: JobEventHub(redis_conn))
+        # Streams hold a thread each, the rest of the API keeps the others
+        if not hub.open_stream():
+            return jsonify({'status': 'error', 'message': 'Too many open event streams, poll '
+                                                          '/api/complaints/status instead'}), 503, {'Retry-After': '5'}
+        response = Response(stream_with_context(stream_job_events(redis_conn, hub, job_ids)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Called by the server when the stream ends or the client goes away, even before it started
+        response.call_on_close(hub.close_stream)
+        return response
+
+    @app.route('/api/complaints/events', methods=['GET', 'POST'])
+    def complaint_events():
+        # Server-Sent Events for many jobs: one event per job when it completes or fails
+        job_ids = requested_job_ids()
+        if not job_ids or len(job_ids) > SSE_MAX_JOBS:
+            return jsonify({'status': 'error',
+                            'message': f"Expected between 1 and {SSE_MAX_JOBS} job_ids"}), 400
+        return job_event_stream(job_ids)
+
+    @app.route('/api/complaints/<job_id>/events', methods=['GET'])
+    def complaint_job_events(job_id):
+        return job_event_stream([job_id])
+
     @app.route('/aggregate', methods=['POST'])
     @metrics.counter('complaints_received', 'Number of complaints received')
     def aggregate_complaint():
         data = request.json
-        job = queue.enqueue(process_complaint, data)
+        if not isinstance(data, dict) or data.get('type') not in MODALITIES:
+            return jsonify({'status': 'error', 'message': f"type must be one of {', '.join(MODALITIES)}"}), 400
+        # Already analyzed by a remote agent (AGENT_DELIVERY=http), only stored
+        job = enqueue_complaint(redis_conn, store_complaint, data)
         return jsonify({'status': 'processing', 'job_id': job.id}), 202
 
     @app.route('/search', methods=['GET'])
+    @app.route('/api/complaints/search', methods=['GET'])
     @metrics.counter('complaints_searched', 'Number of complaint searches')
     def search_complaints():
-        query = request.args.get('q', '')
+        # ?q=&type=&category=&from=&to=&size=&cursor=&fields=&aggs=&interval=&sort=
+        try:
+            params = parse_search_args(request.args)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         try:
-            results = es.search(index='complaints', body={
-                'query': {
-                    'multi_match': {
-                        'query': query,
-                        'fields': ['content', 'category']
-                    }
-                }
-            })
-            return jsonify(results['hits']['hits'])
+            return jsonify(run_search(es, redis_conn, params))
+        except RequestError as e:
+            return jsonify({'status': 'error', 'message': f"Invalid search: {e.error}"}), 400
         except Exception as e:
             logger.error(f"Error searching complaints: {str(e)}")
             return jsonify({'error': 'An error occurred while searching'}), 500
 
+    @app.route('/search/similar', methods=['GET'])
+    @app.route('/api/complaints/similar', methods=['GET'])
+    @metrics.counter('complaints_similarity_searched', 'Number of complaint similarity searches')
+    def search_similar_complaints():
+        # ?q= or ?complaint_id=, &k=&probes=&fields=&hydrate=
+        # numpy, the vector index and the embedding model are loaded on the first request
+        from vector_index import parse_similar_args, similar_complaints
+        try:
+            params = parse_similar_args(request.args)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        try:
+            return jsonify(similar_complaints(es, params))
+        except LookupError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 404
+        except Exception as e:
+            logger.error(f"Error searching similar complaints: {str(e)}")
+            return jsonify({'error': 'An error occurred while searching'}), 500
+
+    @app.route('/api/complaints/duplicates', methods=['GET'])
+    def list_duplicate_clusters():
+        # ?limit=&offset=, largest near-duplicate clusters first
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'limit and offset must be integers'}), 400
+        return jsonify(duplicate_clusters(redis_conn, limit, offset))
+
+    @app.route('/api/complaints/duplicates/report', methods=['GET'])
+    def duplicates_report():
+        # ?days=, analyses skipped per day
+        try:
+            days = min(max(int(request.args.get('days', 7)), 1), 90)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'days must be an integer'}), 400
+        return jsonify({'days': dedup_report(redis_conn, days)})
+
+    @app.route('/api/complaints/duplicates/<canonical_id>', methods=['GET'])
+    def get_duplicate_cluster(canonical_id):
+        # The canonical complaint, by the job ID it was submitted under, and its duplicates
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'limit and offset must be integers'}), 400
+        cluster = duplicate_cluster(redis_conn, canonical_id, limit, offset)
+        if cluster is None:
+            return jsonify({'status': 'error', 'message': f"No duplicate cluster {canonical_id}"}), 404
+        return jsonify(cluster)
+
     @app.route('/status/<job_id>')
     def task_status(job_id):
         job = Job.fetch(job_id, connection=redis_conn)
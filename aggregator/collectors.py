@@ -0,0 +1,203 @@
+# aggregator/collectors.py
+
+import logging
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from redis import RedisError
+from rq import Worker
+from rq.registry import StartedJobRegistry
+from agents.result_cache import CACHE_STATS_KEY
+from agents.classification_stats import STATS_KEY as CLASSIFIER_STATS_KEY
+from agents.delivery import pipeline_report
+from search import SEARCH_CACHE_STATS_KEY
+from dedup import DEDUP_STATS_KEY
+from queues import MODALITIES, QUEUE_STATS_KEY, get_queue, oldest_job_age
+
+logger = logging.getLogger(__name__)
+
+# Agents run in RQ workers, so their counters live in Redis and are exposed
+# here through the registry that PrometheusMetrics serves on /metrics.
+
+class ResultCacheCollector:
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        hits = CounterMetricFamily('complaint_result_cache_hits', 'Agent analyses served from the result cache',
+                                   labels=['modality', 'tier'])
+        misses = CounterMetricFamily('complaint_result_cache_misses', 'Agent analyses not found in the result cache',
+                                     labels=['modality'])
+        try:
+            stats = self.redis_conn.hgetall(CACHE_STATS_KEY)
+        except RedisError as e:
+            logger.warning(f"Could not read result cache stats: {str(e)}")
+            stats = {}
+        for field, value in stats.items():
+            modality, outcome = field.decode().split(':', 1)
+            if outcome == 'miss':
+                misses.add_metric([modality], int(value))
+            elif outcome.startswith('hit_'):
+                hits.add_metric([modality, outcome[len('hit_'):]], int(value))
+        yield hits
+        yield misses
+
+
+class LocalClassifierCollector:
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        classified = CounterMetricFamily('complaint_issue_classifications', 'Issue/sub-issue classifications by source',
+                                         labels=['source'])
+        seconds = CounterMetricFamily('complaint_issue_classification_seconds',
+                                      'Time spent classifying issue/sub-issue by source', labels=['source'])
+        try:
+            stats = {field.decode(): float(value) for field, value in self.redis_conn.hgetall(CLASSIFIER_STATS_KEY).items()}
+        except RedisError as e:
+            logger.warning(f"Could not read local classifier stats: {str(e)}")
+            stats = {}
+        for source in ('local', 'llm'):
+            classified.add_metric([source], stats.get(f"{source}_count", 0.0))
+            seconds.add_metric([source], stats.get(f"{source}_seconds", 0.0))
+        yield classified
+        yield seconds
+
+        local_count, llm_count = stats.get('local_count', 0.0), stats.get('llm_count', 0.0)
+        total = local_count + llm_count
+        mean_llm = stats.get('llm_seconds', 0.0) / llm_count if llm_count else 0.0
+        fraction = GaugeMetricFamily('complaint_issue_local_fraction', 'Fraction of classifications served locally')
+        fraction.add_metric([], local_count / total if total else 0.0)
+        saved = GaugeMetricFamily('complaint_issue_local_seconds_saved',
+                                  'Estimated LLM latency avoided by the local classifier')
+        saved.add_metric([], max(0.0, local_count * mean_llm - stats.get('local_seconds', 0.0)))
+        yield fraction
+        yield saved
+
+
+class ResourcePoolCollector:
+    # Pools are per process, so this reports the pools of the process serving /metrics
+    def __init__(self, resources):
+        self.resources = resources
+
+    def collect(self):
+        labels = ['pool', 'target']
+        in_use = GaugeMetricFamily('complaint_pool_connections_in_use', 'Pooled connections checked out', labels=labels)
+        idle = GaugeMetricFamily('complaint_pool_connections_idle', 'Pooled connections open and idle', labels=labels)
+        limit = GaugeMetricFamily('complaint_pool_connections_max', 'Maximum pooled connections', labels=labels)
+        utilization = GaugeMetricFamily('complaint_pool_utilization', 'Checked out connections over the pool limit',
+                                        labels=labels)
+        try:
+            stats = self.resources.pool_stats()
+        except Exception as e:
+            logger.warning(f"Could not read connection pool stats: {str(e)}")
+            stats = []
+        for pool, target, used, available, maximum in stats:
+            in_use.add_metric([pool, target], used)
+            idle.add_metric([pool, target], available)
+            limit.add_metric([pool, target], maximum)
+            utilization.add_metric([pool, target], used / maximum if maximum else 0.0)
+        yield in_use
+        yield idle
+        yield limit
+        yield utilization
+
+
+class QueueCollector:
+    # Per-modality queue depth, head-of-line age, busy workers and wait time, for autoscaling each pool
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        depth = GaugeMetricFamily('complaint_queue_depth', 'Jobs waiting in the queue', labels=['modality'])
+        age = GaugeMetricFamily('complaint_queue_oldest_job_age_seconds', 'Time the oldest waiting job has waited',
+                                labels=['modality'])
+        running = GaugeMetricFamily('complaint_queue_running_jobs', 'Jobs being processed', labels=['modality'])
+        workers = GaugeMetricFamily('complaint_queue_workers', 'Workers subscribed to the queue', labels=['modality'])
+        started = CounterMetricFamily('complaint_queue_jobs_started', 'Jobs taken off the queue', labels=['modality'])
+        waited = CounterMetricFamily('complaint_queue_wait_seconds', 'Time jobs spent waiting in the queue',
+                                     labels=['modality'])
+        try:
+            stats = {field.decode(): float(value) for field, value in self.redis_conn.hgetall(QUEUE_STATS_KEY).items()}
+            for modality in MODALITIES:
+                queue = get_queue(modality, self.redis_conn)
+                depth.add_metric([modality], queue.count)
+                age.add_metric([modality], oldest_job_age(queue))
+                running.add_metric([modality], StartedJobRegistry(queue=queue).count)
+                workers.add_metric([modality], Worker.count(queue=queue))
+                started.add_metric([modality], stats.get(f"{modality}:started", 0.0))
+                waited.add_metric([modality], stats.get(f"{modality}:wait_seconds", 0.0))
+        except RedisError as e:
+            logger.warning(f"Could not read queue stats: {str(e)}")
+        yield depth
+        yield age
+        yield running
+        yield workers
+        yield started
+        yield waited
+
+
+class PipelineCollector:
+    # Complaints analyzed, agent HTTP hops, jobs enqueued and agent time per modality.
+    # With in-process delivery hops stay at 0 and jobs equal complaints.
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        complaints = CounterMetricFamily('complaint_pipeline_complaints', 'Complaints analyzed by an agent',
+                                         labels=['modality'])
+        hops = CounterMetricFamily('complaint_pipeline_http_hops', 'Agent results posted back to /aggregate',
+                                   labels=['modality'])
+        jobs = CounterMetricFamily('complaint_pipeline_jobs', 'Complaint jobs enqueued', labels=['modality'])
+        seconds = CounterMetricFamily('complaint_pipeline_agent_seconds', 'Time spent in agents',
+                                      labels=['modality'])
+        try:
+            report = pipeline_report(self.redis_conn)
+            for modality in MODALITIES:
+                stats = report.get(modality, {})
+                complaints.add_metric([modality], stats.get('complaints', 0.0))
+                hops.add_metric([modality], stats.get('http_hops', 0.0))
+                jobs.add_metric([modality], stats.get('jobs', 0.0))
+                seconds.add_metric([modality], stats.get('seconds', 0.0))
+        except RedisError as e:
+            logger.warning(f"Could not read pipeline stats: {str(e)}")
+        yield complaints
+        yield hops
+        yield jobs
+        yield seconds
+
+
+class SearchCacheCollector:
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        lookups = CounterMetricFamily('complaint_search_cache_lookups', 'Search requests by result cache outcome',
+                                      labels=['outcome'])
+        try:
+            stats = {field.decode(): int(value) for field, value in self.redis_conn.hgetall(SEARCH_CACHE_STATS_KEY).items()}
+        except RedisError as e:
+            logger.warning(f"Could not read search cache stats: {str(e)}")
+            stats = {}
+        for outcome in ('hit', 'miss'):
+            lookups.add_metric([outcome], stats.get(outcome, 0))
+        yield lookups
+
+
+class DedupCollector:
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def collect(self):
+        checked = CounterMetricFamily('complaint_dedup_checked', 'Text complaints checked for near-duplicates',
+                                      labels=['outcome'])
+        saved = CounterMetricFamily('complaint_dedup_agent_seconds_saved',
+                                    'Agent seconds skipped by reusing canonical analyses')
+        try:
+            stats = {field.decode(): float(value) for field, value in self.redis_conn.hgetall(DEDUP_STATS_KEY).items()}
+        except RedisError as e:
+            logger.warning(f"Could not read dedup stats: {str(e)}")
+            stats = {}
+        for outcome in ('canonical', 'duplicates', 'wait_timeouts'):
+            checked.add_metric([outcome], stats.get(outcome, 0.0))
+        saved.add_metric([], stats.get('seconds_saved', 0.0))
+        yield checked
+        yield saved
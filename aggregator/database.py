@@ -1,37 +1,64 @@
 # aggregator/database.py
 
-import os
-from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime
+import logging
+import threading
+from sqlalchemy import Column, BigInteger, String, DateTime
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from elasticsearch import Elasticsearch
-from datetime import datetime
+from datetime import datetime, timezone
+from agents.resources import resources
+from schema import SCHEMA_VERSION, migrate, schema_version
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 class Complaint(Base):
+    # Mirrors the table managed by schema.py: monthly range partitions on created_at,
+    # so the primary key includes it
     __tablename__ = 'complaints'
+    # Indexes and partitions are created by the migrations
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
 
-    id = Column(Integer, primary_key=True)
+    id = Column(BigInteger, primary_key=True)
+    # Job or batch item ID, unique with created_at so retried writes are no-ops
+    record_id = Column(String(128))
     type = Column(String(50), nullable=False)
-    content = Column(JSON, nullable=False)
+    content = Column(JSONB, nullable=False)
     category = Column(String(100), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), primary_key=True, default=lambda: datetime.now(timezone.utc))
 
 def setup_database():
-    db_user = os.environ.get('POSTGRES_USER', 'postgres')
-    db_pass = os.environ.get('POSTGRES_PASSWORD', 'postgres')
-    db_host = os.environ.get('POSTGRES_HOST', 'localhost')
-    db_port = os.environ.get('POSTGRES_PORT', '5433')
-    db_name = 'complaints'
-    db_url = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-
-    engine = create_engine(db_url)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    Base.metadata.create_all(bind=engine)
+    # Pool size, overflow and pre-ping are configured in agents/resources.py.
+    # The schema comes from the migrations in schema.py, not create_all.
+    engine = resources.engine
+    SessionLocal = resources.session_factory
+    conn = engine.raw_connection()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
 
     return engine, SessionLocal
 
-engine, SessionLocal = setup_database()
+_schema_lock = threading.Lock()
+_schema_ready = False
 
-es = Elasticsearch([os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')])
\ No newline at end of file
+def ensure_schema():
+    # Migrations run once per deploy (`python schema.py migrate`, done by the entrypoint), not on the
+    # write path. This only checks the version, once per process and without the migration lock;
+    # workers check before forking, so work horses inherit the result. A database that was never
+    # migrated, e.g. a fresh development setup, is migrated here.
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn = resources.engine.raw_connection()
+        try:
+            if schema_version(conn) < SCHEMA_VERSION:
+                logger.warning("Complaints schema is not migrated, migrating now. Run `python schema.py migrate` "
+                               "at deploy instead.")
+                migrate(conn)
+        finally:
+            conn.close()
+        _schema_ready = True
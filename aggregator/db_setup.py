@@ -1,6 +1,7 @@
 import os
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from schema import migrate
 
 def setup_database():
     # Get database configuration from environment variables
@@ -39,21 +40,9 @@ def setup_database():
         password=db_pass,
         host=db_host
     )
-    cur = conn.cursor()
-
-    # Create tables
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS complaints (
-            id SERIAL PRIMARY KEY,
-            type VARCHAR(50) NOT NULL,
-            content JSONB NOT NULL,
-            category VARCHAR(100) NOT NULL,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
 
-    conn.commit()
-    cur.close()
+    # Partitioned table, indexes and upcoming partitions; converts an existing unpartitioned table
+    migrate(conn)
     conn.close()
 
     print("Database setup completed.")
@@ -0,0 +1,449 @@
+# aggregator/dedup.py
+#
+# Near-duplicate detection for text complaints, in front of the agents.
+# Campaign floods send thousands of copies of one template with small edits;
+# only the first (the canonical complaint) is analyzed, the others reuse its
+# analysis and are linked to it. Each text gets a MinHash signature over its
+# word shingles. Signatures are split into DEDUP_BANDS bands and every
+# canonical complaint is listed in Redis under the hash of each band (LSH), so
+# a lookup reads a handful of sets instead of comparing against every
+# complaint. Candidates that share a band are confirmed on the estimated
+# Jaccard similarity of the full signatures.
+#
+#   python dedup.py report [--days 7]
+#   python dedup.py clusters [--limit 20]
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+from redis import RedisError
+from agents.resources import resources
+from agents.result_cache import normalize_text
+from agents.entity_extraction import extract_entities_local
+from persistence import RESULT_KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+DEDUP_NUM_PERM = int(os.environ.get('DEDUP_NUM_PERM', 128))
+# 16 bands of 8 rows find texts with a Jaccard similarity of 0.8 about 95% of the time
+DEDUP_BANDS = int(os.environ.get('DEDUP_BANDS', 16))
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', 0.8))
+DEDUP_SHINGLE_WORDS = int(os.environ.get('DEDUP_SHINGLE_WORDS', 3))
+# Short texts share too many shingles by chance, identical ones are served by the result cache
+DEDUP_MIN_WORDS = int(os.environ.get('DEDUP_MIN_WORDS', 8))
+# How long a duplicate waits for the analysis of a canonical complaint that is still running
+DEDUP_WAIT_SECONDS = float(os.environ.get('DEDUP_WAIT_SECONDS', 30))
+# A canonical complaint whose analysis is not published within this stops matching, so a job
+# that died without releasing it does not hold its cluster
+DEDUP_PENDING_SECONDS = int(os.environ.get('DEDUP_PENDING_SECONDS', 4 * DEDUP_WAIT_SECONDS))
+# Canonical complaints stop matching this long after their last duplicate
+DEDUP_WINDOW_DAYS = int(os.environ.get('DEDUP_WINDOW_DAYS', 14))
+DEDUP_REPORT_DAYS = int(os.environ.get('DEDUP_REPORT_DAYS', 90))
+
+KEY_PREFIX = 'dedup:'
+CLUSTERS_KEY = 'dedup:clusters'
+DEDUP_STATS_KEY = 'dedup:stats'
+WAIT_POLL_SECONDS = 0.2
+# Lookups repeated when complaints of the same cluster are claimed concurrently
+CLAIM_ATTEMPTS = 3
+
+# Lists a complaint as canonical under its bands, unless a band gained a member the caller has not
+# compared against since its lookup, in which case those members are returned and nothing is written.
+# KEYS: signature, canonical hash, bands. ARGV: record ID, signature, pending TTL, now, window, compared IDs.
+CLAIM_SCRIPT = """
+local compared = {}
+for i = 6, #ARGV do compared[ARGV[i]] = true end
+local unseen = {}
+for i = 3, #KEYS do
+    for _, member in ipairs(redis.call('SMEMBERS', KEYS[i])) do
+        if not compared[member] then
+            compared[member] = true
+            table.insert(unseen, member)
+        end
+    end
+end
+if #unseen > 0 then return unseen end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('HSET', KEYS[2], 'status', 'pending', 'first_seen', ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+for i = 3, #KEYS do
+    redis.call('SADD', KEYS[i], ARGV[1])
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return {}
+"""
+
+_permutations = None
+
+def _key(*parts):
+    return KEY_PREFIX + ':'.join(str(part) for part in parts)
+
+def _window():
+    return DEDUP_WINDOW_DAYS * 24 * 3600
+
+def shingles(text):
+    words = normalize_text(text).split()
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    return {' '.join(words[i:i + DEDUP_SHINGLE_WORDS]) for i in range(len(words) - DEDUP_SHINGLE_WORDS + 1)}
+
+def signature(text):
+    # DEDUP_NUM_PERM minimums of multiply-shift hashes of the shingles, or None for short texts.
+    # numpy is imported on first use, the app only reads clusters and reports.
+    import numpy as np
+
+    global _permutations
+    words = shingles(text)
+    if not words:
+        return None
+    if _permutations is None:
+        # Fixed seed: every process must hash with the same permutations
+        rng = np.random.default_rng(20240601)
+        _permutations = (rng.integers(0, 2 ** 64, DEDUP_NUM_PERM, dtype=np.uint64) | np.uint64(1),
+                         rng.integers(0, 2 ** 64, DEDUP_NUM_PERM, dtype=np.uint64))
+    a, b = _permutations
+    hashed = np.array([int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+                       for word in words], dtype=np.uint64)
+    # uint64 arithmetic wraps, the high 32 bits of a*x + b are a universal hash of x
+    return ((a[:, None] * hashed[None, :] + b[:, None]) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+def band_keys(modality, sig):
+    rows = len(sig) // DEDUP_BANDS
+    return [_key('band', modality, band, hashlib.blake2b(sig[band * rows:(band + 1) * rows].tobytes(),
+                                                         digest_size=8).hexdigest())
+            for band in range(DEDUP_BANDS)]
+
+def similarity(sig, other):
+    # Fraction of equal minimums, an unbiased estimate of the Jaccard similarity of the shingles
+    return float((sig == other).mean())
+
+
+def _count(redis_conn, **counters):
+    # Running totals for /metrics plus one hash per UTC day for the report
+    daily = _key('daily', datetime.now(timezone.utc).date().isoformat())
+    pipe = redis_conn.pipeline(transaction=False)
+    for name, value in counters.items():
+        for key in (DEDUP_STATS_KEY, daily):
+            if isinstance(value, int):
+                pipe.hincrby(key, name, value)
+            else:
+                pipe.hincrbyfloat(key, name, value)
+    pipe.expire(daily, DEDUP_REPORT_DAYS * 24 * 3600)
+    pipe.execute()
+
+
+class Claim:
+    # Outcome of the lookup for one complaint. `analysis` is set for a duplicate whose canonical
+    # analysis is ready; a complaint without a near-duplicate becomes a canonical one.
+    def __init__(self, redis_conn, modality, record_id, sig, bands, canonical_id=None, score=None, analysis=None):
+        self.redis_conn = redis_conn
+        self.modality = modality
+        self.record_id = record_id
+        self.sig = sig
+        self.bands = bands
+        self.canonical_id = canonical_id
+        self.score = score
+        self.analysis = analysis
+
+    @property
+    def canonical(self):
+        return self.canonical_id is None
+
+    def publish(self, processed_data, seconds):
+        # The analysis of a canonical complaint, for its duplicates
+        if not self.canonical:
+            return
+        try:
+            key = _key('canonical', self.record_id)
+            pipe = self.redis_conn.pipeline()
+            pipe.hset(key, mapping={'status': 'ready', 'category': processed_data.get('category') or '',
+                                    'content': json.dumps(processed_data.get('content')), 'seconds': seconds})
+            # Pending entries only live DEDUP_PENDING_SECONDS, an analyzed one matches for the window.
+            # The bands are listed again in case a duplicate that gave up waiting took them over.
+            pipe.expire(key, _window())
+            pipe.set(_key('sig', self.record_id), self.sig.tobytes(), ex=_window())
+            for band in self.bands:
+                pipe.sadd(band, self.record_id)
+                pipe.expire(band, _window())
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Could not publish canonical analysis of {self.record_id}: {str(e)}")
+
+    def release(self):
+        # The canonical complaint was not analyzed here: waiting duplicates analyze themselves
+        if not self.canonical:
+            return
+        try:
+            pipe = self.redis_conn.pipeline()
+            for band in self.bands:
+                pipe.srem(band, self.record_id)
+            pipe.delete(_key('sig', self.record_id), _key('canonical', self.record_id))
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Could not release canonical complaint {self.record_id}: {str(e)}")
+
+    def stored(self, complaint_id):
+        # Complaint IDs are only known after the insert, None until a write-behind flush
+        if complaint_id is None:
+            return
+        key = _key('canonical', self.record_id) if self.canonical else _key('member', self.record_id)
+        try:
+            self.redis_conn.hset(key, 'complaint_id', complaint_id)
+        except RedisError as e:
+            logger.warning(f"Could not record complaint ID of {self.record_id}: {str(e)}")
+
+
+def _candidates(redis_conn, bands):
+    # Canonical complaints sharing at least one band with a signature
+    pipe = redis_conn.pipeline(transaction=False)
+    for band in bands:
+        pipe.smembers(band)
+    return {member.decode() for member in set().union(*pipe.execute())}
+
+def _best(redis_conn, sig, candidates):
+    # (canonical ID, similarity, its signature) of the most similar candidate, the ID None below
+    # DEDUP_THRESHOLD. Candidates whose signature expired are skipped.
+    import numpy as np
+
+    candidates = sorted(candidates)
+    if not candidates:
+        return None, 0.0, None
+    pipe = redis_conn.pipeline(transaction=False)
+    for candidate in candidates:
+        pipe.get(_key('sig', candidate))
+    best, best_score, best_sig = None, 0.0, None
+    for candidate, stored in zip(candidates, pipe.execute()):
+        if stored is None:
+            continue
+        candidate_sig = np.frombuffer(stored, dtype=np.uint32)
+        score = similarity(sig, candidate_sig)
+        if score > best_score:
+            best, best_score, best_sig = candidate, score, candidate_sig
+    return (best, best_score, best_sig) if best_score >= DEDUP_THRESHOLD else (None, best_score, None)
+
+def _claim(redis_conn, record_id, sig, bands, compared):
+    # Empty when the complaint is now canonical, else the IDs claimed meanwhile to compare against
+    script = redis_conn.register_script(CLAIM_SCRIPT)
+    unseen = script(keys=[_key('sig', record_id), _key('canonical', record_id)] + bands,
+                    args=[record_id, sig.tobytes(), DEDUP_PENDING_SECONDS, time.time(), _window()] + sorted(compared))
+    return {member.decode() for member in unseen}
+
+def _retire(redis_conn, modality, canonical_id, canonical_sig):
+    # Unlists a canonical complaint that was not analyzed in time. If its job is only slow,
+    # publish() lists it again.
+    pipe = redis_conn.pipeline()
+    for band in band_keys(modality, canonical_sig):
+        pipe.srem(band, canonical_id)
+    pipe.delete(_key('sig', canonical_id))
+    pipe.execute()
+
+def _wait_for_analysis(redis_conn, canonical_id):
+    deadline = time.monotonic() + DEDUP_WAIT_SECONDS
+    while True:
+        canonical = {field.decode(): value.decode()
+                     for field, value in redis_conn.hgetall(_key('canonical', canonical_id)).items()}
+        if canonical.get('status') == 'ready' or not canonical or time.monotonic() >= deadline:
+            return canonical
+        time.sleep(WAIT_POLL_SECONDS)
+
+def _reuse(canonical, canonical_id, score, text):
+    # The canonical analysis with this complaint's own text, entities and a link to the canonical one
+    content = json.loads(canonical['content'])
+    if isinstance(content, dict):
+        content = dict(content, original_text=text)
+        if 'entities' in content:
+            content['entities'] = extract_entities_local(text)
+        content['duplicate_of'] = {'record_id': canonical_id, 'similarity': round(score, 3)}
+        if canonical.get('complaint_id'):
+            content['duplicate_of']['complaint_id'] = int(canonical['complaint_id'])
+    return {'type': 'text', 'content': content, 'category': canonical.get('category') or None}
+
+def _link(redis_conn, modality, record_id, canonical_id, canonical_sig, score):
+    now = time.time()
+    pipe = redis_conn.pipeline()
+    pipe.hset(_key('member', record_id), mapping={'canonical': canonical_id, 'similarity': score, 'seen_at': now})
+    pipe.expire(_key('member', record_id), _window())
+    pipe.zadd(_key('cluster', canonical_id), {record_id: now})
+    pipe.hincrby(_key('canonical', canonical_id), 'duplicates', 1)
+    pipe.hset(_key('canonical', canonical_id), 'last_seen', now)
+    pipe.zincrby(CLUSTERS_KEY, 1, canonical_id)
+    # The cluster stays matchable as long as duplicates keep coming
+    for key in [_key('cluster', canonical_id), _key('canonical', canonical_id), _key('sig', canonical_id)] + \
+            band_keys(modality, canonical_sig):
+        pipe.expire(key, _window())
+    pipe.execute()
+
+def check_duplicate(redis_conn, modality, content, record_id):
+    # None when the complaint is not checked (other modalities, short texts, Redis down)
+    if not DEDUP_ENABLED or modality != 'text' or not isinstance(content, str):
+        return None
+    sig = signature(content)
+    if sig is None:
+        return None
+    bands = band_keys(modality, sig)
+    try:
+        compared, took_over = set(), False
+        candidates = _candidates(redis_conn, bands)
+        for _ in range(CLAIM_ATTEMPTS):
+            canonical_id, score, canonical_sig = _best(redis_conn, sig, candidates - compared)
+            compared |= candidates
+            if canonical_id is None:
+                # Listed before it is analyzed, so a flood that arrives meanwhile waits for this one.
+                # Atomic with a last look at the bands, so concurrent copies elect one canonical.
+                candidates = _claim(redis_conn, record_id, sig, bands, compared)
+                if candidates:
+                    continue
+                _count(redis_conn, checked=1, canonical=1, wait_timeouts=int(took_over))
+                return Claim(redis_conn, modality, record_id, sig, bands)
+
+            canonical = _wait_for_analysis(redis_conn, canonical_id)
+            if canonical.get('status') == 'ready':
+                _link(redis_conn, modality, record_id, canonical_id, canonical_sig, score)
+                _count(redis_conn, checked=1, duplicates=1, seconds_saved=float(canonical.get('seconds') or 0.0))
+                logger.info(f"Complaint {record_id} is a near-duplicate of {canonical_id} (similarity {score:.2f})")
+                return Claim(redis_conn, modality, record_id, sig, bands, canonical_id, score,
+                             _reuse(canonical, canonical_id, score, content))
+
+            # Still running after DEDUP_WAIT_SECONDS, or its job died: this complaint takes its place
+            logger.info(f"Canonical complaint {canonical_id} not analyzed in time, {record_id} takes over")
+            _retire(redis_conn, modality, canonical_id, canonical_sig)
+            took_over = True
+            candidates = set()
+        _count(redis_conn, checked=1, wait_timeouts=int(took_over))
+        return None
+    except RedisError as e:
+        logger.warning(f"Near-duplicate check failed, analyzing complaint: {str(e)}")
+        return None
+
+
+def _decoded(mapping):
+    return {field.decode(): value.decode() for field, value in mapping.items()}
+
+def _canonical_summary(canonical_id, canonical, size):
+    content = json.loads(canonical['content']) if canonical.get('content') else {}
+    content = content if isinstance(content, dict) else {}
+    return {
+        'canonical_id': canonical_id,
+        'record_id': canonical_id,
+        'complaint_id': int(canonical['complaint_id']) if canonical.get('complaint_id') else None,
+        'status': canonical.get('status'),
+        'category': canonical.get('category') or None,
+        'issue': content.get('issue'),
+        'summary': content.get('summary'),
+        'duplicates': size,
+        'first_seen': canonical.get('first_seen') and _iso(canonical['first_seen']),
+        'last_seen': canonical.get('last_seen') and _iso(canonical['last_seen']),
+    }
+
+def _fill_complaint_ids(redis_conn, entries):
+    # Complaints stored by the write-behind flusher get their ID after the job, from its result
+    missing = [entry for entry in entries if entry['complaint_id'] is None]
+    if not missing:
+        return
+    pipe = redis_conn.pipeline(transaction=False)
+    for entry in missing:
+        pipe.hget(f"{RESULT_KEY_PREFIX}{entry['record_id']}", 'complaint_id')
+    for entry, complaint_id in zip(missing, pipe.execute()):
+        entry['complaint_id'] = int(complaint_id) if complaint_id else None
+
+def _iso(timestamp):
+    return datetime.fromtimestamp(float(timestamp), timezone.utc).isoformat()
+
+def duplicate_clusters(redis_conn, limit=20, offset=0):
+    # Largest clusters first. Clusters whose canonical complaint expired are dropped on the way.
+    ranked = redis_conn.zrevrange(CLUSTERS_KEY, offset, offset + limit - 1, withscores=True)
+    pipe = redis_conn.pipeline(transaction=False)
+    for canonical_id, _ in ranked:
+        pipe.hgetall(_key('canonical', canonical_id.decode()))
+    clusters, expired = [], []
+    for (canonical_id, size), canonical in zip(ranked, pipe.execute()):
+        if not canonical:
+            expired.append(canonical_id)
+            continue
+        clusters.append(_canonical_summary(canonical_id.decode(), _decoded(canonical), int(size)))
+    if expired:
+        redis_conn.zrem(CLUSTERS_KEY, *expired)
+    _fill_complaint_ids(redis_conn, clusters)
+    return {'clusters': clusters, 'total': redis_conn.zcard(CLUSTERS_KEY)}
+
+def duplicate_cluster(redis_conn, canonical_id, limit=100, offset=0):
+    # The canonical complaint and its duplicates, newest first, or None
+    canonical = _decoded(redis_conn.hgetall(_key('canonical', canonical_id)))
+    if not canonical:
+        return None
+    members = redis_conn.zrevrange(_key('cluster', canonical_id), offset, offset + limit - 1)
+    pipe = redis_conn.pipeline(transaction=False)
+    for record_id in members:
+        pipe.hgetall(_key('member', record_id.decode()))
+    duplicates = []
+    for record_id, member in zip(members, pipe.execute()):
+        member = _decoded(member)
+        duplicates.append({
+            'record_id': record_id.decode(),
+            'complaint_id': int(member['complaint_id']) if member.get('complaint_id') else None,
+            'similarity': round(float(member['similarity']), 3) if member.get('similarity') else None,
+            'seen_at': _iso(member['seen_at']) if member.get('seen_at') else None,
+        })
+    result = _canonical_summary(canonical_id, canonical, int(canonical.get('duplicates', 0)))
+    result['members'] = duplicates
+    _fill_complaint_ids(redis_conn, [result] + duplicates)
+    return result
+
+def dedup_report(redis_conn, days=7):
+    # Per UTC day, newest first: complaints checked, duplicates whose analysis was skipped and
+    # the agent time their canonical analyses took
+    today = datetime.now(timezone.utc).date()
+    dates = [(today - timedelta(days=offset)).isoformat() for offset in range(days)]
+    pipe = redis_conn.pipeline(transaction=False)
+    for date in dates:
+        pipe.hgetall(_key('daily', date))
+    report = []
+    for date, stats in zip(dates, pipe.execute()):
+        stats = {field.decode(): float(value) for field, value in stats.items()}
+        checked = stats.get('checked', 0.0)
+        report.append({
+            'date': date,
+            'checked': int(checked),
+            'canonical': int(stats.get('canonical', 0)),
+            'duplicates': int(stats.get('duplicates', 0)),
+            'duplicate_fraction': stats.get('duplicates', 0.0) / checked if checked else 0.0,
+            'agent_seconds_saved': round(stats.get('seconds_saved', 0.0), 1),
+            'wait_timeouts': int(stats.get('wait_timeouts', 0)),
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Near-duplicate complaint clusters')
+    commands = parser.add_subparsers(dest='command', required=True)
+    report_parser = commands.add_parser('report', help='Work skipped per day')
+    report_parser.add_argument('--days', type=int, default=7)
+    clusters_parser = commands.add_parser('clusters', help='Largest duplicate clusters')
+    clusters_parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    redis_conn = resources.redis
+    if args.command == 'report':
+        print(f"{'date':<12} {'checked':>8} {'duplicates':>10} {'share':>6} {'agent s saved':>14}")
+        for day in dedup_report(redis_conn, args.days):
+            print(f"{day['date']:<12} {day['checked']:>8} {day['duplicates']:>10} "
+                  f"{day['duplicate_fraction']:>6.1%} {day['agent_seconds_saved']:>14.1f}")
+    else:
+        clusters = duplicate_clusters(redis_conn, args.limit)
+        if not clusters['clusters']:
+            print('No duplicate clusters')
+            sys.exit(1)
+        for cluster in clusters['clusters']:
+            print(f"{cluster['duplicates']:>7} x {cluster['canonical_id']} {cluster['category'] or '-':<20} "
+                  f"{(cluster['summary'] or '')[:60]}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -6,11 +6,28 @@ pwd
 echo "Contents of current directory:"
 ls -la
 
-if [ "$1" = "aggregator" ]; then
+migrate() {
+    # Once per deploy: pending migrations, indexes, upcoming partitions and a check of the query plans
+    echo "Migrating the complaints schema..."
+    python schema.py migrate --check-plans
+    # Template and alias, and a dynamic-mapped 'complaints' index moved behind it. Searches still
+    # work on a legacy index, so an Elasticsearch outage does not stop the deploy.
+    echo "Setting up the search index..."
+    python search_index.py setup --migrate-legacy || echo "Search index setup failed, writers retry it on first use"
+}
+
+if [ "$1" = "migrate" ]; then
+    migrate
+elif [ "$1" = "aggregator" ]; then
+    if [ "${SCHEMA_MIGRATE_ON_START:-true}" = "true" ]; then
+        migrate
+    fi
     echo "Starting aggregator..."
+    # Every open /events stream holds a thread (at most SSE_MAX_STREAMS per worker), the
+    # remaining threads serve the rest of the API
     exec gunicorn --bind 0.0.0.0:5000 \
-              --workers 2 \
-              --threads 4 \
+              --workers "${GUNICORN_WORKERS:-2}" \
+              --threads "${GUNICORN_THREADS:-32}" \
               --worker-class gthread \
               --timeout 300 \
               --keep-alive 5 \
@@ -20,7 +37,11 @@ if [ "$1" = "aggregator" ]; then
               app:app
 elif [ "$1" = "worker" ]; then
     echo "Starting RQ worker..."
-    exec rq worker --url redis://redis:6379/0
+    # e.g. `worker --queues text --concurrency 4`
+    exec python worker.py "${@:2}"
+elif [ "$1" = "persister" ]; then
+    echo "Starting write-behind flusher..."
+    exec python persistence.py
 else
     exec "$@"
 fi
\ No newline at end of file
@@ -0,0 +1,197 @@
+# aggregator/notifications.py
+#
+# Push notifications for finished complaint jobs. Jobs are enqueued with RQ
+# success and failure callbacks that publish an event on one Redis pub/sub
+# channel. Each app process holds a single subscription and fans the events out
+# to its Server-Sent Events clients, so clients waiting on many jobs no longer
+# poll Job.fetch. Bulk status lookups resolve any number of job IDs in one
+# pipelined round trip.
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from rq.job import Job
+from redis import RedisError
+from persistence import RESULT_KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+JOB_EVENTS_CHANNEL = os.environ.get('JOB_EVENTS_CHANNEL', 'complaints:job-events')
+# Larger results are left out of events, clients fetch them with the bulk status endpoint
+NOTIFY_MAX_RESULT_BYTES = int(os.environ.get('NOTIFY_MAX_RESULT_BYTES', 64 * 1024))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', 300))
+SSE_MAX_JOBS = int(os.environ.get('SSE_MAX_JOBS', 1000))
+# Open streams per app process. Each holds a gunicorn thread for up to SSE_MAX_SECONDS, so this must
+# stay below GUNICORN_THREADS to leave threads for the rest of the API. Further streams get a 503.
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 24))
+
+TERMINAL_STATUSES = ('completed', 'failed', 'unknown')
+
+def job_event(job_id, status, result=None, error=None):
+    event = {'job_id': job_id, 'status': status}
+    if result is not None:
+        payload = json.dumps(result, default=str)
+        if len(payload) <= NOTIFY_MAX_RESULT_BYTES:
+            event['result'] = json.loads(payload)
+        else:
+            event['result_truncated'] = True
+    if error is not None:
+        event['error'] = error
+    return event
+
+def publish_job_event(connection, event):
+    try:
+        connection.publish(JOB_EVENTS_CHANNEL, json.dumps(event, default=str))
+    except RedisError as e:
+        # Subscribers fall back to their periodic status check
+        logger.warning(f"Could not publish event for job {event['job_id']}: {str(e)}")
+
+# RQ job callbacks, run by the worker right after the job function returns or raises
+def notify_job_finished(job, connection, result, *args, **kwargs):
+    publish_job_event(connection, job_event(job.id, 'completed', result=result))
+
+def notify_job_failed(job, connection, exc_type, exc_value, traceback):
+    publish_job_event(connection, job_event(job.id, 'failed', error=f"{exc_type.__name__}: {exc_value}"))
+
+def job_statuses(connection, job_ids):
+    # One event-shaped status per job ID, in order, from one pipelined HGETALL per job.
+    # Completed results still waiting for write-behind persistence take one more round trip.
+    events = []
+    for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection=connection)):
+        if job is None:
+            events.append(job_event(job_id, 'unknown'))
+            continue
+        state = job.get_status(refresh=False)
+        if state == 'finished':
+            event = job_event(job_id, 'completed', result=job.result)
+        elif state == 'failed':
+            event = job_event(job_id, 'failed', error='Job failed')
+        else:
+            event = job_event(job_id, 'processing')
+        event['state'] = state
+        events.append(event)
+
+    persisting = [event['result'] for event in events
+                  if isinstance(event.get('result'), dict) and event['result'].get('complaint_id') is None
+                  and event['result'].get('record_id')]
+    if persisting:
+        pipe = connection.pipeline(transaction=False)
+        for result in persisting:
+            pipe.hgetall(f"{RESULT_KEY_PREFIX}{result['record_id']}")
+        for result, stored in zip(persisting, pipe.execute()):
+            stored = {key.decode(): value.decode() for key, value in stored.items()}
+            if stored.get('complaint_id'):
+                result['complaint_id'] = int(stored['complaint_id'])
+            result['persistence'] = stored.get('status', 'persisting')
+    return events
+
+
+class JobEventHub:
+    # One pub/sub connection per process, events are handed to per-client queues by job ID
+    def __init__(self, connection, max_streams=SSE_MAX_STREAMS):
+        self.connection = connection
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._streams = threading.BoundedSemaphore(max_streams)
+
+    def open_stream(self):
+        # False when SSE_MAX_STREAMS streams are open in this process
+        return self._streams.acquire(blocking=False)
+
+    def close_stream(self):
+        self._streams.release()
+
+    def subscribe(self, job_ids):
+        subscriber = queue.Queue()
+        with self._lock:
+            for job_id in job_ids:
+                self._subscribers.setdefault(job_id, set()).add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='job-event-hub', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber, job_ids):
+        with self._lock:
+            for job_id in job_ids:
+                subscribers = self._subscribers.get(job_id)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[job_id]
+
+    def _dispatch(self, data):
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(event, dict):
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.get(event.get('job_id'), ()))
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def _listen(self):
+        backoff = 1.0
+        while True:
+            pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(JOB_EVENTS_CHANNEL)
+                backoff = 1.0
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message['type'] == 'message':
+                        self._dispatch(message['data'])
+            except RedisError as e:
+                # Events published meanwhile are picked up by the clients' periodic status checks
+                logger.warning(f"Job event subscription lost ({str(e)}), reconnecting in {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            except Exception as e:
+                # Anything else would end the only subscription of this process for good
+                logger.error(f"Job event hub failed ({str(e)}), resubscribing in {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                pubsub.close()
+
+
+def format_sse(event):
+    return f"event: {event['status']}\nid: {event['job_id']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+def stream_job_events(connection, hub, job_ids, heartbeat=SSE_HEARTBEAT_SECONDS, max_seconds=SSE_MAX_SECONDS):
+    # Server-Sent Events: one event per job when it completes or fails, then an 'end' event
+    pending = set(job_ids)
+    # Subscribe before looking at stored statuses, so no completion falls in between
+    subscriber = hub.subscribe(job_ids)
+    try:
+        deadline = time.monotonic() + max_seconds
+        check = True
+        while pending and time.monotonic() < deadline:
+            if check:
+                # Jobs that ended before the subscription, or whose event was lost
+                for event in job_statuses(connection, sorted(pending)):
+                    if event['status'] in TERMINAL_STATUSES:
+                        pending.discard(event['job_id'])
+                        yield format_sse(event)
+                check = False
+                continue
+            try:
+                event = subscriber.get(timeout=min(heartbeat, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                # Keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                check = True
+                continue
+            if event.get('job_id') in pending:
+                pending.discard(event['job_id'])
+                yield format_sse(event)
+        yield f"event: end\ndata: {json.dumps({'pending': sorted(pending)})}\n\n"
+    finally:
+        hub.unsubscribe(subscriber, job_ids)
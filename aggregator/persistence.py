@@ -0,0 +1,261 @@
+# aggregator/persistence.py
+#
+# Write-behind persistence. Workers stage processed complaints in a Redis list
+# and a flusher writes them in batches: one multi-row INSERT ... RETURNING into
+# Postgres and one _bulk request to Elasticsearch per flush. Staged records stay
+# in Redis until their batch is written, so a worker that stops or dies never
+# loses them. Inserts are idempotent on the record ID, so a batch written again
+# after a failure, or re-claimed from a flusher taken for dead, is stored once.
+#
+#   python persistence.py            # run a standalone flusher
+
+import os
+import json
+import time
+import signal
+import socket
+import logging
+import threading
+from datetime import datetime, timezone
+from psycopg2.extras import execute_values, Json
+from elasticsearch.helpers import streaming_bulk
+from agents.resources import resources
+from database import ensure_schema
+from schema import ensure_partitions
+from search import invalidate_search_cache
+from search_index import SEARCH_ALIAS, ensure_search_index, maybe_rollover, search_document
+
+logger = logging.getLogger(__name__)
+
+# 'direct' writes each complaint inside its job, 'write_behind' stages it for the flusher
+PERSISTENCE_MODE = os.environ.get('PERSISTENCE_MODE', 'direct')
+PERSIST_BATCH_SIZE = int(os.environ.get('PERSIST_BATCH_SIZE', 500))
+PERSIST_FLUSH_INTERVAL_MS = int(os.environ.get('PERSIST_FLUSH_INTERVAL_MS', 200))
+PERSIST_RESULT_TTL = int(os.environ.get('PERSIST_RESULT_TTL', 24 * 3600))
+
+PENDING_KEY = 'persist:pending'
+PROCESSING_KEY_PREFIX = 'persist:processing:'
+CONSUMER_KEY_PREFIX = 'persist:consumer:'
+RESULT_KEY_PREFIX = 'persist:result:'
+FAILED_KEY = 'persist:failed'
+CONSUMER_HEARTBEAT_TTL = 30
+
+def make_record(record_id, complaint_type, content, category):
+    return {
+        'record_id': record_id,
+        'type': complaint_type,
+        'content': content,
+        'category': category,
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+
+def _insert_rows(cur, records):
+    # Idempotent on (record_id, created_at), both fixed when the record is made: a batch retried
+    # after its rows were committed inserts nothing, and the rows it already wrote are looked up.
+    # Returns {record_id: (complaint_id, inserted)}.
+    rows = execute_values(
+        cur,
+        "INSERT INTO complaints (record_id, type, content, category, created_at) VALUES %s "
+        "ON CONFLICT (record_id, created_at) DO NOTHING RETURNING record_id, id",
+        [(r['record_id'], r['type'], Json(r['content']), r['category'], r['created_at']) for r in records],
+        page_size=len(records),
+        fetch=True
+    )
+    stored = {record_id: (complaint_id, True) for record_id, complaint_id in rows}
+    existing = [r['record_id'] for r in records if r['record_id'] not in stored]
+    if existing:
+        cur.execute("SELECT record_id, id FROM complaints WHERE record_id = ANY(%s)", (existing,))
+        stored.update((record_id, (complaint_id, False)) for record_id, complaint_id in cur.fetchall())
+    return stored
+
+def write_complaints(records):
+    # Returns one {'complaint_id', 'error', 'indexed'} entry per record, in order
+    results = [{'record_id': r.get('record_id'), 'complaint_id': None, 'error': None, 'indexed': False}
+               for r in records]
+    if not records:
+        return results
+
+    ensure_schema()
+    # Looked up per call so a forked work horse gets its own pool
+    conn = resources.engine.raw_connection()
+    inserted = set()
+    try:
+        # Rows of a month without a partition would land in the default partition
+        ensure_partitions(conn, {r['created_at'][:7] for r in records})
+        cur = conn.cursor()
+        try:
+            stored = _insert_rows(cur, records)
+            conn.commit()
+        except Exception as e:
+            # One bad row fails the whole statement, retry row by row to isolate it
+            conn.rollback()
+            logger.warning(f"Multi-row insert of {len(records)} complaints failed ({str(e)}), retrying per row")
+            stored = {}
+            for result, record in zip(results, records):
+                try:
+                    stored.update(_insert_rows(cur, [record]))
+                    conn.commit()
+                except Exception as row_error:
+                    conn.rollback()
+                    result['error'] = str(row_error)
+        for index, (result, record) in enumerate(zip(results, records)):
+            if record['record_id'] in stored:
+                result['complaint_id'], new = stored[record['record_id']]
+                result['error'] = None
+                if new:
+                    inserted.add(index)
+        cur.close()
+    finally:
+        conn.close()
+
+    stored = [(result, record) for result, record in zip(results, records) if result['complaint_id'] is not None]
+    # Only rows inserted by this call, a retried batch must not append its vectors twice
+    embedded = [(result['complaint_id'], record) for index, (result, record) in enumerate(zip(results, records))
+                if index in inserted and record.get('embedding')]
+    if embedded:
+        # numpy is only loaded by processes that store embedded complaints
+        from vector_index import add_complaint_vectors
+        add_complaint_vectors(resources.redis, embedded)
+
+    # Documents are indexed under the complaint ID, so indexing a retried batch again is harmless
+    actions = [{'_index': SEARCH_ALIAS, '_id': result['complaint_id'],
+                '_source': search_document(record, result['complaint_id'])}
+               for result, record in stored]
+    by_id = {str(result['complaint_id']): result for result, _ in stored}
+    if actions:
+        ensure_search_index(resources.elasticsearch)
+        maybe_rollover(resources.elasticsearch)
+    for ok, item in streaming_bulk(resources.elasticsearch, actions, raise_on_error=False, raise_on_exception=False):
+        info = item.get('index', {})
+        result = by_id.get(str(info.get('_id')))
+        if result is None:
+            continue
+        if ok:
+            result['indexed'] = True
+        else:
+            result['error'] = f"Elasticsearch: {info.get('error')}"
+    if any(result['indexed'] for result in results):
+        invalidate_search_cache(resources.redis)
+    return results
+
+def stage_complaints(redis_conn, records):
+    redis_conn.lpush(PENDING_KEY, *[json.dumps(record) for record in records])
+
+def persist_complaints(redis_conn, records):
+    if PERSISTENCE_MODE == 'write_behind':
+        stage_complaints(redis_conn, records)
+        return [{'record_id': r['record_id'], 'complaint_id': None, 'status': 'persisting'} for r in records]
+    return write_complaints(records)
+
+def persisted_result(redis_conn, record_id):
+    result = redis_conn.hgetall(f"{RESULT_KEY_PREFIX}{record_id}")
+    return {key.decode(): value.decode() for key, value in result.items()}
+
+
+class WriteBehindFlusher(threading.Thread):
+    def __init__(self, redis_conn=None, batch_size=PERSIST_BATCH_SIZE, flush_interval_ms=PERSIST_FLUSH_INTERVAL_MS):
+        super().__init__(name='write-behind-flusher', daemon=True)
+        self.redis_conn = redis_conn or resources.redis
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self.processing_key = f"{PROCESSING_KEY_PREFIX}{self.consumer}"
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _heartbeat(self):
+        self.redis_conn.set(f"{CONSUMER_KEY_PREFIX}{self.consumer}", 1, ex=CONSUMER_HEARTBEAT_TTL)
+
+    def _keep_alive(self):
+        # On its own thread, so a flush that outlasts CONSUMER_HEARTBEAT_TTL is not taken for an
+        # orphan and claimed by another flusher while it is still being written
+        while not self._stop_event.wait(CONSUMER_HEARTBEAT_TTL / 3):
+            try:
+                self._heartbeat()
+            except Exception as e:
+                logger.warning(f"Write-behind heartbeat failed: {str(e)}")
+
+    def recover_orphans(self):
+        # Batches claimed by flushers that stopped sending heartbeats go back to the pending list
+        for key in self.redis_conn.scan_iter(f"{PROCESSING_KEY_PREFIX}*"):
+            consumer = key.decode()[len(PROCESSING_KEY_PREFIX):]
+            if consumer == self.consumer or self.redis_conn.exists(f"{CONSUMER_KEY_PREFIX}{consumer}"):
+                continue
+            recovered = 0
+            while self.redis_conn.rpoplpush(key, PENDING_KEY) is not None:
+                recovered += 1
+            logger.warning(f"Recovered {recovered} staged complaints from stopped flusher {consumer}")
+
+    def claim(self):
+        # Wait for the first record, then keep claiming until the batch is full or the interval ends.
+        # Everything in the processing list is returned, including records of a failed earlier flush.
+        claimed = self.redis_conn.llen(self.processing_key)
+        if claimed == 0 and self.redis_conn.brpoplpush(PENDING_KEY, self.processing_key, timeout=1) is None:
+            return []
+        claimed = max(claimed, 1)
+        deadline = time.monotonic() + self.flush_interval
+        while claimed < self.batch_size and time.monotonic() < deadline:
+            if self.redis_conn.rpoplpush(PENDING_KEY, self.processing_key) is None:
+                time.sleep(min(0.005, max(0.0, deadline - time.monotonic())))
+                continue
+            claimed += 1
+        return self.redis_conn.lrange(self.processing_key, 0, -1)
+
+    def flush(self, claimed):
+        records = [json.loads(item) for item in claimed]
+        start = time.perf_counter()
+        results = write_complaints(records)
+
+        pipe = self.redis_conn.pipeline()
+        failed = 0
+        for record, result in zip(records, results):
+            key = f"{RESULT_KEY_PREFIX}{record['record_id']}"
+            pipe.hset(key, mapping={
+                'complaint_id': result['complaint_id'] if result['complaint_id'] is not None else '',
+                'status': 'stored' if result['complaint_id'] is not None else 'failed',
+                'indexed': int(result['indexed']),
+                'error': result['error'] or ''
+            })
+            pipe.expire(key, PERSIST_RESULT_TTL)
+            if result['complaint_id'] is None:
+                failed += 1
+                pipe.lpush(FAILED_KEY, json.dumps({**record, 'error': result['error']}))
+        # The batch is only released once its outcome is recorded
+        pipe.delete(self.processing_key)
+        pipe.execute()
+        logger.info(f"Flushed {len(records)} complaints in {time.perf_counter() - start:.3f}s, {failed} failed")
+
+    def run(self):
+        last_recovery = 0.0
+        threading.Thread(target=self._keep_alive, name='write-behind-heartbeat', daemon=True).start()
+        while not self._stop_event.is_set():
+            try:
+                self._heartbeat()
+                if time.monotonic() - last_recovery > CONSUMER_HEARTBEAT_TTL:
+                    self.recover_orphans()
+                    last_recovery = time.monotonic()
+                claimed = self.claim()
+                if claimed:
+                    self.flush(claimed)
+            except Exception as e:
+                # Claimed records stay in the processing list and are retried on the next claim
+                logger.error(f"Write-behind flush failed: {str(e)}")
+                time.sleep(1)
+        logger.info("Write-behind flusher stopped")
+
+
+def run_flusher():
+    # Standalone flusher that finishes its batch on SIGTERM/SIGINT
+    flusher = WriteBehindFlusher()
+    signal.signal(signal.SIGTERM, lambda signum, frame: flusher.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: flusher.stop())
+    flusher.start()
+    while flusher.is_alive():
+        flusher.join(timeout=1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_flusher()
@@ -0,0 +1,75 @@
+# aggregator/queues.py
+#
+# One RQ queue per modality, so a burst of slow video complaints cannot starve
+# text complaints. Each queue is served by its own worker pool and exports its
+# depth and wait time for autoscaling.
+
+import os
+import logging
+from datetime import datetime
+from rq import Queue
+from redis import RedisError
+from agents.delivery import record_pipeline
+from notifications import notify_job_finished, notify_job_failed
+
+logger = logging.getLogger(__name__)
+
+MODALITIES = ('text', 'voice', 'image', 'video')
+QUEUE_PREFIX = os.environ.get('QUEUE_PREFIX', 'complaints')
+
+# Upper bound on a single job per modality, video waits up to 90s per annotation
+JOB_TIMEOUTS = {
+    'text': int(os.environ.get('TEXT_JOB_TIMEOUT', 180)),
+    'voice': int(os.environ.get('VOICE_JOB_TIMEOUT', 300)),
+    'image': int(os.environ.get('IMAGE_JOB_TIMEOUT', 180)),
+    'video': int(os.environ.get('VIDEO_JOB_TIMEOUT', 900)),
+}
+
+# Reindexing and vector index builds run for hours, on a pool of their own
+MAINTENANCE = 'maintenance'
+
+QUEUE_STATS_KEY = 'queue:stats'
+
+def queue_name(modality):
+    return f"{QUEUE_PREFIX}-{modality}"
+
+def get_queue(modality, connection):
+    if modality not in MODALITIES:
+        raise ValueError(f"Unknown complaint type: {modality}")
+    return Queue(queue_name(modality), connection=connection, default_timeout=JOB_TIMEOUTS[modality])
+
+def get_maintenance_queue(connection):
+    # Jobs set their own timeout
+    return Queue(queue_name(MAINTENANCE), connection=connection)
+
+def enqueue_complaint(connection, func, data, **kwargs):
+    # Completion and failure are published for push notifications
+    kwargs.setdefault('on_success', notify_job_finished)
+    kwargs.setdefault('on_failure', notify_job_failed)
+    job = get_queue(data.get('type'), connection).enqueue(func, data, **kwargs)
+    # Jobs per complaint: 1 when agents return in-process, 2 with AGENT_DELIVERY=http
+    record_pipeline(connection, data.get('type'), jobs=1)
+    return job
+
+def record_queue_wait(connection, modality, job):
+    # Called when a job starts; the collector turns the sums into mean wait per modality
+    if job is None or job.enqueued_at is None:
+        return
+    started_at = job.started_at or job.enqueued_at
+    wait = max(0.0, (started_at - job.enqueued_at).total_seconds())
+    try:
+        pipe = connection.pipeline(transaction=False)
+        pipe.hincrby(QUEUE_STATS_KEY, f"{modality}:started", 1)
+        pipe.hincrbyfloat(QUEUE_STATS_KEY, f"{modality}:wait_seconds", wait)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not record queue wait time: {str(e)}")
+
+def oldest_job_age(queue):
+    # Age of the job at the head of the queue, 0 when it is empty
+    job_ids = queue.get_job_ids(0, 1)
+    job = queue.fetch_job(job_ids[0]) if job_ids else None
+    if job is None or job.enqueued_at is None:
+        return 0.0
+    # RQ stores naive UTC timestamps
+    return max(0.0, (datetime.utcnow() - job.enqueued_at).total_seconds())
@@ -0,0 +1,274 @@
+# aggregator/reindex.py
+#
+# Rebuilds the search index from Postgres without running any agent again.
+# Rows are read in id order through a server-side cursor, one keyset window
+# (id > last checkpoint) per transaction, turned into search documents and
+# sent with _bulk from a few threads. A bounded number of chunks may be in
+# flight, so reading waits for Elasticsearch instead of filling memory. The
+# highest id whose chunk and all earlier ones are indexed is checkpointed in
+# Redis, and an interrupted run resumes from there. Reindexing into the alias
+# writes a new backing index and swaps the alias to it once it is complete, so
+# complaints already in older, rolled-over indices are not indexed twice.
+#
+#   python reindex.py run [--name full] [--index complaints] [--restart]
+#   python reindex.py run --enqueue      # as an RQ job on the maintenance queue
+#   python reindex.py status [--name full]
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from elasticsearch.helpers import streaming_bulk
+from rq import get_current_job
+from agents.resources import resources
+from database import ensure_schema
+from queues import get_maintenance_queue
+from search import invalidate_search_cache
+from search_index import (SEARCH_ALIAS, aliased_indices, bulk_ingest, ensure_search_index, is_legacy_index,
+                          next_index_name, search_document, swap_alias)
+
+logger = logging.getLogger(__name__)
+
+# Rows per _bulk request
+REINDEX_CHUNK_SIZE = int(os.environ.get('REINDEX_CHUNK_SIZE', 1000))
+# Rows per keyset window, each read in its own short transaction
+REINDEX_WINDOW_SIZE = int(os.environ.get('REINDEX_WINDOW_SIZE', 50000))
+REINDEX_PARALLELISM = int(os.environ.get('REINDEX_PARALLELISM', 4))
+# Chunks read ahead of Elasticsearch, per thread
+REINDEX_QUEUE_CHUNKS = int(os.environ.get('REINDEX_QUEUE_CHUNKS', 2))
+REINDEX_MAX_RETRIES = int(os.environ.get('REINDEX_MAX_RETRIES', 5))
+REINDEX_REPORT_SECONDS = float(os.environ.get('REINDEX_REPORT_SECONDS', 10))
+REINDEX_JOB_TIMEOUT = int(os.environ.get('REINDEX_JOB_TIMEOUT', 24 * 3600))
+
+CHECKPOINT_KEY_PREFIX = 'reindex:'
+# Lock held while a run is going, renewed with every checkpoint
+LOCK_TIMEOUT = 300
+MAX_RECORDED_FAILURES = 1000
+
+def checkpoint_key(name):
+    return f"{CHECKPOINT_KEY_PREFIX}{name}"
+
+def read_checkpoint(redis_conn, name):
+    return {field.decode(): value.decode() for field, value in redis_conn.hgetall(checkpoint_key(name)).items()}
+
+def read_windows(conn, after_id, window_size=REINDEX_WINDOW_SIZE, chunk_size=REINDEX_CHUNK_SIZE):
+    # Yields lists of rows in id order. The named cursor streams each window from the server
+    # chunk by chunk, and committing after every window keeps the snapshot short.
+    while True:
+        cur = conn.cursor(name='reindex')
+        cur.itersize = chunk_size
+        cur.execute("SELECT id, type, content, category, created_at FROM complaints WHERE id > %s "
+                    "ORDER BY id LIMIT %s", (after_id, window_size))
+        read = 0
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                read += len(rows)
+                after_id = rows[-1][0]
+                yield rows
+        finally:
+            cur.close()
+            conn.commit()
+        if read < window_size:
+            return
+
+def document_actions(rows, index):
+    for complaint_id, complaint_type, content, category, created_at in rows:
+        record = {'type': complaint_type, 'content': content, 'category': category,
+                  'created_at': created_at.astimezone(timezone.utc).isoformat()}
+        yield {'_index': index, '_id': complaint_id, '_source': search_document(record, complaint_id)}
+
+def index_chunk(es, rows, index):
+    # Rejected requests (429) are retried with backoff by streaming_bulk. Only documents Elasticsearch
+    # refuses (4xx, e.g. a mapping conflict) are recorded as failed. Transport errors propagate, and
+    # so do items still overloaded or failing on the server after the retries: the run stops as
+    # interrupted without checkpointing past them, and resumes from the last indexed chunk.
+    failed = []
+    for ok, item in streaming_bulk(es, document_actions(rows, index), chunk_size=len(rows),
+                                   max_retries=REINDEX_MAX_RETRIES, initial_backoff=1, raise_on_error=False):
+        if not ok:
+            info = item.get('index', {})
+            status = info.get('status') or 0
+            if status == 429 or not 400 <= status < 500:
+                raise RuntimeError(f"Elasticsearch could not index complaint {info.get('_id')} "
+                                   f"(status {status}): {info.get('error')}")
+            failed.append((info.get('_id'), str(info.get('error'))))
+    return rows[-1][0], len(rows), failed
+
+
+class Progress:
+    def __init__(self, redis_conn, name, last_id=0, indexed=0, failed=0):
+        self.redis_conn = redis_conn
+        self.key = checkpoint_key(name)
+        self.last_id = last_id
+        self.start = time.monotonic()
+        self.start_indexed = indexed
+        self.indexed = indexed
+        self.failed = failed
+        self.last_report = (self.start, indexed)
+
+    def docs_per_second(self):
+        return (self.indexed - self.start_indexed) / max(1e-9, time.monotonic() - self.start)
+
+    def checkpoint(self, last_id, indexed, failures):
+        self.last_id = last_id
+        self.indexed += indexed
+        self.failed += len(failures)
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(self.key, mapping={
+            'last_id': last_id, 'indexed': self.indexed, 'failed': self.failed, 'status': 'running',
+            'docs_per_second': round(self.docs_per_second(), 1),
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+        })
+        for complaint_id, error in failures:
+            pipe.lpush(f"{self.key}:failed", f"{complaint_id}: {error}")
+        if failures:
+            pipe.ltrim(f"{self.key}:failed", 0, MAX_RECORDED_FAILURES - 1)
+        pipe.execute()
+
+        now = time.monotonic()
+        if now - self.last_report[0] >= REINDEX_REPORT_SECONDS:
+            recent = (self.indexed - self.last_report[1]) / (now - self.last_report[0])
+            logger.info(f"Reindexed {self.indexed} complaints up to id {last_id}: {recent:.0f} docs/s now, "
+                        f"{self.docs_per_second():.0f} docs/s overall, {self.failed} failed")
+            self.last_report = (now, self.indexed)
+            job = get_current_job()
+            if job is not None:
+                job.meta.update({'last_id': last_id, 'indexed': self.indexed,
+                                 'docs_per_second': round(self.docs_per_second(), 1)})
+                job.save_meta()
+
+
+def reindex(name='full', index=SEARCH_ALIAS, restart=False, parallelism=REINDEX_PARALLELISM,
+            chunk_size=REINDEX_CHUNK_SIZE, window_size=REINDEX_WINDOW_SIZE, keep_old=False):
+    redis_conn, es = resources.redis, resources.elasticsearch
+    lock = redis_conn.lock(f"{checkpoint_key(name)}:lock", timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        raise RuntimeError(f"Reindex '{name}' is already running")
+    try:
+        swap = index == SEARCH_ALIAS
+        # A completed run into the alias has been swapped in and may have rolled over since, the
+        # next one rebuilds into a new index
+        if restart or swap and read_checkpoint(redis_conn, name).get('status') == 'completed':
+            redis_conn.delete(checkpoint_key(name), f"{checkpoint_key(name)}:failed")
+        saved = read_checkpoint(redis_conn, name)
+        after_id = int(saved.get('last_id', 0))
+        progress = Progress(redis_conn, name, after_id, int(saved.get('indexed', 0)), int(saved.get('failed', 0)))
+
+        ensure_schema()
+        target = index
+        if swap:
+            ensure_search_index(es)
+            if is_legacy_index(es, index):
+                raise RuntimeError(f"'{index}' is a legacy index, run `python search_index.py setup --migrate-legacy` first")
+            # A resumed run keeps writing to the index it started
+            target = saved.get('target') or next_index_name(es, index)
+            if not es.indices.exists(index=target):
+                es.indices.create(index=target)
+        redis_conn.hset(checkpoint_key(name), mapping={'status': 'running', 'index': index, 'target': target})
+        logger.info(f"Reindexing complaints into '{target}' after id {after_id}")
+        conn = resources.engine.raw_connection()
+
+        def index_rows(after):
+            # Chunks submitted but not yet checkpointed, in id order
+            in_flight = deque()
+            slots = threading.BoundedSemaphore(parallelism * REINDEX_QUEUE_CHUNKS)
+
+            def release(future):
+                slots.release()
+
+            def checkpoint_done(wait=False):
+                while in_flight and (wait or in_flight[0].done()):
+                    progress.checkpoint(*in_flight.popleft().result())
+                    lock.reacquire()
+
+            with ThreadPoolExecutor(max_workers=parallelism) as pool:
+                for rows in read_windows(conn, after, window_size, chunk_size):
+                    # Backpressure: wait for a slot before reading further
+                    slots.acquire()
+                    future = pool.submit(index_chunk, es, rows, target)
+                    future.add_done_callback(release)
+                    in_flight.append(future)
+                    checkpoint_done()
+                checkpoint_done(wait=True)
+
+        try:
+            with bulk_ingest(es, redis_conn, target):
+                index_rows(after_id)
+            if swap and target not in aliased_indices(es, index):
+                old = swap_alias(es, target, index)
+                # Complaints written to the old write index while the last window was read
+                index_rows(progress.last_id)
+                if old and not keep_old and progress.failed == 0:
+                    es.indices.delete(index=','.join(old))
+                    logger.info(f"Deleted {', '.join(old)}, every complaint is in {target}")
+                elif old:
+                    logger.warning(f"Kept {', '.join(old)} out of the '{index}' alias, delete them once checked")
+        finally:
+            conn.close()
+
+        redis_conn.hset(checkpoint_key(name), 'status', 'completed')
+        invalidate_search_cache(redis_conn)
+        summary = {'indexed': progress.indexed, 'failed': progress.failed,
+                   'docs_per_second': round(progress.docs_per_second(), 1),
+                   'seconds': round(time.monotonic() - progress.start, 1), 'index': target}
+        logger.info(f"Reindex '{name}' completed: {summary}")
+        return summary
+    except Exception:
+        redis_conn.hset(checkpoint_key(name), 'status', 'interrupted')
+        raise
+    finally:
+        lock.release()
+
+def enqueue_reindex(connection, **options):
+    # Served by the maintenance pool, so it does not hold a complaint worker for hours
+    return get_maintenance_queue(connection).enqueue(reindex, kwargs=options, job_timeout=REINDEX_JOB_TIMEOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the search index from Postgres')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Reindex, resuming from the last checkpoint')
+    run_parser.add_argument('--name', default='full', help='Checkpoint name, one per independent reindex')
+    run_parser.add_argument('--index', default=SEARCH_ALIAS,
+                            help='The alias (into a new index swapped in at the end) or an index written to directly')
+    run_parser.add_argument('--keep-old', action='store_true',
+                            help='Keep the indices the alias pointed to instead of deleting them after the swap')
+    run_parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+    run_parser.add_argument('--parallelism', type=int, default=REINDEX_PARALLELISM)
+    run_parser.add_argument('--chunk-size', type=int, default=REINDEX_CHUNK_SIZE)
+    run_parser.add_argument('--enqueue', action='store_true', help='Run as an RQ job instead of in this process')
+    status_parser = commands.add_parser('status', help='Show the checkpoint of a reindex')
+    status_parser.add_argument('--name', default='full')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        checkpoint = read_checkpoint(resources.redis, args.name)
+        if not checkpoint:
+            print(f"No reindex named '{args.name}'")
+            sys.exit(1)
+        for field, value in sorted(checkpoint.items()):
+            print(f"{field:<16} {value}")
+        return
+
+    options = {'name': args.name, 'index': args.index, 'restart': args.restart,
+               'parallelism': args.parallelism, 'chunk_size': args.chunk_size, 'keep_old': args.keep_old}
+    if args.enqueue:
+        job = enqueue_reindex(resources.redis, **options)
+        print(f"Enqueued reindex job {job.id}")
+    else:
+        summary = reindex(**options)
+        print(f"Indexed {summary['indexed']} complaints ({summary['failed']} failed) in {summary['seconds']}s, "
+              f"{summary['docs_per_second']} docs/s")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
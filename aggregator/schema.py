@@ -0,0 +1,378 @@
+# aggregator/schema.py
+#
+# Managed Postgres schema for complaints. The table is range partitioned by
+# month on created_at, content is JSONB, and dashboards filtering on category,
+# type, a created_at range or hot content fields are served by B-tree,
+# expression and GIN indexes instead of full scans. Versioned migrations are
+# recorded in schema_migrations and convert the earlier unpartitioned table in
+# place, keeping it as complaints_legacy.
+#
+#   python schema.py migrate [--drop-legacy] [--check-plans]  # apply pending migrations, run at deploy
+#   python schema.py partitions --months 6                    # create the coming months' partitions
+#   python schema.py check-plans                              # EXPLAIN the dashboard queries, non-zero on a full scan
+
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from agents.resources import resources
+
+logger = logging.getLogger(__name__)
+
+# Months after the current one that get a partition ahead of time. Rows outside every
+# partition land in complaints_default and move when their month's partition is created.
+SCHEMA_PARTITION_MONTHS_AHEAD = int(os.environ.get('SCHEMA_PARTITION_MONTHS_AHEAD', 3))
+# Content fields filtered on by dashboards, each gets an expression index on content->>'<field>'
+SCHEMA_JSON_INDEX_FIELDS = [field.strip() for field in
+                            os.environ.get('SCHEMA_JSON_INDEX_FIELDS', 'issue,sub_issue').split(',') if field.strip()]
+# GIN index for containment queries (content @> '{"issue": ...}') over the whole document
+SCHEMA_CONTENT_GIN = os.environ.get('SCHEMA_CONTENT_GIN', 'true').lower() in ('1', 'true', 'yes')
+
+TABLE = 'complaints'
+LEGACY_TABLE = 'complaints_legacy'
+DEFAULT_PARTITION = 'complaints_default'
+# Serializes migrations and partition creation across workers
+SCHEMA_LOCK_ID = 7340211
+
+def _relkind(cur, name):
+    # 'p' partitioned table, 'r' plain table, None when missing
+    cur.execute("SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE c.relname = %s AND n.nspname = current_schema()", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _month_bounds(year, month):
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+def _add_months(year, month, count):
+    index = year * 12 + month - 1 + count
+    return index // 12, index % 12 + 1
+
+def partition_name(year, month):
+    return f"{TABLE}_p{year:04d}_{month:02d}"
+
+def create_partition(cur, year, month):
+    # New partitions are filled from the default partition before they are attached,
+    # so a month that already received rows can still get its own partition
+    name = partition_name(year, month)
+    if _relkind(cur, name) is not None:
+        return False
+    start, end = _month_bounds(year, month)
+    cur.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s "
+                f"RETURNING *) INSERT INTO {name} SELECT * FROM moved", (start, end))
+    if cur.rowcount:
+        logger.info(f"Moved {cur.rowcount} complaints from {DEFAULT_PARTITION} to {name}")
+    cur.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    logger.info(f"Created partition {name}")
+    return True
+
+def create_partitions(cur, first, last):
+    # Every month from first to last inclusive, as (year, month)
+    created = 0
+    year, month = first
+    while (year, month) <= last:
+        created += create_partition(cur, year, month)
+        year, month = _add_months(year, month, 1)
+    return created
+
+def _create_table(cur):
+    cur.execute(f"""
+        CREATE TABLE {TABLE} (
+            id BIGSERIAL,
+            type VARCHAR(50) NOT NULL,
+            content JSONB NOT NULL,
+            category VARCHAR(100) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    cur.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+
+def _migrate_partitioned_table(cur, drop_legacy=False):
+    # Version 1: JSONB content and monthly partitions, converting the table created by
+    # SQLAlchemy (JSON, naive UTC timestamps) or db_setup.py (JSONB, timestamptz)
+    if _relkind(cur, TABLE) == 'p':
+        return
+    legacy = _relkind(cur, TABLE) == 'r'
+    if legacy:
+        if _relkind(cur, LEGACY_TABLE) is not None:
+            raise RuntimeError(f"Cannot convert {TABLE}: {LEGACY_TABLE} already exists")
+        cur.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (TABLE,))
+        sequence, = cur.fetchone()
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", (TABLE,))
+        primary_key = cur.fetchone()
+        cur.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}")
+        # Frees the names the new table's primary key and sequence get
+        if primary_key:
+            cur.execute(f"ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT {primary_key[0]} TO {LEGACY_TABLE}_pkey")
+        if sequence:
+            cur.execute(f"ALTER SEQUENCE {sequence} RENAME TO {LEGACY_TABLE}_id_seq")
+    _create_table(cur)
+    if not legacy:
+        return
+
+    cur.execute("SELECT data_type FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'created_at'",
+                (LEGACY_TABLE,))
+    data_type, = cur.fetchone()
+    # Naive timestamps were written with datetime.utcnow
+    created_at = "created_at AT TIME ZONE 'UTC'" if data_type == 'timestamp without time zone' else 'created_at'
+    created_at = f"COALESCE({created_at}, CURRENT_TIMESTAMP)"
+    cur.execute(f"SELECT min({created_at}), max({created_at}) FROM {LEGACY_TABLE}")
+    oldest, newest = cur.fetchone()
+    if oldest is not None:
+        oldest, newest = oldest.astimezone(timezone.utc), newest.astimezone(timezone.utc)
+        create_partitions(cur, (oldest.year, oldest.month), (newest.year, newest.month))
+    cur.execute(f"INSERT INTO {TABLE} (id, type, content, category, created_at) "
+                f"SELECT id, type, content::jsonb, category, {created_at} FROM {LEGACY_TABLE}")
+    copied = cur.rowcount
+    cur.execute(f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE((SELECT max(id) FROM {TABLE}), 0) + 1, "
+                f"false)", (TABLE,))
+    if drop_legacy:
+        cur.execute(f"DROP TABLE {LEGACY_TABLE}")
+        logger.info(f"Converted {copied} complaints to the partitioned table")
+    else:
+        logger.info(f"Converted {copied} complaints to the partitioned table, the original is kept as "
+                    f"{LEGACY_TABLE}")
+
+def _add_record_id(cur, drop_legacy=False):
+    # Version 2: the job or batch item ID a complaint was stored for. Unique with created_at, which
+    # a unique index on a partitioned table must include, so retried writes insert nothing.
+    cur.execute(f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS record_id VARCHAR(128)")
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {TABLE}_record_id_idx ON {TABLE} (record_id, created_at)")
+
+MIGRATIONS = [
+    (1, 'partitioned complaints table with JSONB content', _migrate_partitioned_table),
+    (2, 'unique record_id for idempotent writes', _add_record_id),
+]
+
+def _index_statements():
+    # Created on the partitioned table, so every partition, current and future, gets them
+    statements = [
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_category_created_at_idx ON {TABLE} (category, created_at)",
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_type_created_at_idx ON {TABLE} (type, created_at)",
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_created_at_idx ON {TABLE} (created_at)",
+    ]
+    for field in SCHEMA_JSON_INDEX_FIELDS:
+        if not re.fullmatch(r'[a-z_][a-z0-9_]*', field):
+            raise ValueError(f"Invalid content field for an index: {field}")
+        statements.append(f"CREATE INDEX IF NOT EXISTS {TABLE}_content_{field}_idx "
+                          f"ON {TABLE} ((content ->> '{field}'), created_at)")
+    if SCHEMA_CONTENT_GIN:
+        statements.append(f"CREATE INDEX IF NOT EXISTS {TABLE}_content_gin_idx "
+                          f"ON {TABLE} USING GIN (content jsonb_path_ops)")
+    return statements
+
+def ensure_indexes(cur):
+    for statement in _index_statements():
+        cur.execute(statement)
+
+def applied_versions(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INTEGER PRIMARY KEY, description TEXT NOT NULL, "
+                "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+    cur.execute("SELECT version FROM schema_migrations")
+    return {version for version, in cur.fetchall()}
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    # Latest applied migration, 0 for a database that was never migrated. No lock, no DDL.
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('schema_migrations')")
+        if cur.fetchone()[0] is None:
+            return 0
+        cur.execute("SELECT COALESCE(max(version), 0) FROM schema_migrations")
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
+        conn.rollback()
+
+def migrate(conn, drop_legacy=False, months_ahead=SCHEMA_PARTITION_MONTHS_AHEAD):
+    # Pending migrations, indexes and the coming months' partitions in one transaction
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        applied = applied_versions(cur)
+        for version, description, apply in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying schema migration {version}: {description}")
+            apply(cur, drop_legacy=drop_legacy)
+            cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description))
+        ensure_indexes(cur)
+        now = datetime.now(timezone.utc)
+        create_partitions(cur, (now.year, now.month), _add_months(now.year, now.month, months_ahead))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    _known_months.clear()
+
+
+_partition_lock = threading.Lock()
+_known_months = set()
+
+def ensure_partitions(conn, months):
+    # months as 'YYYY-MM' strings, e.g. the created_at prefixes of a batch about to be inserted.
+    # Only months this process has not seen yet cost a round trip.
+    missing = set(months) - _known_months
+    if not missing:
+        return
+    with _partition_lock:
+        cur = conn.cursor()
+        try:
+            # Partitions created by migrate or another process are found without taking the lock,
+            # which a forked work horse would otherwise take on every job
+            cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = %s::regclass", (TABLE,))
+            existing = {name for name, in cur.fetchall()}
+            _known_months.update(month for month in missing
+                                 if partition_name(int(month[:4]), int(month[5:7])) in existing)
+            missing -= _known_months
+            if not missing:
+                conn.commit()
+                return
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+            for month in sorted(missing):
+                year, month_number = int(month[:4]), int(month[5:7])
+                create_partition(cur, year, month_number)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        _known_months.update(missing)
+
+
+# Partitions the planner may reasonably read in full
+SMALL_PARTITION_ROWS = 1000
+
+# Representative dashboard queries and the index each one must be able to use
+DASHBOARD_QUERIES = [
+    ('category over a date range',
+     f"SELECT id, type, category, created_at FROM {TABLE} "
+     f"WHERE category = %(category)s AND created_at >= %(since)s ORDER BY created_at DESC LIMIT 50",
+     f"{TABLE}_category_created_at_idx"),
+    ('type over a date range',
+     f"SELECT count(*) FROM {TABLE} WHERE type = %(type)s AND created_at >= %(since)s",
+     f"{TABLE}_type_created_at_idx"),
+    ('daily volume',
+     f"SELECT date_trunc('day', created_at), count(*) FROM {TABLE} "
+     f"WHERE created_at >= %(since)s AND created_at < %(until)s GROUP BY 1",
+     f"{TABLE}_created_at_idx"),
+    ('issue breakdown',
+     f"SELECT content ->> 'sub_issue', count(*) FROM {TABLE} "
+     f"WHERE content ->> 'issue' = %(issue)s AND created_at >= %(since)s GROUP BY 1",
+     f"{TABLE}_content_issue_idx"),
+    ('content containment',
+     f"SELECT id FROM {TABLE} WHERE content @> %(document)s::jsonb",
+     f"{TABLE}_content_gin_idx"),
+]
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+def check_plans(conn, allow_seqscan=False, since=None):
+    # EXPLAIN every dashboard query and report the indexes and partitions it reads. By default
+    # sequential scans are disabled, which checks that an index can serve each query even while
+    # the tables are too small for the planner to prefer it. With allow_seqscan the plans are
+    # the production ones, and only full scans of partitions over SMALL_PARTITION_ROWS count.
+    now = datetime.now(timezone.utc)
+    since = since or datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    params = {'category': 'Billing', 'type': 'text', 'issue': 'Billing disputes', 'since': since, 'until': now,
+              'document': json.dumps({'issue': 'Billing disputes'})}
+    report = []
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT c.relname, c.reltuples FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = %s::regclass", (TABLE,))
+        partition_rows = dict(cur.fetchall())
+        # Indexes of the partitions are attached to the index of the partitioned table
+        cur.execute("SELECT c.relname, p.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "JOIN pg_class p ON p.oid = i.inhparent WHERE c.relkind = 'i'")
+        parent_index = dict(cur.fetchall())
+        if not allow_seqscan:
+            cur.execute("SET LOCAL enable_seqscan = off")
+        for name, query, index in DASHBOARD_QUERIES:
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cur.fetchone()[0]
+            nodes = list(_plan_nodes((plan if isinstance(plan, list) else json.loads(plan))[0]['Plan']))
+            used = {parent_index.get(node['Index Name'], node['Index Name']) for node in nodes if 'Index Name' in node}
+            scanned = {node['Relation Name'] for node in nodes if 'Relation Name' in node}
+            full_scans = sorted({node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'
+                                 and not (allow_seqscan
+                                          and partition_rows.get(node['Relation Name'], 0) < SMALL_PARTITION_ROWS)})
+            report.append({
+                'query': name,
+                'expected_index': index,
+                'indexes': sorted(used),
+                'partitions_scanned': len(scanned),
+                'partitions': len(partition_rows),
+                'seq_scans': full_scans,
+                'ok': index in used and not full_scans,
+            })
+        conn.rollback()
+    finally:
+        cur.close()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the complaints schema')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='Apply pending migrations, indexes and partitions')
+    migrate_parser.add_argument('--drop-legacy', action='store_true',
+                                help=f"Drop the unpartitioned table after converting it instead of keeping "
+                                     f"it as {LEGACY_TABLE}")
+    migrate_parser.add_argument('--check-plans', action='store_true',
+                                help='Then EXPLAIN the dashboard queries and log the ones no index serves')
+    partitions_parser = commands.add_parser('partitions', help="Create the coming months' partitions")
+    partitions_parser.add_argument('--months', type=int, default=SCHEMA_PARTITION_MONTHS_AHEAD)
+    plans_parser = commands.add_parser('check-plans', help='EXPLAIN the dashboard queries')
+    plans_parser.add_argument('--allow-seqscan', action='store_true',
+                              help='Plan as in production instead of checking that the indexes are usable')
+    args = parser.parse_args()
+
+    conn = resources.engine.raw_connection()
+    try:
+        if args.command == 'migrate':
+            migrate(conn, drop_legacy=args.drop_legacy)
+            if args.check_plans:
+                # Run at every deploy by the entrypoint. A missing index is logged, it does not stop the deploy.
+                for entry in check_plans(conn):
+                    if not entry['ok']:
+                        logger.warning(f"Dashboard query '{entry['query']}' cannot use {entry['expected_index']}: "
+                                       f"indexes={entry['indexes']} seq_scans={entry['seq_scans']}")
+        elif args.command == 'partitions':
+            migrate(conn, months_ahead=args.months)
+        else:
+            report = check_plans(conn, allow_seqscan=args.allow_seqscan)
+            for entry in report:
+                print(f"{'ok ' if entry['ok'] else 'FAIL'} {entry['query']:<28} "
+                      f"indexes={','.join(entry['indexes']) or '-'} "
+                      f"partitions={entry['partitions_scanned']}/{entry['partitions']}"
+                      + (f" seq_scans={','.join(entry['seq_scans'])}" if entry['seq_scans'] else ''))
+            if not all(entry['ok'] for entry in report):
+                sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,216 @@
+# aggregator/search.py
+#
+# Complaint search for dashboards. One request returns a page of hits trimmed
+# to the requested fields, a cursor for the next page (search_after, so deep
+# pages cost the same as the first), and terms / date histogram aggregations
+# over the same filters. The fields come from the template in search_index.py.
+# Results are cached in Redis for a few seconds. Indexing moves a generation
+# forward, at most once per refresh interval, which retires all cached results
+# at once.
+
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+from datetime import datetime
+from redis import RedisError
+from search_index import SEARCH_ALIAS, SEARCH_REFRESH_INTERVAL, COMPLAINT_MAPPINGS, interval_seconds
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DEFAULT_SIZE = int(os.environ.get('SEARCH_DEFAULT_SIZE', 20))
+SEARCH_MAX_SIZE = int(os.environ.get('SEARCH_MAX_SIZE', 100))
+SEARCH_AGG_SIZE = int(os.environ.get('SEARCH_AGG_SIZE', 20))
+# Totals are exact up to this many hits, 'gte' beyond
+SEARCH_TRACK_TOTAL_HITS = int(os.environ.get('SEARCH_TRACK_TOTAL_HITS', 10000))
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 30))
+# Newly indexed complaints become searchable after the index refresh. The cache generation
+# counts periods of this length, so it moves at most once per refresh however often we index.
+SEARCH_REFRESH_SECONDS = float(os.environ.get('SEARCH_REFRESH_SECONDS', 0) or interval_seconds(SEARCH_REFRESH_INTERVAL))
+
+SEARCH_CACHE_PREFIX = 'search:cache:'
+SEARCH_GENERATION_KEY = 'search:generation'
+SEARCH_CACHE_STATS_KEY = 'search:cache:stats'
+
+# Everything but the combined full-text field, which is not stored
+SOURCE_FIELDS = tuple(field for field in COMPLAINT_MAPPINGS['properties'] if field != 'content')
+FILTER_FIELDS = ('type', 'category', 'issue', 'sub_issue', 'labels', 'sentiment_label')
+AGGREGATIONS = ('type', 'category', 'issue', 'labels', 'sentiment_label', 'created_at')
+INTERVALS = ('hour', 'day', 'week', 'month')
+SORTS = ('relevance', 'newest', 'oldest')
+# content and category.text come from the template. category and summary are the text of a
+# dynamic-mapped legacy index, which stays searchable until setup --migrate-legacy moves it.
+QUERY_FIELDS = ['content', 'category.text', 'category', 'summary']
+
+
+def _csv(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+def _date(name, value):
+    if not value:
+        return None
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or time")
+    return value
+
+def encode_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+def parse_search_args(args):
+    # Query string of /search, raises ValueError with a message for the client
+    try:
+        size = int(args.get('size', SEARCH_DEFAULT_SIZE))
+    except ValueError:
+        raise ValueError('size must be an integer')
+    if not 0 <= size <= SEARCH_MAX_SIZE:
+        raise ValueError(f"size must be between 0 and {SEARCH_MAX_SIZE}")
+    params = {
+        'q': args.get('q', '').strip(),
+        'size': size,
+        'from': _date('from', args.get('from')),
+        'to': _date('to', args.get('to')),
+        'fields': sorted(_csv(args.get('fields'))) or list(SOURCE_FIELDS),
+        'aggs': sorted(_csv(args.get('aggs'))),
+        'interval': args.get('interval', 'day'),
+        'sort': args.get('sort') or ('relevance' if args.get('q', '').strip() else 'newest'),
+        'cursor': decode_cursor(args['cursor']) if args.get('cursor') else None,
+    }
+    for field in FILTER_FIELDS:
+        params[field] = sorted(_csv(args.get(field)))
+    unknown = [field for field in params['fields'] if field not in SOURCE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Expected some of {', '.join(SOURCE_FIELDS)}")
+    unknown = [name for name in params['aggs'] if name not in AGGREGATIONS]
+    if unknown:
+        raise ValueError(f"Unknown aggregations: {', '.join(unknown)}. Expected some of {', '.join(AGGREGATIONS)}")
+    if params['interval'] not in INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+    if params['sort'] not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+    return params
+
+def build_query(params):
+    filters = [{'terms': {field: params[field]}} for field in FILTER_FIELDS if params[field]]
+    if params['from'] or params['to']:
+        bounds = {'gte': params['from']} if params['from'] else {}
+        if params['to']:
+            bounds['lt'] = params['to']
+        filters.append({'range': {'created_at': bounds}})
+    # Filters are not scored and are cached by Elasticsearch across queries
+    query = {'bool': {
+        'must': [{'multi_match': {'query': params['q'], 'fields': QUERY_FIELDS}}] if params['q']
+        else [{'match_all': {}}],
+        'filter': filters,
+    }}
+
+    # complaint_id breaks ties so search_after never skips or repeats a hit. A legacy index maps
+    # neither field, unmapped_type sorts its documents as missing instead of failing the search.
+    order = 'asc' if params['sort'] == 'oldest' else 'desc'
+    sort = [{'created_at': {'order': order, 'missing': '_last', 'unmapped_type': 'date'}},
+            {'complaint_id': {'order': order, 'missing': '_last', 'unmapped_type': 'long'}}]
+    if params['sort'] == 'relevance':
+        sort.insert(0, {'_score': 'desc'})
+
+    body = {
+        'query': query,
+        'size': params['size'],
+        'sort': sort,
+        '_source': params['fields'],
+        'track_total_hits': SEARCH_TRACK_TOTAL_HITS,
+    }
+    if params['cursor']:
+        body['search_after'] = params['cursor']
+    aggs = {}
+    for name in params['aggs']:
+        if name == 'created_at':
+            aggs[name] = {'date_histogram': {'field': 'created_at', 'calendar_interval': params['interval']}}
+        else:
+            aggs[name] = {'terms': {'field': name, 'size': SEARCH_AGG_SIZE}}
+    if aggs:
+        body['aggs'] = aggs
+    return body
+
+def format_response(params, response):
+    hits = response['hits']['hits']
+    total = response['hits']['total']
+    result = {
+        'hits': [dict(hit.get('_source', {}), id=hit['_id'], score=hit.get('_score')) for hit in hits],
+        'total': total['value'],
+        'total_relation': total['relation'],
+        # A full page may have more after it
+        'next_cursor': encode_cursor(hits[-1]['sort']) if hits and len(hits) == params['size'] else None,
+        'took_ms': response.get('took'),
+    }
+    if 'aggregations' in response:
+        result['aggregations'] = {
+            name: [{'key': bucket.get('key_as_string', bucket['key']), 'count': bucket['doc_count']}
+                   for bucket in aggregation['buckets']]
+            for name, aggregation in response['aggregations'].items()
+        }
+    return result
+
+
+def _cache_key(params):
+    return SEARCH_CACHE_PREFIX + hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def _count(redis_conn, outcome):
+    try:
+        redis_conn.hincrby(SEARCH_CACHE_STATS_KEY, outcome, 1)
+    except RedisError as e:
+        logger.warning(f"Could not record search cache {outcome}: {str(e)}")
+
+def _period(now):
+    # Refresh periods since the epoch, a refresh off ('-1') counts as one second
+    return int(now // max(SEARCH_REFRESH_SECONDS, 1))
+
+def search_complaints(es, redis_conn, params, index=SEARCH_ALIAS):
+    # Cached entries carry the generation they were computed in, read in the same round trip.
+    # The generation is the period by which the last indexed complaints are searchable, and
+    # the current period until then, so entries computed before the refresh do not outlive it.
+    key = _cache_key(params)
+    generation = None
+    if SEARCH_CACHE_TTL > 0:
+        try:
+            pipe = redis_conn.pipeline(transaction=False)
+            pipe.get(SEARCH_GENERATION_KEY)
+            pipe.get(key)
+            searchable, cached = pipe.execute()
+            generation = str(min(int(searchable or 0), _period(time.time())))
+            if cached is not None:
+                entry = json.loads(cached)
+                if entry['generation'] == generation:
+                    _count(redis_conn, 'hit')
+                    return dict(entry['result'], cached=True)
+            _count(redis_conn, 'miss')
+        except RedisError as e:
+            logger.warning(f"Search cache unavailable: {str(e)}")
+
+    result = format_response(params, es.search(index=index, body=build_query(params)))
+
+    if generation is not None:
+        try:
+            redis_conn.set(key, json.dumps({'generation': generation, 'result': result}), ex=SEARCH_CACHE_TTL)
+        except RedisError as e:
+            logger.warning(f"Could not cache search result: {str(e)}")
+    return dict(result, cached=False)
+
+def invalidate_search_cache(redis_conn):
+    # Called after complaints are indexed. They are searchable after the next refresh, at the
+    # latest two periods on, which retires every result cached until then.
+    try:
+        redis_conn.set(SEARCH_GENERATION_KEY, _period(time.time()) + 2)
+    except RedisError as e:
+        logger.warning(f"Could not invalidate the search cache: {str(e)}")
@@ -0,0 +1,322 @@
+# aggregator/search_index.py
+#
+# Managed Elasticsearch layout for complaints. An index template maps the
+# searchable fields of every modality (summary, issue, transcript, OCR text,
+# key phrases, labels, sentiment) with explicit types, and copies the free text
+# into one `content` field for full-text search. Complaints are written through
+# the `complaints` alias to time-based indices (complaints-000001, ...) that
+# roll over by age, size or document count. Backfills run inside bulk_ingest,
+# which turns refresh off and drops replicas on the write index until they end.
+#
+#   python search_index.py setup [--migrate-legacy]   # template, first index and alias
+#   python search_index.py rollover [--force]         # roll over when a condition is met
+#   python search_index.py restore                    # undo bulk_ingest settings left by a crashed backfill
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from elasticsearch import ElasticsearchException, NotFoundError
+from agents.resources import resources
+
+logger = logging.getLogger(__name__)
+
+SEARCH_ALIAS = os.environ.get('SEARCH_ALIAS', 'complaints')
+SEARCH_SHARDS = int(os.environ.get('SEARCH_SHARDS', 1))
+SEARCH_REPLICAS = int(os.environ.get('SEARCH_REPLICAS', 0))
+# Write-heavy ingestion: fewer, larger segments than the 1s default. search.py retires
+# cached results at most once per this interval.
+SEARCH_REFRESH_INTERVAL = os.environ.get('SEARCH_REFRESH_INTERVAL', '5s')
+SEARCH_ROLLOVER_MAX_AGE = os.environ.get('SEARCH_ROLLOVER_MAX_AGE', '30d')
+SEARCH_ROLLOVER_MAX_SIZE = os.environ.get('SEARCH_ROLLOVER_MAX_SIZE', '25gb')
+SEARCH_ROLLOVER_MAX_DOCS = int(os.environ.get('SEARCH_ROLLOVER_MAX_DOCS', 0))
+# How often each writing process asks Elasticsearch whether the write index should roll over
+SEARCH_ROLLOVER_CHECK_SECONDS = float(os.environ.get('SEARCH_ROLLOVER_CHECK_SECONDS', 600))
+# How often setup --migrate-legacy checks on the copy of a legacy index
+SEARCH_MIGRATION_POLL_SECONDS = float(os.environ.get('SEARCH_MIGRATION_POLL_SECONDS', 5))
+
+TEMPLATE_NAME = f"{SEARCH_ALIAS}-template"
+BULK_INGEST_KEY_PREFIX = 'search:bulk-ingest:'
+
+_TEXT = {'type': 'text', 'copy_to': 'content'}
+COMPLAINT_MAPPINGS = {
+    # Unmapped content fields stay in _source without growing the mapping
+    'dynamic': False,
+    'properties': {
+        'complaint_id': {'type': 'long'},
+        'type': {'type': 'keyword'},
+        'category': {'type': 'keyword', 'fields': {'text': {'type': 'text'}}},
+        'created_at': {'type': 'date'},
+        # All free text of a complaint, whatever its modality
+        'content': {'type': 'text'},
+        'summary': _TEXT,
+        'transcript': _TEXT,
+        'ocr_text': _TEXT,
+        'issue': {'type': 'keyword', 'copy_to': 'content'},
+        'sub_issue': {'type': 'keyword', 'copy_to': 'content'},
+        'key_phrases': {'type': 'keyword', 'ignore_above': 256, 'copy_to': 'content'},
+        'labels': {'type': 'keyword'},
+        'sentiment_label': {'type': 'keyword'},
+        # -1 (negative) to 1 (positive) for every modality
+        'sentiment_score': {'type': 'float'},
+        'sentiment_magnitude': {'type': 'float'},
+    }
+}
+
+def interval_seconds(interval):
+    # Elasticsearch time value such as '5s', '500ms' or '1m'; '-1' (refresh off) is 0
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    for unit in ('ms', 's', 'm', 'h'):
+        if interval.endswith(unit) and interval[:-len(unit)].isdigit():
+            return int(interval[:-len(unit)]) * units[unit]
+    return 0.0
+
+def index_settings():
+    return {
+        'number_of_shards': SEARCH_SHARDS,
+        'number_of_replicas': SEARCH_REPLICAS,
+        'refresh_interval': SEARCH_REFRESH_INTERVAL,
+    }
+
+def _strings(values):
+    return [value for value in values if isinstance(value, str) and value]
+
+def search_document(record, complaint_id):
+    # Searchable fields of the analysis, by the keys each agent produces
+    content = record['content'] if isinstance(record.get('content'), dict) else {}
+    document = {
+        'complaint_id': complaint_id,
+        'type': record['type'],
+        'category': record['category'],
+        'created_at': record['created_at'],
+    }
+    for field in ('summary', 'issue', 'sub_issue', 'transcript'):
+        if isinstance(content.get(field), str) and content[field]:
+            document[field] = content[field]
+    if isinstance(content.get('key_phrases'), list):
+        document['key_phrases'] = _strings(content['key_phrases'])
+
+    # Image OCR is one string, video OCR one entry per detected text
+    ocr = [content['text']] if isinstance(content.get('text'), str) else \
+        [item.get('text') for item in content.get('texts') or [] if isinstance(item, dict)]
+    if _strings(ocr):
+        document['ocr_text'] = '\n'.join(_strings(ocr))
+    labels = [item.get('description') or item.get('name')
+              for item in (content.get('labels') or []) + (content.get('objects') or []) if isinstance(item, dict)]
+    if _strings(labels):
+        document['labels'] = sorted(set(_strings(labels)))
+
+    # The text agent labels sentiment with a 0-1 confidence, the Google agents score it from -1 to 1
+    sentiment = content.get('sentiment')
+    if isinstance(sentiment, dict) and isinstance(sentiment.get('score'), (int, float)):
+        if sentiment.get('label') in ('POSITIVE', 'NEGATIVE'):
+            document['sentiment_label'] = sentiment['label']
+            sign = 1 if sentiment['label'] == 'POSITIVE' else -1
+            document['sentiment_score'] = sign * sentiment['score']
+        else:
+            document['sentiment_score'] = sentiment['score']
+            if isinstance(sentiment.get('magnitude'), (int, float)):
+                document['sentiment_magnitude'] = sentiment['magnitude']
+    return document
+
+
+def put_template(es):
+    es.indices.put_index_template(name=TEMPLATE_NAME, body={
+        'index_patterns': [f"{SEARCH_ALIAS}-*"],
+        'template': {'settings': index_settings(), 'mappings': COMPLAINT_MAPPINGS},
+    })
+
+def is_legacy_index(es, alias=SEARCH_ALIAS):
+    # An index created by dynamic mapping under the alias name, before the template
+    return es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias)
+
+def create_first_index(es, alias=SEARCH_ALIAS):
+    # Indices are named <alias>-000001, ... so rollover can number the next one
+    es.indices.create(index=f"{alias}-000001", body={'aliases': {alias: {'is_write_index': True}}})
+
+def migrate_legacy_index(es, alias=SEARCH_ALIAS):
+    # Copies the documents of the dynamic-mapped index, whose 'content' held the summary, into
+    # the first templated index and swaps the alias in for it in one atomic call. Complaints
+    # indexed meanwhile are restored by reindexing from Postgres. The legacy index is only
+    # removed once every document was copied, so a failed migration can be run again.
+    target = f"{alias}-000001"
+    if es.indices.exists(index=target):
+        # Nothing is written to it before the swap, it is what an interrupted migration left
+        logger.warning(f"Deleting {target} left by an interrupted migration")
+        es.indices.delete(index=target)
+    es.indices.create(index=target)
+    task_id = es.reindex(body={
+        'source': {'index': alias},
+        'dest': {'index': target},
+        'script': {'lang': 'painless', 'source':
+                   "ctx._source.summary = ctx._source.remove('content'); ctx._source.complaint_id = "
+                   "Long.parseLong(ctx._id)"},
+    }, wait_for_completion=False)['task']
+    # Polled as a task, so a long copy is not bound by an HTTP timeout
+    task = es.tasks.get(task_id=task_id)
+    while not task.get('completed'):
+        time.sleep(SEARCH_MIGRATION_POLL_SECONDS)
+        task = es.tasks.get(task_id=task_id)
+    response = task.get('response') or {}
+    if task.get('error') or response.get('failures') or response.get('timed_out'):
+        error = task.get('error') or response.get('failures', [])[:3] or 'timed out'
+        raise RuntimeError(f"Migrating '{alias}' to {target} failed, the legacy index is kept: {error}")
+    es.indices.update_aliases(body={'actions': [
+        {'add': {'index': target, 'alias': alias, 'is_write_index': True}},
+        {'remove_index': {'index': alias}},
+    ]})
+    logger.info(f"Moved {response.get('created', 0)} documents from the legacy index to {target}")
+
+def setup_search_index(es, alias=SEARCH_ALIAS, migrate_legacy=False):
+    put_template(es)
+    if is_legacy_index(es, alias):
+        if not migrate_legacy:
+            logger.warning(f"'{alias}' is an index created without the template, complaints are written to it "
+                           f"until `python search_index.py setup --migrate-legacy` is run")
+            return False
+        migrate_legacy_index(es, alias)
+    elif not es.indices.exists_alias(name=alias):
+        create_first_index(es, alias)
+        logger.info(f"Created {alias}-000001 behind the '{alias}' alias")
+    return True
+
+
+_setup_lock = threading.Lock()
+_setup_done = False
+_templated = False
+_last_rollover_check = 0.0
+
+def ensure_search_index(es):
+    # Template and write alias before the first bulk request of the process
+    global _setup_done, _templated
+    with _setup_lock:
+        if not _setup_done:
+            try:
+                _templated = setup_search_index(es)
+                _setup_done = True
+            except ElasticsearchException as e:
+                # The bulk request reports the same failure per complaint
+                logger.warning(f"Could not set up the search index: {str(e)}")
+
+def rollover_conditions():
+    conditions = {'max_age': SEARCH_ROLLOVER_MAX_AGE, 'max_size': SEARCH_ROLLOVER_MAX_SIZE}
+    if SEARCH_ROLLOVER_MAX_DOCS:
+        conditions['max_docs'] = SEARCH_ROLLOVER_MAX_DOCS
+    return conditions
+
+def rollover(es, alias=SEARCH_ALIAS, force=False):
+    # Elasticsearch evaluates the conditions, concurrent callers roll over at most once
+    response = es.indices.rollover(alias=alias, body=None if force else {'conditions': rollover_conditions()})
+    if response.get('rolled_over'):
+        logger.info(f"Rolled '{alias}' over from {response['old_index']} to {response['new_index']}")
+    return response
+
+def maybe_rollover(es):
+    # Called by writers, asks at most every SEARCH_ROLLOVER_CHECK_SECONDS per process
+    global _last_rollover_check
+    if not _templated or time.monotonic() - _last_rollover_check < SEARCH_ROLLOVER_CHECK_SECONDS:
+        return
+    _last_rollover_check = time.monotonic()
+    try:
+        rollover(es)
+    except ElasticsearchException as e:
+        logger.warning(f"Rollover check failed: {str(e)}")
+
+
+def next_index_name(es, alias=SEARCH_ALIAS):
+    # <alias>-NNNNNN after the highest existing one, so rollover keeps numbering from it
+    numbers = [int(name[len(alias) + 1:]) for name in es.indices.get(index=f"{alias}-*")
+               if name[len(alias) + 1:].isdigit()]
+    return f"{alias}-{max(numbers, default=0) + 1:06d}"
+
+def aliased_indices(es, alias=SEARCH_ALIAS):
+    return list(es.indices.get_alias(name=alias)) if es.indices.exists_alias(name=alias) else []
+
+def swap_alias(es, index, alias=SEARCH_ALIAS):
+    # Makes index the only index behind the alias, and its write index, in one atomic call.
+    # Returns the indices taken out, which are left in place.
+    old = [name for name in aliased_indices(es, alias) if name != index]
+    es.indices.update_aliases(body={'actions': [{'add': {'index': index, 'alias': alias, 'is_write_index': True}}]
+                                    + [{'remove': {'index': name, 'alias': alias}} for name in old]})
+    logger.info(f"'{alias}' now points to {index} instead of {', '.join(old) or 'nothing'}")
+    return old
+
+def write_index(es, alias=SEARCH_ALIAS):
+    if not es.indices.exists_alias(name=alias):
+        return alias
+    indices = es.indices.get_alias(name=alias)
+    for index, info in indices.items():
+        if info['aliases'][alias].get('is_write_index'):
+            return index
+    return next(iter(indices))
+
+def _restore_settings(es, redis_conn, index):
+    key = f"{BULK_INGEST_KEY_PREFIX}{index}"
+    saved = {field.decode(): value.decode() for field, value in redis_conn.hgetall(key).items()}
+    try:
+        # Settings that were not set explicitly go back to the template's defaults
+        es.indices.put_settings(index=index, body={'index': {
+            'refresh_interval': saved.get('refresh_interval') or None,
+            'number_of_replicas': saved.get('number_of_replicas') or None,
+        }})
+        es.indices.refresh(index=index)
+    except NotFoundError:
+        logger.warning(f"Index {index} no longer exists, dropping its saved settings")
+    redis_conn.delete(key)
+    logger.info(f"Restored refresh and replica settings of {index}")
+
+@contextmanager
+def bulk_ingest(es=None, redis_conn=None, alias=SEARCH_ALIAS):
+    # Backfills share the write index; the first one in saves its settings and the last one
+    # out restores them. The saved settings are kept in Redis so `restore` can recover them
+    # after a crash.
+    es = es or resources.elasticsearch
+    redis_conn = redis_conn or resources.redis
+    index = write_index(es, alias)
+    key = f"{BULK_INGEST_KEY_PREFIX}{index}"
+    if redis_conn.hincrby(key, 'holders', 1) == 1:
+        settings = es.indices.get_settings(index=index)[index]['settings']['index']
+        redis_conn.hset(key, mapping={'refresh_interval': settings.get('refresh_interval', ''),
+                                      'number_of_replicas': settings.get('number_of_replicas', '')})
+        es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+        logger.info(f"Bulk ingest into {index}: refresh off, no replicas")
+    try:
+        yield index
+    finally:
+        if redis_conn.hincrby(key, 'holders', -1) <= 0:
+            _restore_settings(es, redis_conn, index)
+
+def restore_bulk_ingest(es, redis_conn):
+    for key in redis_conn.scan_iter(f"{BULK_INGEST_KEY_PREFIX}*"):
+        _restore_settings(es, redis_conn, key.decode()[len(BULK_INGEST_KEY_PREFIX):])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the complaints search indices')
+    commands = parser.add_subparsers(dest='command', required=True)
+    setup_parser = commands.add_parser('setup', help='Install the template and create the first index and alias')
+    setup_parser.add_argument('--migrate-legacy', action='store_true',
+                              help=f"Move the documents of a dynamic-mapped '{SEARCH_ALIAS}' index behind the alias")
+    rollover_parser = commands.add_parser('rollover', help='Roll the write index over when a condition is met')
+    rollover_parser.add_argument('--force', action='store_true', help='Roll over regardless of the conditions')
+    commands.add_parser('restore', help='Restore settings changed by an interrupted bulk ingest')
+    args = parser.parse_args()
+
+    es = resources.elasticsearch
+    if args.command == 'setup':
+        if not setup_search_index(es, migrate_legacy=args.migrate_legacy):
+            sys.exit(1)
+    elif args.command == 'rollover':
+        response = rollover(es, force=args.force)
+        print(f"rolled_over={response.get('rolled_over')} new_index={response.get('new_index')} "
+              f"conditions={response.get('conditions')}")
+    else:
+        restore_bulk_ingest(es, resources.redis)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,55 +1,171 @@
 # aggregator/tasks.py
 
+import time
+import uuid
 import logging
-from agents.text_agent import process_text_complaint
-from agents.voice_agent import process_voice_complaint
-from agents.image_agent import process_image_complaint
-from agents.video_agent import process_video_complaint
-from database import SessionLocal, Complaint, es
+import inspect
+import importlib
+from rq import Queue, get_current_job
+from rq.job import Job
+from agents.resources import resources
+from agents.delivery import record_pipeline
+from dedup import check_duplicate
+from persistence import make_record, persist_complaints
+from queues import record_queue_wait
 
 logger = logging.getLogger(__name__)
 
+redis_conn = resources.redis
+
+# Agents are imported on the first complaint of their modality, so a worker that
+# only sees text never loads OpenCV, pydub or the Google Cloud clients
+AGENT_MODULES = {
+    'text': 'agents.text_agent',
+    'voice': 'agents.voice_agent',
+    'image': 'agents.image_agent',
+    'video': 'agents.video_agent',
+}
+
+def load_agent(complaint_type):
+    return importlib.import_module(AGENT_MODULES[complaint_type])
+
+def embed_stage(records, complaint_type):
+    # Sentence embeddings for similarity search, stored with the complaints. Imported on first
+    # use so that worker start-up does not load numpy or the model.
+    start = time.perf_counter()
+    embedded = importlib.import_module('agents.embedding').embed_records(records)
+    if embedded:
+        record_pipeline(redis_conn, complaint_type, embedded=embedded, embed_seconds=time.perf_counter() - start)
+
 def process_complaint(data):
     logger.info(f"Starting to process complaint: {data}")
     complaint_type = data.get('type')
     content = data.get('content')
     
-    if complaint_type == 'text':
-        processed_data = process_text_complaint(content)
-    elif complaint_type == 'voice':
-        processed_data = process_voice_complaint(content)
-    elif complaint_type == 'image':
-        processed_data = process_image_complaint(content)
-    elif complaint_type == 'video':
-        processed_data = process_video_complaint(content)
-    else:
+    if complaint_type not in AGENT_MODULES:
         logger.error(f"Unknown complaint type: {complaint_type}")
         return None
+    job = get_current_job()
+    record_queue_wait(redis_conn, complaint_type, job)
+    record_id = job.id if job else str(uuid.uuid4())
+
+    # A near-duplicate of a recent complaint reuses its analysis instead of calling the agent
+    claim = check_duplicate(redis_conn, complaint_type, content, record_id)
+    if claim is not None and claim.analysis is not None:
+        processed_data = claim.analysis
+        record_pipeline(redis_conn, complaint_type, duplicates=1)
+    else:
+        agent = load_agent(complaint_type)
+        process = getattr(agent, f"process_{complaint_type}_complaint")
+        # Per-request options, e.g. image preprocessing stages, only for agents that take them
+        options = data.get('options')
+        if options and 'options' not in inspect.signature(process).parameters:
+            logger.warning(f"Ignoring options of {complaint_type} complaint, its agent takes none")
+            options = None
+        start = time.perf_counter()
+        try:
+            processed_data = process(content, options=options) if options else process(content)
+        except Exception:
+            if claim is not None:
+                claim.release()
+            raise
+        seconds = time.perf_counter() - start
+        record_pipeline(redis_conn, complaint_type, complaints=1, seconds=seconds)
+
+        if processed_data.get('delivered') == 'http':
+            # The agent already handed the analysis to /aggregate, whose own job stores it
+            if claim is not None:
+                claim.release()
+            return processed_data
+        if claim is not None:
+            claim.publish(processed_data, seconds)
 
     category = processed_data.get('category')
     logger.info(f"Complaint processed. Category: {category}")
-    
+    record = make_record(record_id, complaint_type, processed_data['content'], category)
+    result = store_record(record, processed_data)
+    if claim is not None and result is not None:
+        claim.stored(result['complaint_id'])
+    return result
+
+def store_complaint(data):
+    # /aggregate: analysis from an agent outside the worker pools, only persisted
+    logger.info(f"Storing {data.get('type')} complaint analyzed by a remote agent")
+    job = get_current_job()
+    record_queue_wait(redis_conn, data.get('type'), job)
+    record = make_record(job.id if job else str(uuid.uuid4()), data.get('type'), data.get('content'),
+                         data.get('category'))
+    return store_record(record, data)
+
+def store_record(record, processed_data):
+    # One insert and one index request per complaint, however it was delivered
+    embed_stage([record], record['type'])
     try:
-        session = SessionLocal()
-        new_complaint = Complaint(type=complaint_type, content=processed_data, category=category)
-        session.add(new_complaint)
-        session.commit()
-        complaint_id = new_complaint.id
-        
-        es.index(index='complaints', id=complaint_id, body={
-            'type': complaint_type,
-            'content': processed_data.get('summary', ''),
-            'category': category
-        })
-        
-        logger.info(f"Processed complaint ID: {complaint_id}")
+        result, = persist_complaints(redis_conn, [record])
+        if result.get('error'):
+            logger.error(f"Error storing complaint: {result['error']}")
+            if result['complaint_id'] is None:
+                return None
+
+        logger.info(f"Processed complaint ID: {result['complaint_id']}")
         return {
-            'complaint_id': complaint_id,
-            'category': category,
+            'complaint_id': result['complaint_id'],
+            'record_id': record['record_id'],
+            'category': record['category'],
             'processed_data': processed_data
         }
     except Exception as e:
         logger.error(f"Error processing complaint: {str(e)}")
         return None
-    finally:
-        session.close()
\ No newline at end of file
+
+def process_complaint_batch(items, complaint_type='text'):
+    # Text complaints are packed into as few LLM requests as the context allows,
+    # image complaints are annotated many to a Vision request
+    logger.info(f"Starting to process batch of {len(items)} {complaint_type} complaints")
+    job = get_current_job()
+    record_queue_wait(redis_conn, complaint_type, job)
+    agent = load_agent(complaint_type)
+    analyses = getattr(agent, f"analyze_{complaint_type}_complaints")([item.get('content') for item in items])
+
+    batch_id = job.id if job else str(uuid.uuid4())
+    # Complaints the agent could not analyze have no record and a None result
+    analyzed = [index for index, analysis in enumerate(analyses) if analysis is not None]
+    records = [make_record(f"{batch_id}:{index}", complaint_type, analyses[index][0], analyses[index][1])
+               for index in analyzed]
+    embed_stage(records, complaint_type)
+    try:
+        # One multi-row insert and one bulk index request for the whole batch
+        stored = persist_complaints(redis_conn, records)
+    except Exception as e:
+        # The analyses are already paid for: they are returned without a complaint ID
+        logger.error(f"Error storing complaint batch: {str(e)}")
+        stored = [{'complaint_id': None, 'error': str(e)} for _ in records]
+
+    results = [None] * len(items)
+    for index, record, result in zip(analyzed, records, stored):
+        results[index] = {
+            'complaint_id': result['complaint_id'],
+            'record_id': record['record_id'],
+            'category': record['category'],
+            'processed_data': record['content']
+        }
+        if result.get('error') and result['complaint_id'] is None and result.get('status') != 'persisting':
+            logger.error(f"Error storing complaint {record['record_id']}: {result['error']}")
+            results[index]['error'] = result['error']
+    logger.info(f"Processed batch of {len(results)} complaints")
+    return results
+
+def release_batch_results(job, connection, exc_type, exc_value, traceback):
+    # on_failure of a batch job. RQ leaves the dependents of a failed job deferred for good, so the
+    # per-complaint jobs are enqueued here and fail with the batch's error instead of never finishing.
+    job.meta['error'] = f"{exc_type.__name__}: {exc_value}"
+    job.save_meta()
+    Queue(job.origin, connection=connection).enqueue_dependents(job)
+
+def collect_batch_result(batch_job_id, index):
+    # Runs after the batch job so every complaint of a batch keeps its own job ID
+    batch_job = Job.fetch(batch_job_id, connection=get_current_job().connection)
+    if batch_job.meta.get('error'):
+        raise RuntimeError(f"Batch job {batch_job_id} failed: {batch_job.meta['error']}")
+    results = batch_job.result or []
+    return results[index] if index < len(results) else None
@@ -2,14 +2,13 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
-from elasticsearch import Elasticsearch, ElasticsearchException
+from elasticsearch import ElasticsearchException
 from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from redis import Redis
 from rq import Queue
 from celery import Celery
 from celery.result import AsyncResult
@@ -30,6 +29,7 @@ from text_agent import process_text_complaint
 from voice_agent import process_voice_complaint
 from image_agent import process_image_complaint
 from video_agent import process_video_complaint
+from agents.resources import resources
 
 
 def create_app():
@@ -130,11 +130,10 @@ def create_app():
             engine, Session, Complaint = setup_database()
 
         # Initialize Elasticsearch
-        es = Elasticsearch([os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')])
+        es = resources.elasticsearch
 
         # Initialize Redis and RQ
-        redis_conn = Redis(host=os.environ.get('REDIS_HOST', 'localhost'),
-                        port=int(os.environ.get('REDIS_PORT', 6379)))
+        redis_conn = resources.redis
         task_queue = Queue(connection=redis_conn)
 
     # Initialize Celery
@@ -175,9 +174,8 @@ def create_app():
         logger.info(f"Complaint processed. Category: {category}")
         
         try:
-            # Create a new session for this task
-            Session = sessionmaker(bind=engine)
-            session = Session()
+            # Sessions come from the shared factory so tasks reuse pooled connections
+            session = resources.session_factory()
             
             new_complaint = Complaint(type=complaint_type, content=processed_data, category=category)
             session.add(new_complaint)
@@ -0,0 +1,524 @@
+# aggregator/vector_index.py
+#
+# Approximate nearest-neighbour search over complaint embeddings, in flat files
+# that every process memory-maps instead of loading. Vectors are stored as int8
+# with one float32 scale per vector, a quarter of their float32 size. `build`
+# clusters them with spherical k-means and writes them in the order of their
+# nearest centroid (IVF): a query scores the centroids, then only the vectors
+# of the VECTOR_PROBES closest lists. Complaints embedded since the last build
+# are appended to a tail that every query scans in full, until the next build
+# folds it in (queued automatically once it holds VECTOR_REBUILD_TAIL_ROWS).
+#
+#   python vector_index.py build [--lists 1024] [--reembed] [--enqueue]
+#   python vector_index.py query "charged twice for one purchase" [--k 10]
+#   python vector_index.py status
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import logging
+import argparse
+from contextlib import contextmanager
+import numpy as np
+from elasticsearch import ElasticsearchException
+from redis import RedisError
+from agents.resources import resources
+from agents.embedding import decode_vector, embed_texts, embedding_text, get_embedder
+from queues import get_maintenance_queue
+from search import SOURCE_FIELDS
+from search_index import SEARCH_ALIAS
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', 'data/vectors')
+# Inverted lists of a build, 0 picks about sqrt(vectors)
+VECTOR_LISTS = int(os.environ.get('VECTOR_LISTS', 0))
+# Lists scanned per query: more is slower and closer to exact
+VECTOR_PROBES = int(os.environ.get('VECTOR_PROBES', 16))
+VECTOR_DEFAULT_K = int(os.environ.get('VECTOR_DEFAULT_K', 10))
+VECTOR_MAX_K = int(os.environ.get('VECTOR_MAX_K', 100))
+VECTOR_TRAIN_SAMPLE = int(os.environ.get('VECTOR_TRAIN_SAMPLE', 100000))
+VECTOR_TRAIN_ITERATIONS = int(os.environ.get('VECTOR_TRAIN_ITERATIONS', 10))
+# Every query scans the tail in full, about 0.6 ms per 1000 vectors
+VECTOR_REBUILD_TAIL_ROWS = int(os.environ.get('VECTOR_REBUILD_TAIL_ROWS', 20000))
+VECTOR_BUILD_TIMEOUT = int(os.environ.get('VECTOR_BUILD_TIMEOUT', 24 * 3600))
+
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = '.lock'
+META_FILE = 'meta.json'
+VECTOR_BUILD_LOCK = 'vectors:build:lock'
+VECTOR_BUILD_QUEUED_KEY = 'vectors:build:queued'
+# Rows dequantized at a time by builds and tail scans
+CHUNK_ROWS = 65536
+
+
+def quantize(vectors):
+    # Symmetric int8 per vector: vector ~= codes * scale
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def _scores(codes, scales, query):
+    return (codes.astype(np.float32) @ query) * scales
+
+def _map(path, dtype, shape):
+    # np.memmap cannot map an empty file
+    if not shape[0]:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+def _rows(path, itemsize):
+    return os.path.getsize(path) // itemsize if os.path.exists(path) else 0
+
+
+class VectorIndex:
+    # One generation: the IVF lists of the last build plus the tail appended since
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.dim, self.lists, self.count = self.meta['dim'], self.meta['lists'], self.meta['count']
+        self.embedder = self.meta['embedder']
+        self.centroids = _map(self._file('centroids.f32'), np.float32, (self.lists, self.dim))
+        self.offsets = np.fromfile(self._file('offsets.i64'), dtype=np.int64) if self.lists else np.zeros(1, np.int64)
+        self.codes = _map(self._file('codes.i8'), np.int8, (self.count, self.dim))
+        self.scales = _map(self._file('scales.f32'), np.float32, (self.count,))
+        self.ids = _map(self._file('ids.i64'), np.int64, (self.count,))
+        self.tail = (np.empty((0, self.dim), np.int8), np.empty(0, np.float32), np.empty(0, np.int64))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def refresh_tail(self):
+        # Ids are appended last, so their count is the number of complete rows
+        rows = _rows(self._file('tail.ids.i64'), 8)
+        if rows != len(self.tail[2]):
+            self.tail = (_map(self._file('tail.codes.i8'), np.int8, (rows, self.dim)),
+                         _map(self._file('tail.scales.f32'), np.float32, (rows,)),
+                         _map(self._file('tail.ids.i64'), np.int64, (rows,)))
+        return self.tail
+
+    def __len__(self):
+        return self.count + len(self.refresh_tail()[2])
+
+    def search(self, query, k=VECTOR_DEFAULT_K, probes=VECTOR_PROBES, exclude=()):
+        # [(complaint_id, cosine similarity)], best first
+        query = np.asarray(query, dtype=np.float32)
+        scores, ids = [], []
+        if self.lists:
+            nearest = np.argsort(-(self.centroids @ query))[:min(probes, self.lists)]
+            for lst in nearest:
+                start, end = self.offsets[lst], self.offsets[lst + 1]
+                if end > start:
+                    scores.append(_scores(self.codes[start:end], self.scales[start:end], query))
+                    ids.append(self.ids[start:end])
+        codes, scales, tail_ids = self.refresh_tail()
+        for start in range(0, len(tail_ids), CHUNK_ROWS):
+            scores.append(_scores(codes[start:start + CHUNK_ROWS], scales[start:start + CHUNK_ROWS], query))
+            ids.append(tail_ids[start:start + CHUNK_ROWS])
+        if not scores:
+            return []
+        scores, ids = np.concatenate(scores), np.concatenate(ids)
+
+        # A few extra candidates for complaints stored twice and excluded ones
+        keep = min(len(scores), 2 * k + len(exclude) + 8)
+        top = np.argpartition(-scores, keep - 1)[:keep] if keep < len(scores) else np.arange(len(scores))
+        neighbors, seen = [], set(exclude)
+        for row in top[np.argsort(-scores[top])]:
+            complaint_id = int(ids[row])
+            if complaint_id not in seen:
+                seen.add(complaint_id)
+                neighbors.append((complaint_id, float(scores[row])))
+                if len(neighbors) == k:
+                    break
+        return neighbors
+
+    def vector(self, complaint_id):
+        # The stored (dequantized) vector of a complaint, the latest when it was added twice
+        codes, scales, tail_ids = self.refresh_tail()
+        for codes, scales, ids in ((codes, scales, tail_ids), (self.codes, self.scales, self.ids)):
+            rows = np.flatnonzero(ids == complaint_id)
+            if len(rows):
+                return codes[rows[-1]].astype(np.float32) * scales[rows[-1]]
+        return None
+
+
+def current_generation(directory=VECTOR_INDEX_DIR):
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def _set_current(directory, path):
+    temporary = os.path.join(directory, f"{CURRENT_FILE}.tmp")
+    with open(temporary, 'w') as f:
+        f.write(os.path.basename(path))
+    os.replace(temporary, os.path.join(directory, CURRENT_FILE))
+
+def _new_generation(directory, dim, embedder):
+    path = os.path.join(directory, f"gen-{time.time_ns()}")
+    os.makedirs(path)
+    _write_meta(path, {'dim': dim, 'embedder': embedder, 'lists': 0, 'count': 0})
+    return path
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(dict(meta, updated_at=time.time()), f)
+
+@contextmanager
+def _locked(directory):
+    # Appends and generation swaps of every process on the shared disk are serialized
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+def _append(path, ids, codes, scales):
+    # Ids go last: a row only exists once its id is written. A partial row left by a crashed
+    # writer is cut off before the next append so the three files stay aligned.
+    rows = _rows(os.path.join(path, 'tail.ids.i64'), 8)
+    dim = codes.shape[1]
+    for name, itemsize, array in (('tail.codes.i8', dim, codes), ('tail.scales.f32', 4, scales),
+                                  ('tail.ids.i64', 8, np.asarray(ids, dtype=np.int64))):
+        with open(os.path.join(path, name), 'ab') as f:
+            f.truncate(rows * itemsize)
+            f.write(np.ascontiguousarray(array).tobytes())
+    return rows + len(ids)
+
+def append_vectors(ids, vectors, embedder, directory=VECTOR_INDEX_DIR):
+    # Returns the number of rows in the tail
+    codes, scales = quantize(vectors)
+    with _locked(directory):
+        path = current_generation(directory)
+        if path is None:
+            path = _new_generation(directory, codes.shape[1], embedder)
+            _set_current(directory, path)
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['dim'] != codes.shape[1] or meta['embedder'] != embedder:
+            raise ValueError(f"The vector index holds {meta['dim']}-d vectors of '{meta['embedder']}', not "
+                             f"{codes.shape[1]}-d vectors of '{embedder}'. Rebuild it with --reembed.")
+        return _append(path, ids, codes, scales)
+
+def add_complaint_vectors(redis_conn, records):
+    # [(complaint_id, record)] of stored complaints, records carry the base64 embedding
+    # added by the embedding stage. Failures are logged, a rebuild with --reembed restores them.
+    by_embedder = {}
+    for complaint_id, record in records:
+        by_embedder.setdefault(record['embedding_model'], []).append(
+            (complaint_id, decode_vector(record['embedding'])))
+    for embedder, vectors in by_embedder.items():
+        try:
+            tail_rows = append_vectors([complaint_id for complaint_id, _ in vectors],
+                                       np.stack([vector for _, vector in vectors]), embedder)
+        except Exception as e:
+            logger.warning(f"Could not add {len(vectors)} complaint vectors: {str(e)}")
+            continue
+        if tail_rows >= VECTOR_REBUILD_TAIL_ROWS:
+            queue_build(redis_conn)
+
+def queue_build(redis_conn):
+    # At most one queued or running build, whichever process notices the tail first
+    try:
+        if redis_conn.set(VECTOR_BUILD_QUEUED_KEY, 1, nx=True, ex=VECTOR_BUILD_TIMEOUT):
+            enqueue_build(redis_conn)
+            logger.info("Queued a vector index build")
+    except RedisError as e:
+        logger.warning(f"Could not queue a vector index build: {str(e)}")
+
+
+class IndexReader:
+    # The current generation of a directory, reopened when a build swaps in a new one
+    def __init__(self, directory=VECTOR_INDEX_DIR):
+        self.directory = directory
+        self.index = None
+
+    def get(self):
+        path = current_generation(self.directory)
+        if path is None:
+            return None
+        index = self.index
+        if index is None or index.path != path:
+            index = self.index = VectorIndex(path)
+        return index
+
+def open_index():
+    return resources.client('vector_index', IndexReader).get()
+
+
+def _kmeans(sample, lists, iterations, rng):
+    # Spherical k-means: centroids stay unit length and vectors go to the highest dot product
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=lists)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        centroids[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+        # Empty lists restart from random vectors
+        centroids[~filled] = sample[rng.choice(len(sample), int((~filled).sum()), replace=False)]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+def _assign(vectors, centroids):
+    return np.concatenate([np.argmax(vectors[start:start + CHUNK_ROWS] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), CHUNK_ROWS)]).astype(np.int64)
+
+def _dequantize(codes, scales, rows):
+    return codes[rows].astype(np.float32) * scales[rows, None]
+
+def _stage(path, dim, batches):
+    # Writes (ids, codes, scales) batches to staging files and maps them back
+    count = 0
+    with open(os.path.join(path, 'staging.ids.i64'), 'wb') as ids_file, \
+            open(os.path.join(path, 'staging.codes.i8'), 'wb') as codes_file, \
+            open(os.path.join(path, 'staging.scales.f32'), 'wb') as scales_file:
+        for ids, codes, scales in batches:
+            ids_file.write(np.asarray(ids, dtype=np.int64).tobytes())
+            codes_file.write(np.ascontiguousarray(codes).tobytes())
+            scales_file.write(np.ascontiguousarray(scales).tobytes())
+            count += len(ids)
+    return (_map(os.path.join(path, 'staging.ids.i64'), np.int64, (count,)),
+            _map(os.path.join(path, 'staging.codes.i8'), np.int8, (count, dim)),
+            _map(os.path.join(path, 'staging.scales.f32'), np.float32, (count,)))
+
+def _stored_batches(index, tail_rows):
+    for start in range(0, index.count, CHUNK_ROWS):
+        end = start + CHUNK_ROWS
+        yield index.ids[start:end], index.codes[start:end], index.scales[start:end]
+    codes, scales, ids = index.tail
+    for start in range(0, tail_rows, CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, tail_rows)
+        yield ids[start:end], codes[start:end], scales[start:end]
+
+def _reembedded_batches(chunk_size):
+    # Every stored complaint embedded again, e.g. after changing EMBEDDER
+    from database import ensure_schema
+    from reindex import read_windows
+
+    ensure_schema()
+    conn = resources.engine.raw_connection()
+    embedded = 0
+    try:
+        for rows in read_windows(conn, 0, chunk_size=chunk_size):
+            texts = [(complaint_id, embedding_text(content)) for complaint_id, _, content, _, _ in rows]
+            texts = [(complaint_id, text) for complaint_id, text in texts if text]
+            if texts:
+                codes, scales = quantize(embed_texts([text for _, text in texts]))
+                yield [complaint_id for complaint_id, _ in texts], codes, scales
+                embedded += len(texts)
+                logger.info(f"Embedded {embedded} complaints up to id {rows[-1][0]}")
+    finally:
+        conn.close()
+
+def build_index(directory=VECTOR_INDEX_DIR, lists=VECTOR_LISTS, reembed=False, chunk_size=256, seed=0):
+    lock = resources.redis.lock(VECTOR_BUILD_LOCK, timeout=VECTOR_BUILD_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info("A vector index build is already running")
+        return None
+    try:
+        return build_generation(directory, lists, reembed, chunk_size, seed)
+    finally:
+        lock.release()
+        resources.redis.delete(VECTOR_BUILD_QUEUED_KEY)
+
+def build_generation(directory=VECTOR_INDEX_DIR, lists=VECTOR_LISTS, reembed=False, chunk_size=256, seed=0):
+    # One build without the Redis lock, build_index is the entry point for jobs and the CLI
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+    with _locked(directory):
+        old_path = current_generation(directory)
+    old = VectorIndex(old_path) if old_path else None
+    # Rows appended from here on are carried over to the new generation's tail when it is swapped in
+    tail_rows = len(old.refresh_tail()[2]) if old else 0
+
+    if reembed:
+        embedder = get_embedder()
+        embedder_name, dim, batches = embedder.name, embedder.dim, _reembedded_batches(chunk_size)
+    elif old is None:
+        logger.info("No vectors to index yet")
+        return None
+    else:
+        embedder_name, dim, batches = old.embedder, old.dim, _stored_batches(old, tail_rows)
+    path = _new_generation(directory, dim, embedder_name)
+    ids, codes, scales = _stage(path, dim, batches)
+
+    # A complaint stored twice (at-least-once persistence) keeps its latest vector
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = np.sort(len(ids) - 1 - last)
+    count = len(keep)
+    if not count:
+        shutil.rmtree(path)
+        logger.info("No vectors to index yet")
+        return None
+    lists = min(count, lists or max(1, int(np.sqrt(count))))
+
+    sample = keep[np.sort(rng.choice(count, min(count, max(VECTOR_TRAIN_SAMPLE, 40 * lists)), replace=False))]
+    sample = _dequantize(codes, scales, sample)
+    sample /= np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+    centroids = _kmeans(sample, lists, VECTOR_TRAIN_ITERATIONS, rng)
+    del sample
+    assignments = np.concatenate([_assign(_dequantize(codes, scales, keep[start:start + CHUNK_ROWS]), centroids)
+                                  for start in range(0, count, CHUNK_ROWS)])
+    order = keep[np.argsort(assignments, kind='stable')]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=lists)))).astype(np.int64)
+
+    # Vectors of a list are contiguous on disk, a probe reads one range
+    out_codes = np.memmap(os.path.join(path, 'codes.i8'), dtype=np.int8, mode='w+', shape=(count, dim))
+    for start in range(0, count, CHUNK_ROWS):
+        out_codes[start:start + CHUNK_ROWS] = codes[order[start:start + CHUNK_ROWS]]
+    out_codes.flush()
+    del out_codes
+    np.asarray(scales[order]).tofile(os.path.join(path, 'scales.f32'))
+    np.asarray(ids[order]).tofile(os.path.join(path, 'ids.i64'))
+    centroids.astype(np.float32).tofile(os.path.join(path, 'centroids.f32'))
+    offsets.tofile(os.path.join(path, 'offsets.i64'))
+    del ids, codes, scales
+    for name in ('staging.ids.i64', 'staging.codes.i8', 'staging.scales.f32'):
+        os.remove(os.path.join(path, name))
+    _write_meta(path, {'dim': dim, 'embedder': embedder_name, 'lists': lists, 'count': count})
+
+    with _locked(directory):
+        # Vectors appended during the build move to the new tail, unless the build re-embedded them
+        carried = 0
+        if old is not None and old_path == current_generation(directory):
+            codes, scales, tail_ids = old.refresh_tail()
+            if len(tail_ids) > tail_rows and old.dim == dim and old.embedder == embedder_name:
+                new = VectorIndex(path)
+                fresh = tail_rows + np.flatnonzero(~np.isin(tail_ids[tail_rows:], new.ids))
+                if len(fresh):
+                    _append(path, tail_ids[fresh], codes[fresh], scales[fresh])
+                carried = len(fresh)
+        _set_current(directory, path)
+    _remove_old_generations(directory, keep_paths=(path, old_path))
+
+    summary = {'generation': os.path.basename(path), 'vectors': count, 'lists': lists, 'carried': carried,
+               'seconds': round(time.perf_counter() - start_time, 1)}
+    logger.info(f"Built vector index: {summary}")
+    return summary
+
+def _remove_old_generations(directory, keep_paths):
+    # The previous generation stays for readers that have not switched yet
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('gen-') and path not in keep_paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+def enqueue_build(connection, **options):
+    # Served by the maintenance pool, so it does not hold a complaint worker for hours
+    return get_maintenance_queue(connection).enqueue(build_index, kwargs=options, job_timeout=VECTOR_BUILD_TIMEOUT)
+
+
+def parse_similar_args(args):
+    # Query string of /search/similar, raises ValueError with a message for the client
+    if bool(args.get('q', '').strip()) == bool(args.get('complaint_id')):
+        raise ValueError('Pass either q or complaint_id')
+    try:
+        k = int(args.get('k', VECTOR_DEFAULT_K))
+        probes = int(args.get('probes', VECTOR_PROBES))
+        complaint_id = int(args['complaint_id']) if args.get('complaint_id') else None
+    except ValueError:
+        raise ValueError('k, probes and complaint_id must be integers')
+    if not 1 <= k <= VECTOR_MAX_K:
+        raise ValueError(f"k must be between 1 and {VECTOR_MAX_K}")
+    if probes < 1:
+        raise ValueError('probes must be positive')
+    fields = sorted(field.strip() for field in (args.get('fields') or '').split(',') if field.strip()) \
+        or list(SOURCE_FIELDS)
+    unknown = [field for field in fields if field not in SOURCE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Expected some of {', '.join(SOURCE_FIELDS)}")
+    return {'q': args.get('q', '').strip(), 'complaint_id': complaint_id, 'k': k, 'probes': probes,
+            'fields': fields, 'hydrate': args.get('hydrate', 'true').lower() not in ('0', 'false', 'no')}
+
+def similar_complaints(es, params):
+    # Raises LookupError when the complaint has no vector
+    start = time.perf_counter()
+    index = open_index()
+    if index is None:
+        return {'neighbors': [], 'took_ms': 0}
+    if params['complaint_id'] is not None:
+        query = index.vector(params['complaint_id'])
+        if query is None:
+            raise LookupError(f"Complaint {params['complaint_id']} has no vector")
+        query /= max(np.linalg.norm(query), 1e-12)
+    else:
+        embedder = get_embedder()
+        if embedder.name != index.embedder:
+            raise RuntimeError(f"The vector index was built with '{index.embedder}', queries are embedded "
+                               f"with '{embedder.name}'")
+        query = embed_texts([params['q']])[0]
+    embedded = time.perf_counter()
+
+    exclude = (params['complaint_id'],) if params['complaint_id'] is not None else ()
+    neighbors = index.search(query, params['k'], params['probes'], exclude)
+    result = {
+        'neighbors': [{'complaint_id': complaint_id, 'score': round(score, 4)} for complaint_id, score in neighbors],
+        'embed_ms': round((embedded - start) * 1000, 2),
+        'search_ms': round((time.perf_counter() - embedded) * 1000, 2),
+    }
+    if params['hydrate'] and neighbors:
+        # Searchable fields of the neighbors, in one request. The neighbors stand on their own
+        # if Elasticsearch cannot be reached.
+        try:
+            response = es.search(index=SEARCH_ALIAS, body={
+                'query': {'ids': {'values': [complaint_id for complaint_id, _ in neighbors]}},
+                'size': len(neighbors), '_source': params['fields']})
+            sources = {hit['_id']: hit['_source'] for hit in response['hits']['hits']}
+            for neighbor in result['neighbors']:
+                neighbor.update(sources.get(str(neighbor['complaint_id']), {}))
+        except ElasticsearchException as e:
+            logger.warning(f"Could not fetch similar complaints from Elasticsearch: {str(e)}")
+    result['took_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the complaint vector index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='Cluster every vector into a new IVF generation')
+    build_parser.add_argument('--lists', type=int, default=VECTOR_LISTS, help='Inverted lists, 0 for ~sqrt(vectors)')
+    build_parser.add_argument('--reembed', action='store_true', help='Embed every stored complaint again')
+    build_parser.add_argument('--enqueue', action='store_true', help='Run as an RQ job instead of in this process')
+    query_parser = commands.add_parser('query', help='Show the complaints closest to a text')
+    query_parser.add_argument('text')
+    query_parser.add_argument('--k', type=int, default=VECTOR_DEFAULT_K)
+    query_parser.add_argument('--probes', type=int, default=VECTOR_PROBES)
+    commands.add_parser('status', help='Show the current generation')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.enqueue:
+            job = enqueue_build(resources.redis, lists=args.lists, reembed=args.reembed)
+            print(f"Enqueued vector index build {job.id}")
+        elif build_index(lists=args.lists, reembed=args.reembed) is None:
+            sys.exit(1)
+    elif args.command == 'query':
+        params = parse_similar_args({'q': args.text, 'k': args.k, 'probes': args.probes, 'hydrate': 'false'})
+        result = similar_complaints(None, params)
+        for neighbor in result['neighbors']:
+            print(f"{neighbor['complaint_id']:>12} {neighbor['score']:.4f}")
+        print(f"embedded in {result['embed_ms']} ms, searched in {result['search_ms']} ms")
+    else:
+        index = open_index()
+        if index is None:
+            print(f"No vector index in {VECTOR_INDEX_DIR}")
+            sys.exit(1)
+        size = sum(os.path.getsize(os.path.join(index.path, name)) for name in os.listdir(index.path))
+        print(f"generation   {os.path.basename(index.path)}\nembedder     {index.embedder} ({index.dim}-d)\n"
+              f"indexed      {index.count} vectors in {index.lists} lists\ntail         {len(index) - index.count} "
+              f"vectors\nsize         {size / 1024 ** 2:.1f} MiB")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
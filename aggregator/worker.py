@@ -0,0 +1,130 @@
+# aggregator/worker.py
+#
+# RQ worker entry point. In write-behind mode it also runs the flusher that
+# batches staged complaints into Postgres and Elasticsearch; on shutdown the
+# flusher finishes the batch it holds and the rest stays staged in Redis.
+#
+#   python worker.py                                # every modality queue, one worker
+#   python worker.py --queues text --concurrency 8  # dedicated text pool
+#   python worker.py --queues video,image --concurrency 2
+#   python worker.py --queues maintenance           # reindexing and vector index builds
+
+import os
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+from prometheus_client import REGISTRY, start_http_server
+from rq import Queue, Worker, SimpleWorker
+from agents.resources import resources
+from collectors import ResourcePoolCollector
+from database import ensure_schema
+from persistence import PERSISTENCE_MODE, WriteBehindFlusher, run_flusher
+from queues import MAINTENANCE, MODALITIES, queue_name
+from tasks import load_agent
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A forking worker runs every job in a fresh work horse, so pooled connections only
+# live for one job. Without forking, HTTP, Redis, Postgres and Elasticsearch
+# connections are reused across jobs.
+WORKER_FORK = os.environ.get('WORKER_FORK', 'true').lower() in ('1', 'true', 'yes')
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
+# Modalities in priority order; 'default' drains jobs enqueued before the per-modality queues
+WORKER_QUEUES = os.environ.get('WORKER_QUEUES', ','.join(MODALITIES) + f",default,{MAINTENANCE}")
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 1))
+
+def run_worker(queue_names, index=0):
+    redis_conn = resources.redis
+    if WORKER_METRICS_PORT:
+        # One port per worker process, pools are per process
+        REGISTRY.register(ResourcePoolCollector(resources))
+        start_http_server(WORKER_METRICS_PORT + index)
+
+    worker_class = Worker if WORKER_FORK else SimpleWorker
+    queues = [Queue(name, connection=redis_conn) for name in queue_names]
+    worker_class(queues, connection=redis_conn).work()
+
+def supervise(targets):
+    # Runs each (target, args) in its own process and restarts it when it exits,
+    # until the pool is asked to stop
+    context = multiprocessing.get_context('fork')
+    processes = [None] * len(targets)
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        stopping.set()
+        # Ctrl-C already reached the whole process group, a second signal would force a cold shutdown
+        if signum == signal.SIGINT:
+            return
+        for process in processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while not stopping.is_set():
+        for index, (target, args) in enumerate(targets):
+            process = processes[index]
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.warning(f"{target.__name__} process {process.pid} exited with {process.exitcode}, restarting")
+                processes[index] = context.Process(target=target, args=args)
+                processes[index].start()
+        stopping.wait(1)
+    for process in processes:
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run RQ workers for the complaint queues')
+    parser.add_argument('--queues', default=WORKER_QUEUES,
+                        help='Comma-separated modalities, maintenance (or queue names) in priority order')
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY,
+                        help='Worker processes serving these queues')
+    parser.add_argument('--preload', default=None,
+                        help='Comma-separated agents to import before the first job')
+    args = parser.parse_args()
+
+    modalities = [name for name in args.queues.split(',') if name]
+    queue_names = [queue_name(name) if name in MODALITIES + (MAINTENANCE,) else name for name in modalities]
+
+    # Worker processes and work horses are forked from this process, so agents
+    # imported here are shared; a single non-forking worker loads them on first use.
+    preload = args.preload if args.preload is not None else os.environ.get('WORKER_PRELOAD_AGENTS')
+    if preload is None:
+        preload = ','.join(m for m in modalities if m in MODALITIES) \
+            if WORKER_FORK or args.concurrency > 1 else ''
+    for complaint_type in [m for m in preload.split(',') if m]:
+        load_agent(complaint_type)
+
+    # Checked once here, every worker process and work horse forked from this one inherits it
+    try:
+        ensure_schema()
+    except Exception as e:
+        logger.warning(f"Could not check the complaints schema, checking on the first write: {str(e)}")
+
+    logger.info(f"Serving {', '.join(queue_names)} with {args.concurrency} worker process(es)")
+    if args.concurrency <= 1:
+        flusher = None
+        if PERSISTENCE_MODE == 'write_behind':
+            flusher = WriteBehindFlusher(resources.redis)
+            flusher.start()
+        try:
+            run_worker(queue_names)
+        finally:
+            if flusher is not None:
+                logger.info("Waiting for the write-behind flusher to finish its batch...")
+                flusher.stop()
+                flusher.join()
+        return
+
+    # The flusher gets its own process: forking while its thread holds a lock could deadlock a worker
+    targets = [(run_worker, (queue_names, index)) for index in range(args.concurrency)]
+    if PERSISTENCE_MODE == 'write_behind':
+        targets.append((run_flusher, ()))
+    supervise(targets)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# benchmarks/bench_audio_enhancement.py
+#
+# Time and peak memory of voice noise reduction versus clip length. The
+# streaming spectral gate is fed 16 kHz PCM in the blocks ffmpeg would deliver;
+# when noisereduce is installed it is run over the full array for comparison.
+# Peak memory is what tracemalloc sees allocated on top of the input, which
+# includes NumPy buffers.
+#
+#   python benchmarks/bench_audio_enhancement.py --minutes 1 5 15
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+import numpy as np
+
+from agents.audio_enhancement import enhance_stream
+
+SAMPLE_RATE = 16000
+BLOCK_SAMPLES = 64 * 1024
+
+def noisy_speech(seconds, seed=0):
+    # Tones switching on and off under stationary noise, with a 10 dB signal-to-noise ratio
+    rng = np.random.default_rng(seed)
+    t = np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+    clean = 3000 * np.sin(2 * np.pi * 220 * t) * (np.sin(2 * np.pi * 0.3 * t) > 0)
+    noisy = clean + rng.standard_normal(len(t)) * 500
+    return clean.astype(np.float32), np.clip(noisy, -32768, 32767).astype(np.int16)
+
+def snr(clean, samples):
+    return 10 * np.log10(np.sum(clean ** 2) / np.sum((samples.astype(np.float32) - clean) ** 2))
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 ** 2
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming noise reduction against noisereduce')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 5, 15])
+    args = parser.parse_args()
+
+    try:
+        import noisereduce
+    except ImportError:
+        noisereduce = None
+        print("noisereduce is not installed, only the streaming gate is measured")
+
+    print(f"{'clip':>7} {'pcm':>8} {'method':>12} {'time':>8} {'x realtime':>11} {'peak':>9} {'snr':>8}")
+    for minutes in args.minutes:
+        seconds = int(minutes * 60)
+        clean, samples = noisy_speech(seconds)
+        pcm_mb = samples.nbytes / 1024 ** 2
+        runs = [('streaming', lambda: enhance_stream(
+            (samples[i:i + BLOCK_SAMPLES] for i in range(0, len(samples), BLOCK_SAMPLES)),
+            SAMPLE_RATE, expected_samples=len(samples)))]
+        if noisereduce is not None:
+            runs.append(('noisereduce', lambda: noisereduce.reduce_noise(y=samples, sr=SAMPLE_RATE).astype(np.int16)))
+        for name, fn in runs:
+            enhanced, elapsed, peak = measure(fn)
+            print(f"{minutes:>6.1f}m {pcm_mb:>6.1f}MB {name:>12} {elapsed:>7.2f}s {seconds / elapsed:>10.0f}x "
+                  f"{peak:>7.1f}MB {snr(clean, enhanced):>6.1f}dB")
+        print(f"{'':>7} {'':>8} {'input':>12} {'':>8} {'':>11} {'':>9} {snr(clean, samples):>6.1f}dB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# benchmarks/bench_batch_text.py
+#
+# Throughput (complaints/second) and cost per complaint of packed batch
+# analysis versus one request per complaint, against the stub LLM server.
+#
+#   python benchmarks/bench_batch_text.py --complaints 200
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+sys.path.append(os.path.dirname(current_dir))
+
+import openai
+
+from stub_llm_server import StubLLMServer
+from bench_text_agent import SAMPLE_COMPLAINTS
+from agents import text_agent
+
+# USD per 1M tokens, gpt-3.5-turbo list prices
+INPUT_PRICE = 0.50
+OUTPUT_PRICE = 1.50
+
+def summarize(name, stub, elapsed, count):
+    stats = stub.snapshot()
+    cost = (stats['prompt_tokens'] * INPUT_PRICE + stats['completion_tokens'] * OUTPUT_PRICE) / 1e6
+    return {
+        'path': name,
+        'complaints_per_second': count / elapsed,
+        'requests': stats['requests'],
+        'tokens_per_complaint': (stats['prompt_tokens'] + stats['completion_tokens']) / count,
+        'cost_per_1k_complaints': cost / count * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batch vs one-at-a-time text analysis')
+    parser.add_argument('--complaints', type=int, default=100)
+    parser.add_argument('--base-latency', type=float, default=0.25)
+    args = parser.parse_args()
+
+    stub = StubLLMServer(base_latency=args.base_latency).start()
+    openai.api_base = f"{stub.url}/v1"
+    openai.api_key = 'stub'
+    # Distinct texts so nothing is answered from a cache
+    complaints = [f"{SAMPLE_COMPLAINTS[i % len(SAMPLE_COMPLAINTS)]} (ref {i})" for i in range(args.complaints)]
+
+    results = []
+    try:
+        stub.reset()
+        start = time.perf_counter()
+        for text in complaints:
+            text_agent.analyze_text_fused(text)
+        results.append(summarize('single', stub, time.perf_counter() - start, len(complaints)))
+
+        stub.reset()
+        start = time.perf_counter()
+        text_agent.analyze_text_batch(complaints)
+        results.append(summarize('batch', stub, time.perf_counter() - start, len(complaints)))
+    finally:
+        stub.stop()
+
+    print(f"{'path':<8} {'compl/s':>9} {'requests':>9} {'tokens':>8} {'$/1k':>8}")
+    for r in results:
+        print(f"{r['path']:<8} {r['complaints_per_second']:>9.2f} {r['requests']:>9} "
+              f"{r['tokens_per_complaint']:>8.1f} {r['cost_per_1k_complaints']:>8.4f}")
+    single, batch = results
+    print(f"batch throughput: {batch['complaints_per_second'] / single['complaints_per_second']:.1f}x, "
+          f"cost: {batch['cost_per_1k_complaints'] / single['cost_per_1k_complaints']:.2f}x")
+    print(f"adapted output estimate: {text_agent.batch_sizer.output_tokens_per_complaint:.0f} tokens/complaint")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# benchmarks/bench_entity_extraction.py
+#
+# Throughput of the in-process entity extraction engine over a synthetic
+# corpus of complaints.
+#
+#   python benchmarks/bench_entity_extraction.py --complaints 100000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.entity_extraction import extract_entities_batch
+
+TEMPLATES = [
+    "I was charged {amount} on {date} for a purchase I never made with my card ending in {last4}.",
+    "My annual fee of {amount} posted on {date} even though I closed account number {account} last month.",
+    "The interest on my statement dated {date} was {amount}, which is far more than I agreed to.",
+    "Customer service hung up on me three times this week and nobody explains the late fee.",
+    "A payment of {amount} from {date} is missing and the last four digits {last4} do not match my card.",
+    "On {date} I disputed {amount} and {amount2} but acct # {account} still shows both charges.",
+]
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+
+def random_amount(rng):
+    value = rng.uniform(1, 5000)
+    return rng.choice([f"${value:,.2f}", f"${int(value)}", f"{int(value)} dollars", f"USD {value:.2f}"])
+
+def random_date(rng):
+    year, month, day = rng.randint(2019, 2024), rng.randint(1, 12), rng.randint(1, 28)
+    return rng.choice([f"{month:02d}/{day:02d}/{year}", f"{year}-{month:02d}-{day:02d}",
+                       f"{MONTHS[month - 1]} {day}, {year}", f"{day} {MONTHS[month - 1]} {year}"])
+
+def synthetic_corpus(count, seed=7):
+    rng = random.Random(seed)
+    return [rng.choice(TEMPLATES).format(amount=random_amount(rng), amount2=random_amount(rng),
+                                         date=random_date(rng), last4=f"{rng.randint(0, 9999):04d}",
+                                         account=f"{rng.randint(10 ** 7, 10 ** 9)}")
+            for _ in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rule-based entity extraction')
+    parser.add_argument('--complaints', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.complaints)
+    total_bytes = sum(len(text) for text in corpus)
+
+    start = time.perf_counter()
+    found = 0
+    for offset in range(0, len(corpus), args.batch_size):
+        for entities in extract_entities_batch(corpus[offset:offset + args.batch_size]):
+            found += sum(len(values) for values in entities.values())
+    elapsed = time.perf_counter() - start
+
+    print(f"complaints:   {len(corpus)}")
+    print(f"entities:     {found}")
+    print(f"elapsed:      {elapsed:.2f}s")
+    print(f"throughput:   {len(corpus) / elapsed:,.0f} complaints/s, {total_bytes / elapsed / 1e6:.1f} MB/s")
+    print(f"per complaint: {elapsed / len(corpus) * 1e6:.1f}us")
+
+if __name__ == '__main__':
+    main()
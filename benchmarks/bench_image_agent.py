@@ -0,0 +1,74 @@
+# benchmarks/bench_image_agent.py
+#
+# Wall-clock time and Vision round trips per image complaint against the local
+# fake Vision/Language server: the previous three feature requests plus a
+# sequential sentiment call, one combined annotate request, and batch mode.
+#
+#   python benchmarks/bench_image_agent.py --images 32
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+sys.path.append(os.path.dirname(current_dir))
+
+import cv2
+import numpy as np
+
+from stub_vision_server import StubVisionServer
+
+def sample_images(count):
+    # Small receipts, so the numbers are about API round trips rather than preprocessing
+    images = []
+    for index in range(count):
+        page = np.full((900, 600, 3), 235, np.uint8)
+        for line in range(15):
+            cv2.putText(page, f"ITEM {index}-{line} ...... ${line * 1.37:.2f}", (30, 50 + line * 55),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 20, 20), 2)
+        images.append(cv2.imencode('.jpg', page)[1].tobytes())
+    return images
+
+def legacy_analysis(image_agent, image_content):
+    request, preprocessing = image_agent.prepare_image(image_content)
+    image = request.image
+    client = image_agent.vision_client()
+    texts = client.text_detection(image=image).text_annotations
+    client.label_detection(image=image)
+    client.object_localization(image=image)
+    if texts:
+        image_agent.text_sentiment(texts[0].description)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Vision request patterns of the image agent')
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--base-latency', type=float, default=0.15)
+    args = parser.parse_args()
+
+    stub = StubVisionServer(base_latency=args.base_latency).start()
+    os.environ['VISION_API_ENDPOINT'] = os.environ['LANGUAGE_API_ENDPOINT'] = stub.endpoint
+    os.environ['RESULT_CACHE_ENABLED'] = 'false'
+    from agents import image_agent
+
+    images = sample_images(args.images)
+    modes = [
+        ('legacy', lambda: [legacy_analysis(image_agent, image) for image in images]),
+        ('combined', lambda: [image_agent.analyze_image_complaint(image) for image in images]),
+        ('batch', lambda: image_agent.analyze_image_complaints(images)),
+    ]
+    print(f"{'mode':<10} {'s/image':>8} {'vision calls/image':>19} {'MB uploaded/image':>18}")
+    try:
+        for name, run in modes:
+            stub.reset()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            stats = stub.snapshot()
+            print(f"{name:<10} {elapsed / len(images):>8.3f} {stats['vision_requests'] / len(images):>19.2f} "
+                  f"{stats['bytes'] / len(images) / 1024 ** 2:>18.3f}")
+    finally:
+        stub.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# benchmarks/bench_image_preprocessing.py
+#
+# Time per preprocessing stage over a folder of sample images (JPEG, PNG).
+# Without a folder, synthetic receipt photos at 12 MP are generated with three
+# noise levels. --legacy also times the previous full-resolution pipeline
+# (non-local means with a 21 pixel search window, CLAHE, JPEG encode).
+#
+#   python benchmarks/bench_image_preprocessing.py --images samples/receipts --legacy
+#   python benchmarks/bench_image_preprocessing.py --skip denoise
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+import cv2
+import numpy as np
+
+from agents.complaint_options import STAGES, resolve_stages
+from agents.image_preprocessing import preprocess_image
+
+def synthetic_receipts(count=3, size=(3000, 4000)):
+    # Dark text on a light page, with Gaussian noise of increasing strength
+    rng = np.random.default_rng(0)
+    page = np.full((size[0], size[1], 3), 235, np.uint8)
+    for line in range(size[0] // 50 - 2):
+        cv2.putText(page, f"ITEM {line:03d} ............ ${line * 1.37:8.2f}", (200, 100 + line * 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.3, (20, 20, 20), 2)
+    for index in range(count):
+        sigma = 12 * index
+        noisy = np.clip(page + rng.normal(0, sigma, page.shape), 0, 255).astype(np.uint8) if sigma else page
+        yield f"synthetic-noise-{sigma}.jpg", cv2.imencode('.jpg', noisy, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+
+def folder_images(path):
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.bmp')):
+            with open(os.path.join(path, name), 'rb') as f:
+                yield name, f.read()
+
+def legacy_preprocess(data):
+    timings = {}
+    started = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    timings['decode'] = time.perf_counter() - started
+    started = time.perf_counter()
+    img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
+    timings['denoise'] = time.perf_counter() - started
+    started = time.perf_counter()
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    img = cv2.cvtColor(cv2.merge((cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8)).apply(l), a, b)),
+                       cv2.COLOR_LAB2BGR)
+    timings['contrast'] = time.perf_counter() - started
+    started = time.perf_counter()
+    cv2.imencode('.jpg', img)
+    timings['encode'] = time.perf_counter() - started
+    return {stage: seconds * 1000 for stage, seconds in timings.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image preprocessing stages')
+    parser.add_argument('--images', help='Folder of sample images, synthetic receipts when omitted')
+    parser.add_argument('--skip', default='', help=f"Comma-separated stages to turn off ({', '.join(STAGES)})")
+    parser.add_argument('--legacy', action='store_true', help='Also time the previous full-resolution pipeline')
+    args = parser.parse_args()
+
+    stages = resolve_stages({stage: False for stage in args.skip.split(',') if stage})
+    images = folder_images(args.images) if args.images else synthetic_receipts()
+    columns = ['decode', 'downscale', 'noise_estimate', 'denoise', 'contrast', 'encode']
+    totals = defaultdict(float)
+    count = 0
+
+    print(f"{'image':<28} {'size':>10} {'noise':>6} {'denoiser':>9} "
+          + ' '.join(f"{column:>14}" for column in columns) + f" {'total':>9}")
+    for name, data in images:
+        _, info = preprocess_image(data, stages)
+        timings = info['timings_ms']
+        width, height = info['original_size']
+        noise = f"{info['noise']:.1f}" if info['noise'] is not None else '-'
+        print(f"{name[:28]:<28} {f'{width}x{height}':>10} {noise:>6} {info['denoiser'] or '-':>9} "
+              + ' '.join(f"{timings.get(column, 0):>12.1f}ms" for column in columns)
+              + f" {sum(timings.values()):>7.1f}ms")
+        for column in columns:
+            totals[column] += timings.get(column, 0)
+        count += 1
+        if args.legacy:
+            legacy = legacy_preprocess(data)
+            print(f"{'  legacy':<28} {'':>10} {'':>6} {'nl_means':>9} "
+                  + ' '.join(f"{legacy.get(column, 0):>12.1f}ms" for column in columns)
+                  + f" {sum(legacy.values()):>7.1f}ms")
+
+    if count:
+        print(f"{'mean':<28} {'':>10} {'':>6} {'':>9} "
+              + ' '.join(f"{totals[column] / count:>12.1f}ms" for column in columns)
+              + f" {sum(totals.values()) / count:>7.1f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/bench_pipeline.py
+#
+# HTTP hops, Redis jobs and latency per complaint through a running aggregator
+# and its workers. Submits complaints, waits for them with the bulk status
+# endpoint and prints the change in the pipeline counters the workers keep in
+# Redis. Run it once with the workers started with AGENT_DELIVERY=http and once
+# with the default in-process delivery to compare.
+#
+#   python benchmarks/bench_pipeline.py --url http://localhost:5000 --complaints 50
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+from agents.resources import resources
+from agents.delivery import pipeline_report
+
+COMPLAINTS = [
+    "I was charged a $35 overdraft fee twice on 04/02/2024 even though my balance was positive.",
+    "The mobile app logs me out every time I try to make a transfer and support never calls back.",
+    "My credit report still shows a loan I paid off in full last year, and the lender ignores my disputes.",
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure hops, jobs and latency per complaint')
+    parser.add_argument('--url', default='http://localhost:5000', help='Aggregator base URL')
+    parser.add_argument('--complaints', type=int, default=20)
+    parser.add_argument('--type', default='text', help='Modality of the submitted complaints')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    http, redis_conn = resources.http, resources.redis
+    before = pipeline_report(redis_conn).get(args.type, {})
+
+    start = time.perf_counter()
+    job_ids = []
+    for index in range(args.complaints):
+        response = http.post(f"{args.url}/api/complaints",
+                             json={'type': args.type, 'content': COMPLAINTS[index % len(COMPLAINTS)]})
+        response.raise_for_status()
+        job_ids.append(response.json()['job_id'])
+
+    # With AGENT_DELIVERY=http each complaint finishes with a store job of its own
+    pending, stored_jobs, latencies = set(job_ids), [], []
+    while (pending or stored_jobs) and time.perf_counter() - start < args.timeout:
+        jobs = http.post(f"{args.url}/api/complaints/status",
+                         json={'job_ids': sorted(pending) + stored_jobs}).json()['jobs']
+        stored_jobs = []
+        for job in jobs:
+            if job['status'] not in ('completed', 'failed', 'unknown'):
+                if job['job_id'] not in pending:
+                    stored_jobs.append(job['job_id'])
+                continue
+            if job['job_id'] in pending:
+                pending.discard(job['job_id'])
+                follow_up = (job.get('result') or {}).get('job_id')
+                if follow_up:
+                    stored_jobs.append(follow_up)
+                    continue
+            latencies.append(time.perf_counter() - start)
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - start
+
+    after = pipeline_report(redis_conn).get(args.type, {})
+    delta = {name: after.get(name, 0.0) - before.get(name, 0.0) for name in ('complaints', 'http_hops', 'jobs', 'seconds')}
+    complaints = delta['complaints'] or 1.0
+    print(f"{args.complaints} {args.type} complaints in {elapsed:.1f}s, {len(pending)} still pending")
+    print(f"  http hops per complaint  {delta['http_hops'] / complaints:.2f}")
+    print(f"  jobs per complaint       {delta['jobs'] / complaints:.2f}")
+    print(f"  agent seconds/complaint  {delta['seconds'] / complaints:.3f}")
+    if latencies:
+        latencies.sort()
+        print(f"  end-to-end latency       p50 {latencies[len(latencies) // 2]:.2f}s  max {latencies[-1]:.2f}s")
+
+if __name__ == '__main__':
+    main()
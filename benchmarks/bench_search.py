@@ -0,0 +1,82 @@
+# benchmarks/bench_search.py
+#
+# Dashboard search against a local Elasticsearch: the previous unbounded
+# multi_match plus one follow-up query per facet, versus one filtered request
+# with aggregations, versus the same request served from the Redis cache.
+# Documents are indexed into a throwaway index that is deleted afterwards.
+#
+#   python benchmarks/bench_search.py --complaints 100000 --repeat 50
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+sys.path.append(os.path.join(os.path.dirname(current_dir), 'aggregator'))
+
+from elasticsearch.helpers import bulk
+from agents.resources import resources
+import search
+from search_index import COMPLAINT_MAPPINGS
+
+INDEX = 'bench-complaints'
+WORDS = ['charge', 'refund', 'fee', 'card', 'loan', 'late', 'statement', 'interest', 'fraud', 'account']
+
+def seed(es, count):
+    rng = random.Random(0)
+    now = datetime.now(timezone.utc)
+    es.indices.create(index=INDEX, body={'mappings': COMPLAINT_MAPPINGS})
+    bulk(es, ({'_index': INDEX, '_id': i, '_source': {
+        'complaint_id': i,
+        'type': rng.choice(['text', 'voice', 'image', 'video']),
+        'summary': ' '.join(rng.choices(WORDS, k=12)),
+        'category': rng.choice(['Billing', 'Fraud', 'Service', 'Digital']),
+        'created_at': (now - timedelta(minutes=rng.randrange(90 * 24 * 60))).isoformat(),
+    }} for i in range(count)), refresh='wait_for')
+
+def legacy_dashboard(es):
+    # What dashboards did before: unbounded search, then one query per facet
+    es.search(index=INDEX, body={'query': {'multi_match': {'query': 'refund', 'fields': ['content', 'category']}}})
+    for category in ('Billing', 'Fraud', 'Service', 'Digital'):
+        es.count(index=INDEX, body={'query': {'bool': {'must': [
+            {'multi_match': {'query': 'refund', 'fields': ['content', 'category']}},
+            {'term': {'category': category}}]}}})
+
+def timed(label, repeat, call):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    print(f"{label:<34} {(time.perf_counter() - start) / repeat * 1000:>8.1f} ms/dashboard")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dashboard search requests')
+    parser.add_argument('--complaints', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    es, redis_conn = resources.elasticsearch, resources.redis
+    es.indices.delete(index=INDEX, ignore=404)
+    seed(es, args.complaints)
+    since = (datetime.now(timezone.utc) - timedelta(days=30)).date().isoformat()
+    params = search.parse_search_args({'q': 'refund', 'from': since, 'aggs': 'category,created_at', 'size': '20'})
+    try:
+        timed('legacy search + facet queries', args.repeat, lambda: legacy_dashboard(es))
+        timed('one request with aggregations', args.repeat,
+              lambda: search.format_response(params, es.search(index=INDEX, body=search.build_query(params))))
+        search.search_complaints(es, redis_conn, params, index=INDEX)
+        timed('cached', args.repeat, lambda: search.search_complaints(es, redis_conn, params, index=INDEX))
+
+        # Walk ten pages with search_after
+        cursor, start = None, time.perf_counter()
+        for _ in range(10):
+            page = search.parse_search_args({'q': 'refund', 'size': '100', **({'cursor': cursor} if cursor else {})})
+            cursor = search.format_response(page, es.search(index=INDEX, body=search.build_query(page)))['next_cursor']
+        print(f"{'10 pages of 100 with search_after':<34} {(time.perf_counter() - start) * 1000:>8.1f} ms")
+    finally:
+        es.indices.delete(index=INDEX, ignore=404)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/bench_text_agent.py
+#
+# Compares wall-clock time and tokens per complaint for the legacy, concurrent
+# and fused text analysis modes against the local stub LLM server.
+#
+#   python benchmarks/bench_text_agent.py --complaints 20
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+sys.path.append(os.path.dirname(current_dir))
+
+import openai
+
+from stub_llm_server import StubLLMServer
+from agents import text_agent
+
+SAMPLE_COMPLAINTS = [
+    "I've been trying to reach customer service for days about a wrong charge of $50.00 on my card from 05/15/2024, but no one is responding!",
+    "My annual fee of $95 was charged twice on 01/03/2024 and the bank refuses to refund the duplicate.",
+    "The interest rate on my statement jumped to 29.99% without any notice. I was charged $212.45 in interest on 03/01/2024.",
+    "I asked to close my account on 02/10/2024 but I am still receiving statements and a $35 late fee.",
+    "A credit card was opened in my name without my consent. The first statement dated 04/22/2024 shows $1,240.00 in purchases.",
+    "My online payment of $300 on 06/01/2024 failed twice and I was charged a returned payment fee.",
+]
+
+def run_mode(stub, mode, complaints):
+    stub.reset()
+    timings = []
+    for text in complaints:
+        start = time.perf_counter()
+        text_agent.analyze_text_complaint(text, mode=mode)
+        timings.append(time.perf_counter() - start)
+    stats = stub.snapshot()
+    count = len(complaints)
+    return {
+        'mode': mode,
+        'mean_seconds': sum(timings) / count,
+        'max_seconds': max(timings),
+        'requests_per_complaint': stats['requests'] / count,
+        'tokens_per_complaint': (stats['prompt_tokens'] + stats['completion_tokens']) / count,
+        'prompt_tokens_per_complaint': stats['prompt_tokens'] / count,
+        'completion_tokens_per_complaint': stats['completion_tokens'] / count,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the text analysis modes')
+    parser.add_argument('--complaints', type=int, default=12)
+    parser.add_argument('--base-latency', type=float, default=0.25)
+    args = parser.parse_args()
+
+    stub = StubLLMServer(base_latency=args.base_latency).start()
+    openai.api_base = f"{stub.url}/v1"
+    openai.api_key = 'stub'
+
+    complaints = [SAMPLE_COMPLAINTS[i % len(SAMPLE_COMPLAINTS)] for i in range(args.complaints)]
+    try:
+        results = [run_mode(stub, mode, complaints) for mode in ('legacy', 'concurrent', 'fused')]
+    finally:
+        stub.stop()
+
+    print(f"{'mode':<10} {'mean s':>8} {'max s':>8} {'calls':>6} {'tokens':>8} {'prompt':>8} {'compl.':>8}")
+    for r in results:
+        print(f"{r['mode']:<10} {r['mean_seconds']:>8.3f} {r['max_seconds']:>8.3f} "
+              f"{r['requests_per_complaint']:>6.1f} {r['tokens_per_complaint']:>8.1f} "
+              f"{r['prompt_tokens_per_complaint']:>8.1f} {r['completion_tokens_per_complaint']:>8.1f}")
+    legacy = results[0]
+    for r in results[1:]:
+        print(f"{r['mode']} speedup: {legacy['mean_seconds'] / r['mean_seconds']:.2f}x, "
+              f"token ratio: {r['tokens_per_complaint'] / legacy['tokens_per_complaint']:.2f}")
+
+if __name__ == '__main__':
+    main()
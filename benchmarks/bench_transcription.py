@@ -0,0 +1,55 @@
+# benchmarks/bench_transcription.py
+#
+# Wall-clock transcription time versus clip length with the stub recognizer,
+# whose latency is proportional to the audio it is given (like the real API).
+# With windowed, concurrent recognition the time should follow the longest
+# window instead of the clip length.
+#
+#   python benchmarks/bench_transcription.py --minutes 1 5 15
+import argparse
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+
+import numpy as np
+
+from agents.transcription import StubRecognizer, split_on_silence, transcribe
+
+SAMPLE_RATE = 16000
+
+def synthetic_speech(seconds, seed=0):
+    # Utterances of 2-12s separated by 0.2-1.5s pauses
+    rng = np.random.default_rng(seed)
+    parts, total = [], 0
+    while total < seconds * SAMPLE_RATE:
+        speech = (rng.standard_normal(int(SAMPLE_RATE * rng.uniform(2, 12))) * 3000).astype(np.int16)
+        pause = (rng.standard_normal(int(SAMPLE_RATE * rng.uniform(0.2, 1.5))) * 30).astype(np.int16)
+        parts += [speech, pause]
+        total += len(speech) + len(pause)
+    return np.concatenate(parts)[:seconds * SAMPLE_RATE]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark windowed transcription against the stub recognizer')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 5, 15])
+    parser.add_argument('--latency', type=float, default=0.05, help='Stub seconds of latency per second of audio')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    recognizer = StubRecognizer(seconds_per_audio_second=args.latency)
+    print(f"{'clip':>8} {'windows':>8} {'longest':>8} {'serial':>8} {'windowed':>9}")
+    for minutes in args.minutes:
+        samples = synthetic_speech(int(minutes * 60))
+        windows = split_on_silence(samples, SAMPLE_RATE)
+        longest = max((end - start) / SAMPLE_RATE for start, end in windows)
+        start = time.perf_counter()
+        transcribe(samples, SAMPLE_RATE, recognizer, concurrency=args.concurrency)
+        elapsed = time.perf_counter() - start
+        # One synchronous request for the whole clip, as before
+        serial = len(samples) / SAMPLE_RATE * args.latency
+        print(f"{minutes:>7.1f}m {len(windows):>8} {longest:>7.1f}s {serial:>7.2f}s {elapsed:>8.2f}s")
+
+if __name__ == '__main__':
+    main()
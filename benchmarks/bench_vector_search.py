@@ -0,0 +1,102 @@
+# benchmarks/bench_vector_search.py
+#
+# Recall@k and queries per second of the int8 IVF vector index against exact
+# float32 search. Synthetic unit vectors are drawn around random topic centers
+# (sentence embeddings of complaints cluster by topic), appended to a throwaway
+# index directory, scanned in full as the unbuilt tail, then built into
+# inverted lists and queried with a range of probes. No Redis, Elasticsearch or
+# embedding model is needed.
+#
+#   python benchmarks/bench_vector_search.py --vectors 1000000 --probes 4,8,16,32,64
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(current_dir))
+sys.path.append(os.path.join(os.path.dirname(current_dir), 'aggregator'))
+
+import numpy as np
+import vector_index
+
+CHUNK = 100000
+
+def draw(rng, centers, count, spread):
+    topics = rng.integers(len(centers), size=count)
+    vectors = centers[topics] + spread * rng.standard_normal((count, centers.shape[1]), dtype=np.float32) \
+        / np.sqrt(centers.shape[1])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def seed(directory, args):
+    # Appends the vectors chunk by chunk while keeping the exact float32 top-k of every query
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((args.topics, args.dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    queries = draw(np.random.default_rng(1), centers, args.queries, args.spread)
+    best_scores = np.full((args.queries, args.k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((args.queries, args.k), dtype=np.int64)
+    for start in range(0, args.vectors, CHUNK):
+        vectors = draw(rng, centers, min(CHUNK, args.vectors - start), args.spread)
+        ids = np.arange(start + 1, start + 1 + len(vectors))
+        vector_index.append_vectors(ids, vectors, 'synthetic', directory)
+        scores = np.concatenate([best_scores, queries @ vectors.T], axis=1)
+        candidates = np.concatenate([best_ids, np.broadcast_to(ids, (args.queries, len(ids)))], axis=1)
+        top = np.argpartition(-scores, args.k - 1, axis=1)[:, :args.k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(candidates, top, axis=1)
+    return queries, [set(row) for row in best_ids.tolist()]
+
+def run(index, queries, truth, k, probes):
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        neighbors = index.search(query, k, probes)
+        latencies.append(time.perf_counter() - start)
+        hits += len(expected.intersection(complaint_id for complaint_id, _ in neighbors))
+    latencies = np.array(latencies) * 1000
+    return hits / (k * len(queries)), len(queries) / latencies.sum() * 1000, np.percentile(latencies, 50), \
+        np.percentile(latencies, 99)
+
+def report(label, results):
+    recall, qps, p50, p99 = results
+    print(f"{label:<22} recall@k {recall:>6.3f}  {qps:>8.1f} QPS  p50 {p50:>7.2f} ms  p99 {p99:>7.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the complaint vector index')
+    parser.add_argument('--vectors', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--topics', type=int, default=2000, help='Centers the vectors are drawn around')
+    parser.add_argument('--spread', type=float, default=1.5,
+                        help='Noise around a center: 1.0 puts vectors at ~0.7 cosine from it, 1.5 at ~0.55')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--lists', type=int, default=0, help='Inverted lists, 0 for ~sqrt(vectors)')
+    parser.add_argument('--probes', default='1,4,8,16,32,64')
+    parser.add_argument('--flat-queries', type=int, default=20, help='Queries for the full scan, it is slow')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-vectors-')
+    try:
+        start = time.perf_counter()
+        queries, truth = seed(directory, args)
+        print(f"{args.vectors} x {args.dim} vectors appended with exact top-{args.k} "
+              f"in {time.perf_counter() - start:.1f}s")
+        index = vector_index.VectorIndex(vector_index.current_generation(directory))
+        report('full int8 scan', run(index, queries[:args.flat_queries], truth[:args.flat_queries], args.k, 1))
+
+        start = time.perf_counter()
+        summary = vector_index.build_generation(directory, lists=args.lists)
+        index = vector_index.VectorIndex(vector_index.current_generation(directory))
+        size = sum(os.path.getsize(os.path.join(index.path, name)) for name in os.listdir(index.path))
+        print(f"built {summary['lists']} lists in {time.perf_counter() - start:.1f}s, "
+              f"{size / 1024 ** 2:.0f} MiB on disk ({args.vectors * args.dim * 4 / 1024 ** 2:.0f} MiB as float32)")
+        for probes in (int(value) for value in args.probes.split(',')):
+            report(f"IVF probes={probes}", run(index, queries, truth, args.k, probes))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/bench_video_keyframes.py
+#
+# Keyframe analysis of video complaints versus full-video annotation on sample
+# clips: latency, bytes uploaded and, with --live, agreement of the labels with
+# the full-video path (Jaccard similarity, and the share of full-video labels the
+# keyframes also found). Without --live the keyframes are annotated by the fake
+# Vision server and the full-video columns only show the upload size.
+#
+#   python benchmarks/bench_video_keyframes.py --videos samples/videos --live
+#   python benchmarks/bench_video_keyframes.py --keyframes 4
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+sys.path.append(os.path.dirname(current_dir))
+
+import cv2
+import numpy as np
+
+def synthetic_clips(directory, count=2, seconds=20, fps=30):
+    # Scenes of a few seconds each with moving text, in the container complaints arrive in
+    rng = np.random.default_rng(0)
+    for clip in range(count):
+        path = os.path.join(directory, f"synthetic-{clip}.mp4")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (1280, 720))
+        frame_index = 0
+        while frame_index < seconds * fps:
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            for offset in range(int(fps * rng.uniform(1.5, 5))):
+                frame = np.full((720, 1280, 3), color, np.uint8)
+                cv2.putText(frame, f"ORDER #{clip}{frame_index // fps:04d}", (80 + offset * 4, 360),
+                            cv2.FONT_HERSHEY_SIMPLEX, 2, (255 - color[0], 255 - color[1], 255 - color[2]), 4)
+                writer.write(frame)
+                frame_index += 1
+        writer.release()
+        yield path
+
+def clip_paths(directory):
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.mp4', '.mov', '.avi', '.mkv', '.webm')):
+            yield os.path.join(directory, name)
+
+def label_set(visual):
+    return {label['description'].lower() for label in visual['labels']}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark keyframe analysis against full-video annotation')
+    parser.add_argument('--videos', help='Folder of sample clips, synthetic clips when omitted')
+    parser.add_argument('--keyframes', type=int, help='Keyframes per video (VIDEO_KEYFRAMES)')
+    parser.add_argument('--live', action='store_true',
+                        help='Use the Google APIs and also run full-video annotation for label agreement')
+    args = parser.parse_args()
+
+    if args.keyframes:
+        os.environ['VIDEO_KEYFRAMES'] = str(args.keyframes)
+    stub = None
+    if not args.live:
+        from stub_vision_server import StubVisionServer
+        stub = StubVisionServer().start()
+        os.environ['VISION_API_ENDPOINT'] = os.environ['LANGUAGE_API_ENDPOINT'] = stub.endpoint
+    from agents import video_agent
+    from agents.blob_store import Media
+    from agents.keyframes import extract_keyframes
+
+    print(f"{'clip':<22} {'length':>7} {'extract':>8} {'keyframes':>10} {'uploaded':>10} "
+          f"{'full':>10} {'full s':>7} {'jaccard':>8} {'recall':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        paths = clip_paths(args.videos) if args.videos else synthetic_clips(directory)
+        try:
+            for path in paths:
+                capture = cv2.VideoCapture(path)
+                fps = capture.get(cv2.CAP_PROP_FPS)
+                length = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps else 0.0
+                capture.release()
+
+                start = time.perf_counter()
+                keyframes = extract_keyframes(path, fps)
+                extract_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                visual = video_agent.annotate_keyframes(path, fps)
+                keyframe_seconds = time.perf_counter() - start
+                uploaded = sum(len(video_agent.prepare_image(keyframe['jpeg'])[0].image.content)
+                               for keyframe in keyframes)
+                full_bytes = os.path.getsize(path)
+
+                full_seconds, jaccard, recall = '-', '-', '-'
+                if args.live:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    start = time.perf_counter()
+                    full = video_agent.annotate_full_video(Media(memoryview(data)))
+                    full_seconds = f"{time.perf_counter() - start:.1f}"
+                    ours, theirs = label_set(visual), label_set(full)
+                    jaccard = f"{len(ours & theirs) / max(1, len(ours | theirs)):.2f}"
+                    recall = f"{len(ours & theirs) / max(1, len(theirs)):.2f}"
+
+                print(f"{os.path.basename(path)[:22]:<22} {length:>6.1f}s {extract_seconds:>7.2f}s "
+                      f"{len(keyframes):>4} {keyframe_seconds:>4.1f}s {uploaded / 1024:>8.0f}KB "
+                      f"{full_bytes / 1024:>8.0f}KB {full_seconds:>7} {jaccard:>8} {recall:>7}")
+        finally:
+            if stub is not None:
+                stub.stop()
+
+if __name__ == '__main__':
+    main()
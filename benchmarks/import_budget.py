@@ -0,0 +1,92 @@
+# benchmarks/import_budget.py
+#
+# Import-time budget for the aggregator app and each worker role, measured with
+# `python -X importtime`. Fails (exit code 1) when a role goes over its time
+# budget or imports a module that belongs to another modality.
+#
+#   python benchmarks/import_budget.py
+#   python benchmarks/import_budget.py --role text --budget text=1500 --top 15
+import argparse
+import os
+import subprocess
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(current_dir)
+aggregator_dir = os.path.join(repo_dir, 'aggregator')
+
+MEDIA_MODULES = ['cv2', 'pydub', 'noisereduce', 'scipy.io', 'google.cloud.vision',
+                 'google.cloud.speech_v1p1beta1', 'google.cloud.videointelligence', 'google.cloud.language_v1']
+
+# Statement run in a fresh interpreter, time budget in ms, modules that must not be imported
+ROLES = {
+    'app': ('import app', 1500, MEDIA_MODULES + ['openai', 'numpy', 'agents.text_agent']),
+    'worker': ('import worker', 1000, MEDIA_MODULES + ['openai', 'numpy', 'agents.text_agent']),
+    'text': ('import worker, agents.text_agent', 2500, MEDIA_MODULES),
+    'voice': ('import worker, agents.voice_agent', 3500,
+              ['cv2', 'openai', 'google.cloud.vision', 'google.cloud.videointelligence']),
+    'image': ('import worker, agents.image_agent', 3500,
+              ['pydub', 'noisereduce', 'openai', 'google.cloud.speech_v1p1beta1', 'google.cloud.videointelligence']),
+    'video': ('import worker, agents.video_agent', 3500,
+              ['pydub', 'noisereduce', 'openai']),
+}
+
+def import_times(statement):
+    # {module: (self_us, cumulative_us)} for one interpreter run
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([aggregator_dir, repo_dir]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=aggregator_dir, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"`{statement}` failed:\n{proc.stderr[-2000:]}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def measure(statement, baseline, repeat):
+    # Best of `repeat` runs; interpreter start-up imports are excluded
+    best = None
+    for _ in range(repeat):
+        times = {name: t for name, t in import_times(statement).items() if name not in baseline}
+        total = sum(self_us for self_us, _ in times.values()) / 1000.0
+        if best is None or total < best[0]:
+            best = (total, times)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Check import time of the app and worker roles')
+    parser.add_argument('--role', action='append', choices=sorted(ROLES), help='Role to check (default: all)')
+    parser.add_argument('--budget', action='append', default=[], metavar='ROLE=MS', help='Override a time budget')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list per role')
+    args = parser.parse_args()
+
+    budgets = {role: budget for role, (_, budget, _) in ROLES.items()}
+    for override in args.budget:
+        role, ms = override.split('=', 1)
+        budgets[role] = float(ms)
+
+    baseline = set(import_times('pass'))
+    failures = []
+    for role in args.role or list(ROLES):
+        statement, _, forbidden = ROLES[role]
+        total_ms, times = measure(statement, baseline, args.repeat)
+        loaded = [name for name in forbidden if name in times]
+        status = 'ok' if total_ms <= budgets[role] and not loaded else 'FAIL'
+        print(f"{role:<8} {total_ms:>8.0f}ms  budget {budgets[role]:>6.0f}ms  {len(times):>5} modules  {status}")
+        for name, (_, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][1])[:args.top]:
+            print(f"    {cumulative_us / 1000.0:>8.1f}ms  {name}")
+        if total_ms > budgets[role]:
+            failures.append(f"{role}: {total_ms:.0f}ms over the {budgets[role]:.0f}ms budget")
+        if loaded:
+            failures.append(f"{role}: imports {', '.join(loaded)}")
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
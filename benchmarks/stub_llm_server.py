@@ -0,0 +1,176 @@
+# benchmarks/stub_llm_server.py
+#
+# Minimal OpenAI-compatible chat completions server used by the benchmarks.
+# Replies are canned per prompt type, latency is simulated from the token
+# counts and usage is accumulated so callers can read tokens per complaint
+# from GET /stats.
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Simulated latency: fixed round-trip cost plus generation time per completion token
+BASE_LATENCY = 0.25
+PER_COMPLETION_TOKEN = 0.004
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+def _fused_reply(text, with_entities=True):
+    reply = {
+        "category": "Billing dispute",
+        "summary": "Customer reports an unrecognized charge and cannot reach customer service.",
+        "issue": "Problem with a purchase shown on your statement",
+        "sub_issue": "Card was charged for something you did not purchase with the card",
+        "sentiment": {"label": "NEGATIVE", "score": 0.92},
+        "entities": {"monetary_amounts": re.findall(r"\$\d[\d,]*(?:\.\d{2})?", text),
+                     "dates": re.findall(r"\d{1,2}/\d{1,2}/\d{2,4}", text)},
+        "key_phrases": ["wrong charge", "customer service", "no response"]
+    }
+    if not with_entities:
+        del reply["entities"]
+    return json.dumps(reply)
+
+def _batch_reply(payload, with_entities=True):
+    try:
+        complaints = json.loads(payload)
+    except json.JSONDecodeError:
+        complaints = []
+    results = []
+    for complaint in complaints:
+        result = json.loads(_fused_reply(complaint.get('text', ''), with_entities))
+        result['id'] = complaint.get('id')
+        results.append(result)
+    return json.dumps({"results": results})
+
+def canned_reply(messages):
+    system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+    user = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+    if 'JSON array of complaints' in system:
+        return _batch_reply(user, with_entities='"entities"' in system)
+    if 'single JSON object' in system:
+        return _fused_reply(user, with_entities='"entities"' in system)
+    if 'sub-classifier' in system:
+        return "Card was charged for something you did not purchase with the card"
+    if 'complaint classifier' in system:
+        return "Problem with a purchase shown on your statement"
+    if 'sentiment' in system:
+        return json.dumps({"label": "NEGATIVE", "score": 0.92})
+    if 'monetary amounts' in system:
+        return json.dumps({"monetary_amounts": re.findall(r"\$\d[\d,]*(?:\.\d{2})?", user),
+                           "dates": re.findall(r"\d{1,2}/\d{1,2}/\d{2,4}", user)})
+    if 'key phrases' in system:
+        return json.dumps(["wrong charge", "customer service", "no response"])
+    return ("Category: Billing dispute\n"
+            "Customer reports an unrecognized charge and cannot reach customer service.")
+
+
+class StubLLMServer:
+    def __init__(self, host='127.0.0.1', port=0, base_latency=BASE_LATENCY,
+                 per_completion_token=PER_COMPLETION_TOKEN):
+        self.base_latency = base_latency
+        self.per_completion_token = per_completion_token
+        self.lock = threading.Lock()
+        self.reset()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    self._send_json(200, server.snapshot())
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if self.path == '/reset':
+                    server.reset()
+                    self._send_json(200, {'status': 'ok'})
+                    return
+                if not self.path.endswith('/chat/completions'):
+                    self._send_json(404, {'error': 'not found'})
+                    return
+
+                messages = body.get('messages', [])
+                reply = canned_reply(messages)
+                prompt_tokens = sum(estimate_tokens(m.get('content', '')) for m in messages)
+                completion_tokens = estimate_tokens(reply)
+                time.sleep(server.base_latency + server.per_completion_token * completion_tokens)
+                with server.lock:
+                    server.stats['requests'] += 1
+                    server.stats['prompt_tokens'] += prompt_tokens
+                    server.stats['completion_tokens'] += completion_tokens
+
+                self._send_json(200, {
+                    'id': f"chatcmpl-{uuid.uuid4().hex}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': body.get('model', 'stub'),
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': reply},
+                        'finish_reason': 'stop'
+                    }],
+                    'usage': {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens,
+                        'total_tokens': prompt_tokens + completion_tokens
+                    }
+                })
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a stub OpenAI chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--base-latency', type=float, default=BASE_LATENCY)
+    args = parser.parse_args()
+
+    stub = StubLLMServer(args.host, args.port, base_latency=args.base_latency)
+    print(f"Stub LLM server listening on {stub.url}")
+    stub.httpd.serve_forever()
@@ -0,0 +1,119 @@
+# benchmarks/stub_vision_server.py
+#
+# Local fake of the Vision ImageAnnotator and Language services over plaintext
+# gRPC, for benchmarks and local runs of the image agent. Point the agent at it
+# with VISION_API_ENDPOINT=127.0.0.1:<port> and LANGUAGE_API_ENDPOINT=127.0.0.1:<port>.
+# Annotations are canned, latency is simulated per request, per image and per
+# uploaded megabyte, and requests, images and bytes are counted.
+#
+#   python benchmarks/stub_vision_server.py --port 8090
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.cloud import language_v1
+from google.cloud import vision
+
+# Simulated latency: round trip, annotation work per image and upload time per MB
+BASE_LATENCY = 0.15
+PER_IMAGE = 0.05
+PER_MEGABYTE = 0.02
+SENTIMENT_LATENCY = 0.1
+
+RECEIPT_TEXT = "RECEIPT\nStore #1042\nTOTAL $42.17\nCharged twice, refund refused by the manager"
+
+
+def annotate(request):
+    response = vision.AnnotateImageResponse()
+    if not request.image.content:
+        response.error.code = 3
+        response.error.message = 'Image content is empty'
+        return response
+    features = {feature.type_ for feature in request.features}
+    if vision.Feature.Type.TEXT_DETECTION in features:
+        response.text_annotations = [vision.EntityAnnotation(description=RECEIPT_TEXT, locale='en')]
+    if vision.Feature.Type.LABEL_DETECTION in features:
+        response.label_annotations = [vision.EntityAnnotation(description='receipt', score=0.94),
+                                      vision.EntityAnnotation(description='paper', score=0.81)]
+    if vision.Feature.Type.OBJECT_LOCALIZATION in features:
+        response.localized_object_annotations = [vision.LocalizedObjectAnnotation(name='document', score=0.88)]
+    return response
+
+
+class StubVisionServer:
+    def __init__(self, host='127.0.0.1', port=0, base_latency=BASE_LATENCY, per_image=PER_IMAGE,
+                 per_megabyte=PER_MEGABYTE, sentiment_latency=SENTIMENT_LATENCY, max_workers=32):
+        self.base_latency = base_latency
+        self.per_image = per_image
+        self.per_megabyte = per_megabyte
+        self.sentiment_latency = sentiment_latency
+        self.lock = threading.Lock()
+        self.reset()
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+        self.server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler('google.cloud.vision.v1.ImageAnnotator', {
+                'BatchAnnotateImages': grpc.unary_unary_rpc_method_handler(
+                    self._batch_annotate_images,
+                    request_deserializer=vision.BatchAnnotateImagesRequest.deserialize,
+                    response_serializer=vision.BatchAnnotateImagesResponse.serialize),
+            }),
+            grpc.method_handlers_generic_handler('google.cloud.language.v1.LanguageService', {
+                'AnalyzeSentiment': grpc.unary_unary_rpc_method_handler(
+                    self._analyze_sentiment,
+                    request_deserializer=language_v1.AnalyzeSentimentRequest.deserialize,
+                    response_serializer=language_v1.AnalyzeSentimentResponse.serialize),
+            }),
+        ))
+        self.port = self.server.add_insecure_port(f"{host}:{port}")
+        self.host = host
+
+    @property
+    def endpoint(self):
+        return f"{self.host}:{self.port}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'vision_requests': 0, 'images': 0, 'bytes': 0, 'sentiment_requests': 0}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(grace=None)
+
+    def _batch_annotate_images(self, request, context):
+        size = sum(len(image_request.image.content) for image_request in request.requests)
+        time.sleep(self.base_latency + self.per_image * len(request.requests) + self.per_megabyte * size / 1024 ** 2)
+        with self.lock:
+            self.stats['vision_requests'] += 1
+            self.stats['images'] += len(request.requests)
+            self.stats['bytes'] += size
+        return vision.BatchAnnotateImagesResponse(responses=[annotate(r) for r in request.requests])
+
+    def _analyze_sentiment(self, request, context):
+        time.sleep(self.sentiment_latency)
+        with self.lock:
+            self.stats['sentiment_requests'] += 1
+        negative = any(word in request.document.content.lower() for word in ('refused', 'twice', 'broken'))
+        return language_v1.AnalyzeSentimentResponse(
+            document_sentiment=language_v1.Sentiment(score=-0.7 if negative else 0.2, magnitude=1.4))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a fake Vision and Language gRPC server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--base-latency', type=float, default=BASE_LATENCY)
+    args = parser.parse_args()
+
+    stub = StubVisionServer(args.host, args.port, base_latency=args.base_latency).start()
+    print(f"Stub Vision server listening on {stub.endpoint}")
+    stub.server.wait_for_termination()
@@ -6,6 +6,9 @@ kubectl apply -f kubernetes/
 # Wait for deployments to be ready
 kubectl rollout status deployment/aggregator
 kubectl rollout status deployment/agents
+for modality in text voice image video; do
+    kubectl rollout status deployment/worker-$modality
+done
 kubectl rollout status deployment/frontend
 kubectl rollout status statefulset/postgres
 
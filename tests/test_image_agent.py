@@ -0,0 +1,84 @@
+# tests/test_image_agent.py
+#
+# Single and batch mode of the image agent against the local fake Vision/Language
+# server, and a failed batch request.
+#
+#   python -m pytest tests/test_image_agent.py
+import importlib
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, 'benchmarks'))
+
+from stub_vision_server import StubVisionServer
+from agents.resources import resources
+from agents.result_cache import ResultCache
+
+
+@pytest.fixture(scope='module')
+def image_agent():
+    # The agent reads its endpoints and batch size at import, so it is reloaded with them set
+    # and once more after they are restored
+    stub = StubVisionServer(base_latency=0, per_image=0, per_megabyte=0, sentiment_latency=0).start()
+    from agents import image_agent
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('VISION_API_ENDPOINT', stub.endpoint)
+        patch.setenv('LANGUAGE_API_ENDPOINT', stub.endpoint)
+        patch.setenv('VISION_BATCH_SIZE', '2')
+        # Clients built for other endpoints are set aside, and nothing comes from the cache
+        for name in ('vision', 'language'):
+            patch.delitem(resources._clients, name, raising=False)
+        module = importlib.reload(image_agent)
+        patch.setattr(module, 'result_cache', ResultCache(enabled=False))
+        try:
+            yield module
+        finally:
+            for name in ('vision', 'language'):
+                resources._clients.pop(name, None)
+            stub.stop()
+    importlib.reload(image_agent)
+
+
+def receipt(index):
+    page = np.full((300, 200, 3), 235, np.uint8)
+    cv2.putText(page, f"ITEM {index}", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 20, 20), 2)
+    return cv2.imencode('.jpg', page)[1].tobytes()
+
+
+def test_single_image(image_agent):
+    result = image_agent.process_image_complaint(receipt(0))
+    assert result['type'] == 'image'
+    assert result['category'] == 'Document-related Complaint'
+    assert result['content']['text'].startswith('RECEIPT')
+    assert result['content']['sentiment']['score'] < 0
+
+
+def test_batch_mode(image_agent):
+    images = [receipt(index) for index in range(5)] + [b'not an image']
+    analyses = image_agent.analyze_image_complaints(images)
+    assert [analysis is not None for analysis in analyses] == [True] * 5 + [False]
+    assert analyses[0] == image_agent.analyze_image_complaint(images[0])
+
+
+def test_failed_batch_request_loses_only_its_batch(image_agent, monkeypatch):
+    from google.api_core.exceptions import ServiceUnavailable
+    client = image_agent.vision_client()
+    annotate = client.batch_annotate_images
+    calls = []
+
+    def flaky_annotate(requests):
+        calls.append(len(requests))
+        if len(calls) == 2:
+            raise ServiceUnavailable('Vision is down')
+        return annotate(requests=requests)
+
+    monkeypatch.setattr(client, 'batch_annotate_images', flaky_annotate)
+    analyses = image_agent.analyze_image_complaints([receipt(index) for index in range(5)])
+    assert calls == [2, 2, 1]
+    assert [analysis is not None for analysis in analyses] == [True, True, False, False, True]